@@ -0,0 +1,79 @@
+"""
+Benchmark for the /api/analytics/distributions engine
+Times build_distributions on synthetic registries of increasing size; the
+per-1000-patient cost should stay flat as the registry grows.
+
+Run from the backend directory:
+    python -m benchmarks.distributions [--sizes 1000,4000,16000] [--repeat 3]
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from services.distributions import build_distributions
+
+OCCUPATIONS = ["Farmer", "Fisherfolk", "Homemaker", "Vendor", "Driver", "Teacher", None]
+CONDITIONS = [["Hypertension"], ["Diabetes"], ["Hypertension", "Diabetes"], ["Diabetes Mellitus Type 2"]]
+RISK_LEVELS = ["Low", "Moderate", "High", "Very High", None]
+MEDICATIONS = ["Amlodipine", "Losartan", "Metformin", "Gliclazide"]
+
+
+def generate(patient_count: int, visits_per_patient: int = 5, seed: int = 7):
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    patients, visits, latest_visits = [], [], {}
+    for index in range(patient_count):
+        patient_id = f"JAG-{index:06d}"
+        patients.append({
+            "patient_id": patient_id,
+            "age": rng.randint(18, 90),
+            "occupation": rng.choice(OCCUPATIONS),
+            "education": rng.choice(["Elementary", "High School", "College"]),
+            "conditions": rng.choice(CONDITIONS),
+            "risk_level": rng.choice(RISK_LEVELS)
+        })
+        for v in range(visits_per_patient):
+            vitals = {
+                "systolic": rng.randint(100, 180),
+                "diastolic": rng.randint(60, 110),
+                "weight": rng.uniform(45, 95),
+                "height": rng.uniform(145, 180)
+            }
+            if rng.random() < 0.5:
+                vitals["glucose"] = rng.randint(70, 380)
+                vitals["glucose_type"] = rng.choice(["Fasting", "Random"])
+            visit = {
+                "patient_id": patient_id,
+                "visit_date": now - timedelta(days=(visits_per_patient - v) * 45),
+                "diagnosis": rng.choice(["HTN", "DM", "HTN+DM"]),
+                "control_status": rng.choice(["Controlled", "Uncontrolled"]),
+                "vitals": vitals,
+                "complications_noted": rng.choice([None, None, "Mild headache", "Dizziness"]),
+                "medications_dispensed": [{"name": rng.choice(MEDICATIONS), "quantity": 30}]
+            }
+            visits.append(visit)
+        latest_visits[patient_id] = visits[-1]
+    return patients, latest_visits, visits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,4000,16000,64000", help="comma-separated patient counts")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per size; the fastest is reported")
+    args = parser.parse_args()
+
+    print(f"{'patients':>10} {'visits':>10} {'ms':>10} {'ms/1k patients':>16}")
+    for size in [int(value) for value in args.sizes.split(",") if value.strip()]:
+        patients, latest_visits, visits = generate(size)
+        best = float("inf")
+        for _ in range(max(1, args.repeat)):
+            started = time.perf_counter()
+            build_distributions(patients, latest_visits, visits, months=12)
+            best = min(best, (time.perf_counter() - started) * 1000)
+        print(f"{size:>10} {len(visits):>10} {best:>10.1f} {best / size * 1000:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
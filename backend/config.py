@@ -15,7 +15,62 @@ class Settings(BaseSettings):
     # Database
     MONGODB_URL: str = "mongodb://localhost:27017"
     DATABASE_NAME: str = "healthhive"
-    DB_MODE: str = "embedded"  # embedded (mongita) or mongo (atlas/local)
+    DB_MODE: str = "embedded"  # embedded (mongita), memory (in-process, optional snapshot) or mongo (atlas/local)
+    
+    # MongoDB connection pool (DB_MODE=mongo)
+    MONGODB_MAX_POOL_SIZE: int = 100
+    MONGODB_MIN_POOL_SIZE: int = 10  # opened during startup so the first requests skip the handshake
+    MONGODB_MAX_IDLE_TIME_MS: Optional[int] = None  # close connections idle this long (None = never)
+    MONGODB_WAIT_QUEUE_TIMEOUT_MS: Optional[int] = None  # max wait for a free connection (None = forever)
+    MONGODB_COMPRESSORS: str = ""  # comma-separated, in preference order: zstd,snappy,zlib
+    MONGODB_ZLIB_COMPRESSION_LEVEL: int = 6
+    MONGODB_SERVER_SELECTION_TIMEOUT_MS: int = 30000
+    MONGODB_CONNECT_TIMEOUT_MS: int = 20000
+    MONGODB_SOCKET_TIMEOUT_MS: Optional[int] = None  # None = no timeout
+    MONGODB_POOL_WARMUP_TIMEOUT_S: float = 5.0  # how long startup waits for minPoolSize connections
+    
+    # In-memory database (DB_MODE=memory)
+    MEMORY_SNAPSHOT_DIR: Optional[str] = None  # loaded at startup and written on shutdown when set
+    MEMORY_SNAPSHOT_ON_SHUTDOWN: bool = True  # False for read-only replicas
+    MEMORY_SEED_FROM_EMBEDDED: bool = True  # copy the embedded (.mongita) data when there is no snapshot
+    
+    # Embedded database (Mongita) cursors
+    EMBEDDED_CURSOR_BATCH_SIZE: int = 256  # documents per batch handed to async iterators
+    EMBEDDED_CURSOR_PREFETCH_BATCHES: int = 4  # batches buffered ahead of the consumer
+    
+    # Embedded database worker threads
+    DB_EXECUTOR_WORKERS: int = 8  # threads for reads (all DB work unless split)
+    DB_EXECUTOR_SPLIT_READ_WRITE: bool = False  # give writes their own pool
+    DB_EXECUTOR_WRITE_WORKERS: int = 2  # writes serialize on the engine lock anyway
+    
+    # Embedded database group commit
+    DB_GROUP_COMMIT: bool = True  # batch concurrent writes into one flush
+    DB_GROUP_COMMIT_WINDOW_MS: float = 2.0  # how long a write waits for others to join its batch
+    DB_GROUP_COMMIT_MAX_OPS: int = 64  # flush as soon as this many writes are queued
+    DB_GROUP_COMMIT_FSYNC: bool = True  # fsync data and metadata before acknowledging a batch
+    
+    # Database query instrumentation
+    DB_QUERY_STATS: bool = True  # latency histograms per collection, operation and filter shape
+    DB_SLOW_QUERY_MS: float = 250.0  # log operations slower than this (0 disables the slow-query log)
+    DB_SLOW_QUERY_LOG_SIZE: int = 200  # recent slow queries kept for /api/admin/db-queries
+    
+    # Analytics
+    ANALYTICS_CACHE_TTL_S: float = 60.0  # cached results per endpoint, parameters and barangay scope (0 disables)
+    ANALYTICS_CACHE_MAX_ENTRIES: int = 512  # least recently used results are evicted beyond this
+    ANALYTICS_SNAPSHOT: bool = False  # columnar (NumPy) copy of patients/visits kept current by this process's writes; single-instance deployments only
+    
+    # List endpoints
+    LIST_TOTAL_CACHE_TTL_S: float = 300.0  # include_total=estimated totals per filter and barangay scope (0 disables)
+    LIST_TOTAL_CACHE_MAX_ENTRIES: int = 1024
+    
+    # Patient registration
+    PATIENT_ID_BLOCK_MAX: int = 500  # most patient IDs an offline device may reserve per request
+    DUPLICATE_MIN_SCORE: float = 0.8  # pairs scoring at least this (0-1) are queued for duplicate review
+    
+    # Line-list exports (/api/patients/export, /api/visits/export)
+    EXPORT_CHUNK_BYTES: int = 65536  # encoded rows are flushed to the client in chunks of about this size
+    EXPORT_GZIP_LEVEL: int = 6  # zlib level for gzip=true exports
+    EXPORT_PATIENT_BATCH_SIZE: int = 500  # patients enriched with their latest visit per lookup
     
     # Security
     SECRET_KEY: str = "your-secret-key-change-this-in-production"
@@ -46,6 +101,11 @@ class Settings(BaseSettings):
     DEFAULT_PAGE_SIZE: int = 50
     MAX_PAGE_SIZE: int = 1000
     
+    @property
+    def in_process_db(self) -> bool:
+        """True when the database runs inside this process (embedded or memory)"""
+        return self.DB_MODE.lower() in ("embedded", "memory")
+    
     class Config:
         env_file = ".env"
         case_sensitive = True
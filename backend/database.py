@@ -2,94 +2,408 @@
 Database configuration and connection management
 """
 
+from abc import ABC, abstractmethod
 from motor.motor_asyncio import AsyncIOMotorClient
 from typing import Optional
 from datetime import datetime
-import anyio
+import copy
+import itertools
 import os
 from mongita import MongitaClientDisk
 from config import settings
+from storage.streaming import stream_batches
+from storage.projection import compile_projection
+from storage.compound_index import CompoundIndexSet, index_name, is_compound_key
+from storage.engine import engine_lock, find_documents, get_document, iter_documents
+from storage.matcher import normalize_sort, split_filter
+from storage.pipeline import run_pipeline
+from storage.query import count_query, explain_index, run_query
+from storage.executor import run_read, run_write, shutdown_executors
+from storage.group_commit import commit_write
+from storage.mongo_pool import client_options, warm_pool
+from storage.memory import MemoryClient, apply_update, copy_collections, load_snapshot, save_snapshot
+from storage.loader import batchable_key, current_loader
+from storage.profiler import pipeline_shape, profile_operation, query_shape
 
-class AsyncCursorWrapper:
-    def __init__(self, cursor):
-        self._cursor = cursor
+def _split_projection(args: tuple, kwargs: dict):
+    """Pull a projection out of pymongo-style find/find_one arguments"""
+    args = list(args)
+    projection = kwargs.pop("projection", None)
+    if len(args) >= 2:
+        projection = args.pop(1)
+    return args, kwargs, projection
+
+class AsyncResultWrapper(ABC):
+    """Runs a blocking document iterator on the DB executor for async callers"""
+    _operation = "find"
+    _stream = None
+
+    @abstractmethod
+    def _iterate(self):
+        """Blocking iterator over the result documents"""
+
+    @abstractmethod
+    def _profile(self):
+        """Profiler context for one run of the operation"""
+
+    async def _to_list(self, length: Optional[int] = None):
+        def _collect():
+            if length is None:
+                return list(self._iterate())
+            return list(itertools.islice(self._iterate(), length))
+        return await run_read(self._collection.name, self._operation, _collect)
+
+    async def to_list(self, length: Optional[int] = None):
+        with self._profile() as probe:
+            docs = await self._to_list(length)
+            probe.results = len(docs)
+        return docs
+
+    def __aiter__(self):
+        async def generator():
+            batches = stream_batches(
+                self._iterate,
+                settings.EMBEDDED_CURSOR_BATCH_SIZE,
+                settings.EMBEDDED_CURSOR_PREFETCH_BATCHES,
+                lambda fetch: run_read(self._collection.name, self._operation, fetch)
+            )
+            try:
+                with self._profile() as probe:
+                    probe.results = 0
+                    async for batch in batches:
+                        probe.results += len(batch)
+                        for item in batch:
+                            yield item
+            finally:
+                # Stops batch fetching when the caller leaves the loop early
+                await batches.aclose()
+        self._stream = generator()
+        return self._stream
+
+    async def close(self):
+        """Stop a running async for iteration, like closing a Motor cursor"""
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            await stream.aclose()
+
+class AsyncCursorWrapper(AsyncResultWrapper):
+    """
+    Embedded-mode cursor. The query is planned when it runs, once sort, skip
+    and limit are known, so compound indexes can serve ordered scans.
+    """
+    def __init__(self, collection, query=None, projector=None, indexes=None):
+        self._collection = collection
+        self._query = query or {}
+        self._projector = projector
+        self._indexes = indexes
+        self._sort = []
+        self._skip = 0
+        self._limit = None
+
+    def _iterate(self):
+        # Projected reads can use the engine cache directly because the
+        # projector copies the fields it keeps
+        docs = run_query(
+            self._collection, self._indexes, self._query, self._sort, self._skip, self._limit,
+            shallow=self._projector is not None
+        )
+        return docs if self._projector is None else map(self._projector, docs)
+
+    def _profile(self):
+        detail = {"sort": self._sort, "skip": self._skip, "limit": self._limit}
+        return profile_operation(
+            self._collection.name, self._operation, query_shape(self._query),
+            lambda: explain_index(self._collection, self._indexes, self._query, self._sort),
+            {key: value for key, value in detail.items() if value}
+        )
 
     def skip(self, count: int):
-        self._cursor = self._cursor.skip(count)
+        self._skip = count
         return self
 
     def limit(self, count: int):
-        self._cursor = self._cursor.limit(count)
+        self._limit = count
         return self
 
-    def sort(self, *args, **kwargs):
-        self._cursor = self._cursor.sort(*args, **kwargs)
+    def sort(self, key_or_list, direction: Optional[int] = None):
+        self._sort = normalize_sort(key_or_list, direction)
         return self
 
-    async def to_list(self, length: Optional[int] = None):
-        def _collect():
-            if length is None:
-                return list(self._cursor)
-            return list(self._cursor.limit(length))
-        return await anyio.to_thread.run_sync(_collect)
+class AsyncPipelineWrapper(AsyncResultWrapper):
+    """Embedded-mode aggregation cursor"""
+    _operation = "aggregate"
 
-    def __aiter__(self):
-        async def generator():
-            items = await self.to_list()
-            for item in items:
-                yield item
-        return generator()
+    def __init__(self, collection, pipeline, indexes=None):
+        self._collection = collection
+        self._pipeline = pipeline
+        self._indexes = indexes
+
+    def _iterate(self):
+        return run_pipeline(self._collection, self._indexes, self._pipeline)
+
+    def _profile(self):
+        first = self._pipeline[0] if self._pipeline else {}
+        return profile_operation(
+            self._collection.name, self._operation, pipeline_shape(self._pipeline),
+            lambda: explain_index(self._collection, self._indexes, first.get("$match")) if "$match" in first else None
+        )
 
 class AsyncCollectionWrapper:
-    def __init__(self, collection):
+    def __init__(self, collection, indexes: Optional[CompoundIndexSet] = None):
         self._collection = collection
+        # Compound indexes are kept in-process; Mongita only has single-field ones
+        self._indexes = indexes if indexes is not None else CompoundIndexSet()
+
+    @property
+    def name(self) -> str:
+        return self._collection.name
+
+    def _invalidate(self, **kwargs):
+        loader = current_loader()
+        if loader is not None:
+            loader.invalidate(self.name, **kwargs)
+
+    def _profile(self, operation: str, query=None):
+        return profile_operation(
+            self.name, operation, query_shape(query or {}),
+            (lambda: explain_index(self._collection, self._indexes, query)) if query is not None else None
+        )
+
+    def _check_update(self, targets, update):
+        """Reject an update that would give a unique key to a second document"""
+        if not targets or not self._indexes.updates_unique_key(update):
+            return
+        updated = []
+        for target in targets:
+            doc = copy.deepcopy(target)
+            for operator, fields in update.items():
+                apply_update(operator, fields, doc)
+            updated.append(doc)
+        self._indexes.check_unique(updated, {str(target["_id"]): target for target in targets})
+
+    def _reindex(self, doc_ids):
+        for doc_id in doc_ids:
+            doc = get_document(self._collection, doc_id, shallow=True)
+            if doc is None:
+                self._indexes.remove(doc_id)
+            else:
+                self._indexes.add(doc)
 
     async def find_one(self, *args, **kwargs):
-        return await anyio.to_thread.run_sync(lambda: self._collection.find_one(*args, **kwargs))
+        query = args[0] if args else kwargs.get("filter")
+        with self._profile("find_one", query or {}) as probe:
+            doc = await self._find_one(*args, **kwargs)
+            probe.results = int(doc is not None)
+        return doc
+
+    async def _find_one(self, *args, **kwargs):
+        if settings.in_process_db:
+            args, kwargs, projection = _split_projection(args, kwargs)
+            query = args[0] if args else kwargs.get("filter")
+            sort = kwargs.get("sort")
+            sort = normalize_sort(sort) if sort else []
+            loader = current_loader()
+            key = batchable_key(query) if loader and projection is None and not kwargs else None
+            if key is not None:
+                return await loader.load(self, *key)
+            projector = compile_projection(projection)
+            if projector is not None or split_filter(query)[1] or (
+                self._indexes and self._indexes.plan(query or {}, sort) is not None
+            ):
+                cursor = AsyncCursorWrapper(self._collection, query, projector, self._indexes)
+                docs = await cursor.sort(sort).limit(1)._to_list(1)
+                return docs[0] if docs else None
+        return await run_read(self._collection.name, "find_one", lambda: self._collection.find_one(*args, **kwargs))
 
     def find(self, *args, **kwargs):
-        if settings.DB_MODE.lower() == "embedded":
-            if len(args) >= 2 and isinstance(args[1], dict):
-                args = list(args)
-                args.pop(1)
-            kwargs.pop("projection", None)
-            return AsyncCursorWrapper(self._collection.find(*args, **kwargs))
+        if settings.in_process_db:
+            # Projections are applied in the worker thread so only the requested
+            # fields are copied out of the engine cache
+            args, kwargs, projection = _split_projection(args, kwargs)
+            query = args[0] if args else kwargs.get("filter")
+            cursor = AsyncCursorWrapper(
+                self._collection, query, compile_projection(projection), self._indexes
+            )
+            if kwargs.get("sort"):
+                cursor.sort(kwargs["sort"])
+            if kwargs.get("skip"):
+                cursor.skip(kwargs["skip"])
+            if kwargs.get("limit"):
+                cursor.limit(kwargs["limit"])
+            return cursor
         if len(args) >= 2 and isinstance(args[1], dict):
             args = list(args)
             kwargs = {**kwargs, "projection": args[1]}
             args.pop(1)
-        return AsyncCursorWrapper(self._collection.find(*args, **kwargs))
+        return self._collection.find(*args, **kwargs)
 
-    def aggregate(self, *args, **kwargs):
-        return AsyncCursorWrapper(self._collection.aggregate(*args, **kwargs))
+    def aggregate(self, pipeline, *args, **kwargs):
+        if settings.in_process_db:
+            return AsyncPipelineWrapper(self._collection, pipeline, self._indexes)
+        return self._collection.aggregate(pipeline, *args, **kwargs)
 
-    async def insert_one(self, *args, **kwargs):
-        return await anyio.to_thread.run_sync(lambda: self._collection.insert_one(*args, **kwargs))
+    async def insert_one(self, document, *args, **kwargs):
+        def _insert():
+            with engine_lock(self._collection):
+                if self._indexes:
+                    self._indexes.check_unique([document])
+                result = self._collection.insert_one(document, *args, **kwargs)
+                if self._indexes:
+                    self._indexes.add({**document, "_id": result.inserted_id})
+            return result
+        with self._profile("insert_one") as probe:
+            result = await commit_write(self._collection, "insert_one", _insert)
+            probe.results = 1
+        self._invalidate(inserted={**document, "_id": result.inserted_id})
+        return result
 
-    async def insert_many(self, *args, **kwargs):
-        return await anyio.to_thread.run_sync(lambda: self._collection.insert_many(*args, **kwargs))
+    async def insert_many(self, documents, *args, **kwargs):
+        def _insert():
+            with engine_lock(self._collection):
+                if self._indexes:
+                    self._indexes.check_unique(documents)
+                result = self._collection.insert_many(documents, *args, **kwargs)
+                if self._indexes:
+                    for document, doc_id in zip(documents, result.inserted_ids):
+                        self._indexes.add({**document, "_id": doc_id})
+            return result
+        with self._profile("insert_many") as probe:
+            result = await commit_write(self._collection, "insert_many", _insert)
+            probe.results = len(result.inserted_ids)
+        for document, doc_id in zip(documents, result.inserted_ids):
+            self._invalidate(inserted={**document, "_id": doc_id})
+        return result
 
     async def update_one(self, *args, **kwargs):
-        return await anyio.to_thread.run_sync(lambda: self._collection.update_one(*args, **kwargs))
+        def _update():
+            if not self._indexes:
+                return self._collection.update_one(*args, **kwargs)
+            # Mongita updates the first document its own find returns, so
+            # resolving that document under the write lock names the one changed
+            with engine_lock(self._collection):
+                target = next(find_documents(self._collection, args[0], limit=1, shallow=True), None)
+                self._check_update([target] if target is not None else [], args[1])
+                result = self._collection.update_one(*args, **kwargs)
+                if target is not None:
+                    self._reindex([target["_id"]])
+            return result
+        with self._profile("update_one", args[0]) as probe:
+            result = await commit_write(self._collection, "update_one", _update)
+            probe.results = result.matched_count
+        self._invalidate(query=args[0], updated=True)
+        return result
+
+    async def update_many(self, *args, **kwargs):
+        def _update():
+            if not self._indexes:
+                return self._collection.update_many(*args, **kwargs)
+            with engine_lock(self._collection):
+                targets = list(find_documents(self._collection, args[0], shallow=True))
+                self._check_update(targets, args[1])
+                doc_ids = [doc["_id"] for doc in targets]
+                result = self._collection.update_many(*args, **kwargs)
+                self._reindex(doc_ids)
+            return result
+        with self._profile("update_many", args[0]) as probe:
+            result = await commit_write(self._collection, "update_many", _update)
+            probe.results = result.matched_count
+        self._invalidate(query=args[0], updated=True)
+        return result
+
+    async def delete_one(self, *args, **kwargs):
+        def _delete():
+            if not self._indexes:
+                return self._collection.delete_one(*args, **kwargs)
+            with engine_lock(self._collection):
+                target = next(find_documents(self._collection, args[0], limit=1, shallow=True), None)
+                result = self._collection.delete_one(*args, **kwargs)
+                if target is not None:
+                    self._reindex([target["_id"]])
+            return result
+        with self._profile("delete_one", args[0]) as probe:
+            result = await commit_write(self._collection, "delete_one", _delete)
+            probe.results = result.deleted_count
+        self._invalidate(query=args[0])
+        return result
 
     async def delete_many(self, *args, **kwargs):
-        return await anyio.to_thread.run_sync(lambda: self._collection.delete_many(*args, **kwargs))
+        def _delete():
+            if not self._indexes:
+                return self._collection.delete_many(*args, **kwargs)
+            with engine_lock(self._collection):
+                doc_ids = [doc["_id"] for doc in find_documents(self._collection, args[0], shallow=True)]
+                result = self._collection.delete_many(*args, **kwargs)
+                self._reindex(doc_ids)
+            return result
+        with self._profile("delete_many", args[0]) as probe:
+            result = await commit_write(self._collection, "delete_many", _delete)
+            probe.results = result.deleted_count
+        self._invalidate(query=args[0])
+        return result
 
     async def count_documents(self, *args, **kwargs):
-        return await anyio.to_thread.run_sync(lambda: self._collection.count_documents(*args, **kwargs))
+        query = args[0] if args else kwargs.get("filter")
+        with self._profile("count_documents", query or {}) as probe:
+            if settings.in_process_db:
+                count = await run_read(
+                    self._collection.name, "count_documents",
+                    lambda: count_query(self._collection, self._indexes, query)
+                )
+            else:
+                count = await run_read(
+                    self._collection.name, "count_documents",
+                    lambda: self._collection.count_documents(*args, **kwargs)
+                )
+            probe.results = count
+        return count
+
+    async def create_index(self, keys, *args, **kwargs):
+        with profile_operation(self.name, "create_index", normalize_sort(keys)):
+            return await self._create_index(keys, *args, **kwargs)
 
-    async def create_index(self, *args, **kwargs):
-        return await anyio.to_thread.run_sync(lambda: self._collection.create_index(*args, **kwargs))
+    async def _create_index(self, keys, *args, **kwargs):
+        if settings.in_process_db:
+            # Compound keys and unique constraints are kept in-process; the
+            # engine only gets plain single-field indexes
+            unique, sparse = kwargs.get("unique", False), kwargs.get("sparse", False)
+            compound = is_compound_key(keys)
+            if compound or unique:
+                def _create():
+                    with engine_lock(self._collection):
+                        return self._indexes.create(
+                            normalize_sort(keys), iter_documents(self._collection),
+                            unique=unique, sparse=sparse, planned=compound
+                        )
+                index = await run_write(self._collection.name, "create_index", _create)
+                if index.duplicate_keys:
+                    print(
+                        f"⚠ {self.name} has {index.duplicate_keys} duplicate key(s) for unique index "
+                        f"{index.fields}; existing duplicates are kept, new ones are rejected"
+                    )
+                if compound:
+                    return index_name(index.keys)
+            return await run_write(
+                self._collection.name, "create_index",
+                lambda: self._collection.create_index(keys)
+            )
+        return await run_write(
+            self._collection.name, "create_index",
+            lambda: self._collection.create_index(keys, *args, **kwargs)
+        )
 
 class AsyncDatabaseWrapper:
     def __init__(self, db):
         self._db = db
+        self._compound_indexes = {}
 
     def __getattr__(self, name: str):
-        return AsyncCollectionWrapper(self._db[name])
+        return self[name]
 
     def __getitem__(self, name: str):
-        return AsyncCollectionWrapper(self._db[name])
+        indexes = self._compound_indexes.setdefault(name, CompoundIndexSet())
+        return AsyncCollectionWrapper(self._db[name], indexes)
+
+EMBEDDED_DB_DIR = os.path.join(os.path.dirname(__file__), ".mongita")
 
 class Database:
     client: Optional[AsyncIOMotorClient] = None
@@ -99,8 +413,24 @@ class Database:
 async def connect_to_mongo():
     """Establish connection to MongoDB"""
     try:
-        if settings.DB_MODE.lower() == "embedded":
-            db_dir = os.path.join(os.path.dirname(__file__), ".mongita")
+        if settings.DB_MODE.lower() == "memory":
+            Database.client = MemoryClient()
+            memory_db = Database.client[settings.DATABASE_NAME]
+            snapshot_dir = settings.MEMORY_SNAPSHOT_DIR
+            if snapshot_dir and os.path.isdir(snapshot_dir):
+                counts = load_snapshot(memory_db, snapshot_dir)
+                print(f"✓ Loaded memory snapshot from {snapshot_dir} ({sum(counts.values())} documents)")
+            elif settings.MEMORY_SEED_FROM_EMBEDDED and os.path.isdir(EMBEDDED_DB_DIR):
+                counts = copy_collections(MongitaClientDisk(EMBEDDED_DB_DIR)[settings.DATABASE_NAME], memory_db)
+                print(f"✓ Seeded memory database from embedded data ({sum(counts.values())} documents)")
+            Database.db = AsyncDatabaseWrapper(memory_db)
+            await create_indexes()
+            print("✓ Connected to in-memory database")
+            print(f"✓ Using database: {settings.DATABASE_NAME}")
+            return
+
+        if settings.in_process_db:
+            db_dir = EMBEDDED_DB_DIR
             os.makedirs(db_dir, exist_ok=True)
             Database.client = MongitaClientDisk(db_dir)
             Database.db = AsyncDatabaseWrapper(Database.client[settings.DATABASE_NAME])
@@ -109,12 +439,18 @@ async def connect_to_mongo():
             print(f"✓ Using database: {settings.DATABASE_NAME}")
             return
 
-        Database.client = AsyncIOMotorClient(settings.MONGODB_URL)
+        Database.client = AsyncIOMotorClient(settings.MONGODB_URL, **client_options())
         Database.db = Database.client[settings.DATABASE_NAME]
 
         # Verify connection
         await Database.client.admin.command('ping')
 
+        # Open the minimum pool up front so early requests skip the handshake
+        opened = await warm_pool(
+            Database.client, settings.MONGODB_MIN_POOL_SIZE, settings.MONGODB_POOL_WARMUP_TIMEOUT_S
+        )
+        print(f"✓ Connection pool warmed: {opened}/{settings.MONGODB_MIN_POOL_SIZE} connections open")
+
         # Create indexes for performance
         await create_indexes()
 
@@ -126,7 +462,12 @@ async def connect_to_mongo():
 
 async def close_mongo_connection():
     """Close MongoDB connection"""
-    if Database.client and settings.DB_MODE.lower() != "embedded":
+    if settings.DB_MODE.lower() == "memory" and settings.MEMORY_SNAPSHOT_DIR and settings.MEMORY_SNAPSHOT_ON_SHUTDOWN:
+        counts = save_snapshot(Database.client[settings.DATABASE_NAME], settings.MEMORY_SNAPSHOT_DIR)
+        print(f"✓ Saved memory snapshot to {settings.MEMORY_SNAPSHOT_DIR} ({sum(counts.values())} documents)")
+    if settings.in_process_db:
+        shutdown_executors()
+    if Database.client and not settings.in_process_db:
         Database.client.close()
         print("Closed MongoDB connection")
 
@@ -135,10 +476,6 @@ async def create_indexes():
     db = Database.db
 
     async def safe_create_index(collection, *args, **kwargs):
-        if settings.DB_MODE.lower() == "embedded":
-            kwargs = {}
-            if args and isinstance(args[0], (list, tuple)) and args[0] and isinstance(args[0][0], (list, tuple)):
-                return None
         return await collection.create_index(*args, **kwargs)
     
     # Patient indexes
@@ -148,6 +485,8 @@ async def create_indexes():
     await safe_create_index(db.patients, "conditions")
     await safe_create_index(db.patients, "risk_level")
     await safe_create_index(db.patients, "created_at")
+    await safe_create_index(db.patients, [("created_at", -1), ("patient_id", -1)])
+    await safe_create_index(db.patients, "identity_hash", unique=True, sparse=True)
     
     # Visit indexes
     await safe_create_index(db.visits, "visit_id", unique=True)
@@ -155,6 +494,8 @@ async def create_indexes():
     await safe_create_index(db.visits, "visit_date")
     await safe_create_index(db.visits, "sync_status")
     await safe_create_index(db.visits, [("patient_id", 1), ("visit_date", -1)])
+    await safe_create_index(db.visits, [("patient_id", 1), ("visit_date", -1), ("visit_id", -1)])
+    await safe_create_index(db.visits, [("visit_date", -1), ("visit_id", -1)])
     
     # User indexes
     await safe_create_index(db.users, "user_id", unique=True)
@@ -192,6 +533,36 @@ async def create_indexes():
     await safe_create_index(db.audit_logs, "timestamp")
     await safe_create_index(db.audit_logs, "action")
     
+    # Latest-visit projection indexes
+    await safe_create_index(db.patient_latest_visit, "patient_id", unique=True)
+    
+    # Monthly visit rollup indexes; the key gained patient state, so the
+    # old unique key would reject rows that now differ only by state
+    if not settings.in_process_db:
+        legacy_rollup_key = "barangay_1_month_1_diagnosis_1_control_status_1_visit_type_1"
+        if legacy_rollup_key in await db.visit_monthly_rollup.index_information():
+            await db.visit_monthly_rollup.drop_index(legacy_rollup_key)
+    await safe_create_index(
+        db.visit_monthly_rollup,
+        [("barangay", 1), ("month", 1), ("diagnosis", 1), ("control_status", 1), ("visit_type", 1),
+         ("is_active", 1), ("htn", 1), ("dm", 1)],
+        unique=True
+    )
+    await safe_create_index(db.visit_monthly_rollup, [("diagnosis", 1), ("month", 1)])
+    
+    # Patient search index
+    await safe_create_index(db.patient_search, "patient_id", unique=True)
+    await safe_create_index(db.patient_search, "terms")
+    
+    # Duplicate review indexes
+    await safe_create_index(db.patient_duplicate_candidates, "pair_id", unique=True)
+    await safe_create_index(db.patient_duplicate_candidates, [("status", 1), ("score", -1)])
+    
+    # ID counter and reserved ID block indexes
+    await safe_create_index(db.counters, "name", unique=True)
+    await safe_create_index(db.patient_id_blocks, "block_id", unique=True)
+    await safe_create_index(db.patient_id_blocks, [("reserved_by", 1), ("first", 1)])
+    
     print("Database indexes created successfully")
 
 def get_database():
@@ -0,0 +1,36 @@
+"""
+Duplicate Patient Finder for HealthHive Platform
+Blocks active patients by phonetic surname key and birth year, scores each
+pair in a block and queues likely duplicates in patient_duplicate_candidates
+for review (GET /api/admin/duplicates)
+"""
+
+import asyncio
+from database import connect_to_mongo, close_mongo_connection, get_database
+from services.duplicates import backfill_identity_hashes, find_duplicate_candidates
+
+
+async def main():
+    """Backfill identity hashes, then score duplicate candidates"""
+    await connect_to_mongo()
+    db = get_database()
+
+    try:
+        backfilled = await backfill_identity_hashes(db)
+        print(
+            f"✓ Backfilled identity hashes for {backfilled['hashed']} patients, "
+            f"{backfilled['collisions']} exact duplicates queued for review"
+        )
+        stats = await find_duplicate_candidates(db)
+        print(
+            f"✓ Scanned {stats['patients']} patients in {stats['blocks']} blocks: "
+            f"{stats['pairs_compared']} pairs compared, {stats['pairs_recorded']} queued for review"
+        )
+    except Exception as e:
+        print(f"\n✗ Error finding duplicates: {e}")
+        raise
+    finally:
+        await close_mongo_connection()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -13,7 +13,14 @@ from contextlib import asynccontextmanager
 import time
 
 from config import settings
-from database import connect_to_mongo, close_mongo_connection
+from database import connect_to_mongo, close_mongo_connection, get_database
+from services.columnar import load_analytics_snapshot
+from services.duplicates import backfill_identity_hashes
+from services.id_allocator import ensure_patient_id_counter
+from services.latest_visits import ensure_latest_visits
+from services.patient_search import ensure_patient_search
+from services.visit_rollups import ensure_visit_rollups
+from storage.loader import request_scope
 
 # Import routes
 from routes.auth_routes import router as auth_router
@@ -29,6 +36,27 @@ from routes.field_ops_routes import router as field_ops_router
 async def lifespan(app: FastAPI):
     # Startup
     await connect_to_mongo()
+    db = get_database()
+    backfilled = await ensure_latest_visits(db)
+    if backfilled is not None:
+        print(f"✓ Backfilled latest-visit projection for {backfilled} patients")
+    backfilled = await ensure_visit_rollups(db)
+    if backfilled is not None:
+        print(f"✓ Backfilled monthly visit rollup with {backfilled} rows")
+    backfilled = await ensure_patient_search(db)
+    if backfilled is not None:
+        print(f"✓ Backfilled patient search index for {backfilled} patients")
+    backfilled = await backfill_identity_hashes(db)
+    if backfilled["hashed"]:
+        print(f"✓ Backfilled identity hashes for {backfilled['hashed']} patients")
+    if backfilled["collisions"]:
+        print(f"⚠ {backfilled['collisions']} patients match an existing identity hash; recorded as duplicate candidates")
+    counter = await ensure_patient_id_counter(db)
+    if counter is not None:
+        print(f"✓ Initialized patient ID counter at {counter}")
+    if settings.ANALYTICS_SNAPSHOT:
+        snapshot = await load_analytics_snapshot(db)
+        print(f"✓ Loaded analytics snapshot: {snapshot.patients.size} patients, {snapshot.visits.size} visits")
     print(f"✓ {settings.APP_NAME} v{settings.APP_VERSION} started successfully")
     yield
     # Shutdown
@@ -89,6 +117,15 @@ async def add_process_time_header(request: Request, call_next):
     response.headers["X-Process-Time"] = str(process_time)
     return response
 
+# Request-scoped find_one batching and identity map; only the in-process
+# backends batch, Motor's find_one goes straight to the server
+@app.middleware("http")
+async def find_one_loader_scope(request: Request, call_next):
+    if not settings.in_process_db:
+        return await call_next(request)
+    with request_scope():
+        return await call_next(request)
+
 # Include routers
 app.include_router(auth_router)
 app.include_router(patient_router)
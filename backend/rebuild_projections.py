@@ -0,0 +1,36 @@
+"""
+Projection Rebuild Script for HealthHive Platform
+Recomputes read models derived from the visits and patients collections
+- patient_latest_visit: most recent visit per patient
+- visit_monthly_rollup: visit counts per barangay, month, diagnosis,
+  control status and visit type
+- patient_search: name and ID search postings per patient
+"""
+
+import asyncio
+from database import connect_to_mongo, close_mongo_connection, get_database
+from services.latest_visits import rebuild_latest_visits
+from services.patient_search import rebuild_patient_search
+from services.visit_rollups import rebuild_visit_rollups
+
+
+async def main():
+    """Rebuild every projection from source collections"""
+    await connect_to_mongo()
+    db = get_database()
+
+    try:
+        count = await rebuild_latest_visits(db)
+        print(f"✓ Rebuilt patient_latest_visit for {count} patients")
+        count = await rebuild_visit_rollups(db)
+        print(f"✓ Rebuilt visit_monthly_rollup with {count} rows")
+        count = await rebuild_patient_search(db)
+        print(f"✓ Rebuilt patient_search for {count} patients")
+    except Exception as e:
+        print(f"\n✗ Error rebuilding projections: {e}")
+        raise
+    finally:
+        await close_mongo_connection()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,11 +2,20 @@
 Admin endpoints for user management and audit logs.
 """
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Body, Depends, HTTPException, Query
+from typing import Literal, Optional
 from datetime import datetime
 from database import get_database
 from auth import get_current_user
 from models.schemas import RoleEnum
+from services.analytics_cache import analytics_cache_metrics
+from services.columnar import analytics_snapshot
+from services.duplicates import find_duplicate_candidates
+from services.list_totals import list_total_cache_metrics
+from storage.executor import executor_metrics
+from storage.group_commit import group_commit_metrics
+from storage.mongo_pool import pool_metrics
+from storage.profiler import query_metrics
 
 router = APIRouter(prefix="/api/admin", tags=["Admin"])
 
@@ -67,7 +76,7 @@ async def admin_summary(
     barangays = await db.barangays.count_documents({})
     medications = len(set([
         med.get("name")
-        for visit in await db.visits.find({}).to_list(length=100000)
+        for visit in await db.visits.find({}, {"medications_dispensed.name": 1}).to_list(length=100000)
         for med in visit.get("medications_dispensed", [])
         if med.get("name")
     ]))
@@ -78,3 +87,100 @@ async def admin_summary(
         "medications": medications,
         "last_sync": last_sync
     }
+
+@router.get("/db-metrics")
+async def db_metrics(
+    reset: bool = Query(False),
+    current_user: dict = Depends(get_current_user)
+):
+    """Embedded DB executor queue depth, per-operation wait/run times and group commit batching"""
+    require_admin(current_user)
+    return {**executor_metrics(reset=reset), "group_commit": group_commit_metrics()}
+
+@router.get("/db-pool")
+async def db_pool(
+    reset: bool = Query(False),
+    current_user: dict = Depends(get_current_user)
+):
+    """MongoDB connection pool state and checkout wait times (DB_MODE=mongo)"""
+    require_admin(current_user)
+    return pool_metrics(reset=reset)
+
+@router.get("/db-queries")
+async def db_queries(
+    reset: bool = Query(False),
+    limit: Optional[int] = Query(50, ge=1),
+    order_by: str = Query("total_ms", pattern="^(total_ms|p99_ms|p95_ms|max_ms|avg_ms|count)$"),
+    current_user: dict = Depends(get_current_user)
+):
+    """Latency histograms per collection, operation and query shape, plus recent slow queries"""
+    require_admin(current_user)
+    return query_metrics(reset=reset, limit=limit, order_by=order_by)
+
+@router.get("/analytics-cache")
+async def analytics_cache(
+    current_user: dict = Depends(get_current_user)
+):
+    """Analytics result cache size, hit rate, evictions and invalidations"""
+    require_admin(current_user)
+    return analytics_cache_metrics()
+
+@router.get("/list-total-cache")
+async def list_total_cache(
+    current_user: dict = Depends(get_current_user)
+):
+    """Cached list totals (include_total=estimated): size, hit rate and invalidations"""
+    require_admin(current_user)
+    return list_total_cache_metrics()
+
+@router.get("/analytics-snapshot")
+async def analytics_snapshot_metrics(
+    current_user: dict = Depends(get_current_user)
+):
+    """Row counts and column memory of the columnar analytics snapshot"""
+    require_admin(current_user)
+    snapshot = analytics_snapshot()
+    if snapshot is None:
+        return {"enabled": False}
+    return {"enabled": True, **snapshot.metrics()}
+
+@router.post("/duplicates/scan")
+async def scan_duplicates(
+    min_score: Optional[float] = Query(None, ge=0, le=1),
+    current_user: dict = Depends(get_current_user),
+    db = Depends(get_database)
+):
+    """Run the duplicate finder now and queue likely duplicate pairs for review"""
+    require_admin(current_user)
+    return await find_duplicate_candidates(db, min_score)
+
+@router.get("/duplicates")
+async def list_duplicates(
+    status: Literal["pending", "duplicate", "not_duplicate"] = Query("pending"),
+    limit: int = Query(50, ge=1, le=500),
+    current_user: dict = Depends(get_current_user),
+    db = Depends(get_database)
+):
+    """Duplicate candidate pairs by review status, highest score first"""
+    require_admin(current_user)
+    pairs = await db.patient_duplicate_candidates.find({"status": status}).sort("score", -1).to_list(length=limit)
+    for pair in pairs:
+        pair.pop("_id", None)
+    return {"pairs": pairs}
+
+@router.put("/duplicates/{pair_id}")
+async def review_duplicate(
+    pair_id: str,
+    decision: Literal["duplicate", "not_duplicate"] = Body(..., embed=True),
+    current_user: dict = Depends(get_current_user),
+    db = Depends(get_database)
+):
+    """Record the review decision for a candidate pair"""
+    require_admin(current_user)
+    result = await db.patient_duplicate_candidates.update_one(
+        {"pair_id": pair_id},
+        {"$set": {"status": decision, "reviewed_by": current_user["user_id"], "reviewed_at": datetime.utcnow()}}
+    )
+    if not result.matched_count:
+        raise HTTPException(status_code=404, detail="Duplicate candidate not found")
+    return {"pair_id": pair_id, "status": decision}
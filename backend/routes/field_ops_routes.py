@@ -8,6 +8,7 @@ from collections import defaultdict
 from database import get_database
 from auth import get_current_user
 from models.schemas import RoleEnum, ControlStatus
+from services.latest_visits import get_latest_visits
 
 router = APIRouter(prefix="/api/field-ops", tags=["FieldOps"])
 
@@ -32,15 +33,14 @@ async def get_field_ops_summary(
     patient_ids = [p.get("patient_id") for p in patients if p.get("patient_id")]
     patient_map = {p.get("patient_id"): p for p in patients}
 
-    visits = await db.visits.find({"patient_id": {"$in": patient_ids}}).to_list(length=100000)
-    latest_by_patient = {}
-    for visit in visits:
-        pid = visit.get("patient_id")
-        if not pid:
-            continue
-        current = latest_by_patient.get(pid)
-        if not current or (visit.get("visit_date") and visit["visit_date"] > current.get("visit_date")):
-            latest_by_patient[pid] = visit
+    latest_by_patient = await get_latest_visits(db, patient_ids)
+
+    # Only the past week's visits feed the KPI and team counts below
+    week_start = now - timedelta(days=7)
+    visits = await db.visits.find({
+        "patient_id": {"$in": patient_ids},
+        "visit_date": {"$gte": week_start}
+    }).to_list(length=100000)
 
     # Build barangay metrics for heatmap
     barangay_metrics = {}
@@ -104,7 +104,6 @@ async def get_field_ops_summary(
 
     # KPI counts
     today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    week_start = now - timedelta(days=7)
     today_visits = sum(1 for visit in visits if visit.get("visit_date") and visit["visit_date"] >= today_start)
     week_visits = sum(1 for visit in visits if visit.get("visit_date") and visit["visit_date"] >= week_start)
     overdue_count = len(overdue_visits)
@@ -3,22 +3,34 @@ Patient management endpoints
 Register, list, retrieve, update patients
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, Query
-from typing import List, Optional
+from fastapi import APIRouter, Body, Depends, HTTPException, status, Query
+from typing import List, Literal, Optional
 from datetime import datetime
-from database import get_database
 from config import settings
+from database import get_database
 from auth import get_current_user, RoleChecker, check_barangay_access
 from models.schemas import Patient, RoleEnum, ConsentRecord
+from services.analytics_cache import invalidate_barangays
+from services.columnar import snapshot_patient
+from services.duplicates import IDENTITY_FIELDS, identity_hash
+from services.export import PATIENT_EXPORT_COLUMNS, batched, export_response
+from services.id_allocator import PATIENT_ID_COUNTER, allocate, allocate_patient_ids, format_patient_id, parse_patient_id
+from services.latest_visits import get_latest_visits
+from services.list_totals import TotalMode, list_total, scope_tags
+from services.pagination import after_cursor, keyset_sort, next_cursor
+from services.patient_search import record_patient_search, search_patient_ids
+from services.visit_rollups import move_patient_rollups
 from validation import ClinicalValidator, ValidationError
+from pymongo.errors import DuplicateKeyError
 import re
 import uuid
 
 router = APIRouter(prefix="/api/patients", tags=["Patients"])
 
-def generate_patient_id(barangay: str, count: int) -> str:
-    """Generate unique patient ID: JAG-XXXXXX"""
-    return f"JAG-{count + 1:06d}"
+DUPLICATE_PATIENT_DETAIL = "Patient with same name, date of birth, and barangay already exists. Check for duplicates."
+
+# Internal fields kept out of list rows and exports
+PATIENT_ROW_PROJECTION = {"identity_hash": 0, "consent_records": 0}
 
 def normalize_conditions(conditions: List[str]) -> List[str]:
     """Normalize condition labels to HTN/DM tags for UI compatibility"""
@@ -42,7 +54,7 @@ async def register_patient(
     - Requires BHW, RHU_NURSE, or ADMIN role
     - Validates required fields
     - Checks for duplicates
-    - Generates unique patient ID
+    - Allocates a unique patient ID, or uses one from the user's reserved blocks
     - Records consent
     """
     # Check role permissions
@@ -71,23 +83,40 @@ async def register_patient(
             detail=[{"field": e.field, "message": e.message} for e in validation_errors]
         )
     
-    # Check for potential duplicates
-    existing_patient = await db.patients.find_one({
-        "first_name": patient_data["first_name"],
-        "last_name": patient_data["last_name"],
-        "date_of_birth": patient_data["date_of_birth"],
-        "barangay": barangay
-    })
+    # Check for potential duplicates (normalized name, date of birth and barangay)
+    patient_identity = identity_hash({**patient_data, "barangay": barangay})
+    existing_patient = await db.patients.find_one({"identity_hash": patient_identity})
     
     if existing_patient:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
-            detail="Patient with same name, date of birth, and barangay already exists. Check for duplicates."
+            detail=DUPLICATE_PATIENT_DETAIL
         )
     
-    # Generate patient ID
-    patient_count = await db.patients.count_documents({})
-    patient_id = generate_patient_id(barangay, patient_count)
+    # Use an ID the user reserved for offline registration, otherwise allocate one
+    requested_id = patient_data.get("patient_id")
+    if requested_id:
+        number = parse_patient_id(requested_id)
+        block = None
+        if number is not None:
+            block = await db.patient_id_blocks.find_one({
+                "reserved_by": current_user["user_id"],
+                "first": {"$lte": number},
+                "last": {"$gte": number}
+            })
+        if not block:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Patient ID {requested_id} was not reserved by this user"
+            )
+        if await db.patients.find_one({"patient_id": requested_id}):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Patient ID {requested_id} is already registered"
+            )
+        patient_id = requested_id
+    else:
+        patient_id = (await allocate_patient_ids(db))[0]
     
     # Prepare patient document
     now = datetime.utcnow()
@@ -113,6 +142,7 @@ async def register_patient(
         "medications_provided": patient_data.get("medications_provided"),
         "medications_taken_regularly": patient_data.get("medications_taken_regularly"),
         "flagged_for_follow_up": patient_data.get("flagged_for_follow_up"),
+        "identity_hash": patient_identity,
         "consent_records": [],
         "created_at": now,
         "created_by": current_user["user_id"],
@@ -131,8 +161,20 @@ async def register_patient(
         }
         patient_doc["consent_records"].append(consent)
     
-    # Insert patient
-    result = await db.patients.insert_one(patient_doc)
+    # Insert patient; the unique identity_hash index catches a concurrent duplicate
+    try:
+        result = await db.patients.insert_one(patient_doc)
+    except DuplicateKeyError as exc:
+        if "patient_id" in (exc.details or {}).get("keyPattern", {}):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Patient ID {patient_id} is already registered"
+            )
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=DUPLICATE_PATIENT_DETAIL
+        )
+    invalidate_barangays(barangay)
     
     # Log audit with UUID to prevent collisions
     audit_id = f"AUDIT-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{str(uuid.uuid4())[:8]}"
@@ -149,28 +191,59 @@ async def register_patient(
     
     # Return created patient
     created_patient = await db.patients.find_one({"_id": result.inserted_id})
+    snapshot_patient(created_patient)
+    await record_patient_search(db, created_patient)
     created_patient.pop("_id")
     
     return created_patient
 
-@router.get("")
-async def list_patients(
-    barangay: Optional[str] = Query(None),
-    condition: Optional[str] = Query(None, description="HTN, DM, or HTN+DM"),
-    risk_level: Optional[str] = Query(None),
-    search: Optional[str] = Query(None, description="Search by name or patient ID"),
-    skip: int = Query(0, ge=0),
-    limit: int = Query(50, ge=1, le=1000),
+@router.post("/id-blocks", status_code=status.HTTP_201_CREATED)
+async def reserve_patient_ids(
+    count: int = Body(..., embed=True, ge=1, le=settings.PATIENT_ID_BLOCK_MAX),
+    device_id: Optional[str] = Body(None, embed=True),
     current_user: dict = Depends(get_current_user),
     db = Depends(get_database)
 ):
     """
-    List patients with filters and pagination
+    Reserve a block of consecutive patient IDs for offline registration
     
-    - BHWs/RHU nurses see only their assigned barangays
-    - Supervisors/admins see all
-    - Supports search, filtering, and pagination
+    - Requires BHW, RHU_NURSE, or ADMIN role
+    - Patients registered later with these IDs must be submitted by the same user
     """
+    allowed_roles = [RoleEnum.BHW, RoleEnum.RHU_NURSE, RoleEnum.ADMIN]
+    if current_user["role"] not in [r.value for r in allowed_roles]:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Insufficient permissions to register patients"
+        )
+    
+    first = await allocate(db, PATIENT_ID_COUNTER, count)
+    now = datetime.utcnow()
+    block = {
+        "block_id": f"IDBLOCK-{now.strftime('%Y%m%d%H%M%S')}-{str(uuid.uuid4())[:8]}",
+        "first": first,
+        "last": first + count - 1,
+        "reserved_by": current_user["user_id"],
+        "device_id": device_id,
+        "reserved_at": now
+    }
+    await db.patient_id_blocks.insert_one(block)
+    
+    return {
+        "block_id": block["block_id"],
+        "first_patient_id": format_patient_id(block["first"]),
+        "last_patient_id": format_patient_id(block["last"]),
+        "patient_ids": [format_patient_id(number) for number in range(block["first"], block["last"] + 1)],
+        "count": count
+    }
+
+def build_patient_list_query(
+    current_user: dict,
+    barangay: Optional[str],
+    condition: Optional[str],
+    risk_level: Optional[str]
+) -> dict:
+    """Patient filter for list/export: the caller's barangay scope plus the requested filters"""
     # Build query based on user permissions
     query = {"is_active": True}
     
@@ -209,86 +282,150 @@ async def list_patients(
     
     if risk_level:
         query["risk_level"] = risk_level
+    return query
+
+def enrich_patient(patient: dict, latest_visit: Optional[dict]):
+    """Add latest-visit fields (last visit, control status, vitals) to a patient row in place"""
+    patient["conditions"] = normalize_conditions(patient.get("conditions", []))
+    patient["last_visit_date"] = latest_visit.get("visit_date") if latest_visit else None
+    patient["next_visit_date"] = latest_visit.get("next_visit_date") if latest_visit else None
+    if latest_visit and latest_visit.get("control_status"):
+        patient["control_status"] = latest_visit.get("control_status")
+    else:
+        patient["control_status"] = "N/A" if not patient["conditions"] else "Unknown"
+    vitals = latest_visit.get("vitals", {}) if latest_visit else {}
+    if vitals.get("systolic") and vitals.get("diastolic"):
+        patient["latest_bp"] = f"{vitals.get('systolic')}/{vitals.get('diastolic')}"
+    if vitals.get("glucose"):
+        patient["latest_glucose"] = vitals.get("glucose")
+    if vitals.get("glucose_random") is not None:
+        patient["latest_rbg"] = vitals.get("glucose_random")
+    elif vitals.get("glucose") is not None and (vitals.get("glucose_type") or "").lower() == "random":
+        patient["latest_rbg"] = vitals.get("glucose")
+    if vitals.get("glucose_fasting") is not None:
+        patient["latest_fbg"] = vitals.get("glucose_fasting")
+    elif vitals.get("glucose") is not None and (vitals.get("glucose_type") or "").lower() == "fasting":
+        patient["latest_fbg"] = vitals.get("glucose")
+    if vitals.get("weight") is not None:
+        patient["weight"] = vitals.get("weight")
+    if vitals.get("height") is not None:
+        patient["height"] = vitals.get("height")
+    if vitals.get("bmi") is not None:
+        patient["bmi"] = vitals.get("bmi")
+    if latest_visit and latest_visit.get("flagged_for_follow_up") is not None:
+        patient["flagged_for_follow_up"] = latest_visit.get("flagged_for_follow_up")
+    patient.pop("_id", None)
+
+@router.get("")
+async def list_patients(
+    barangay: Optional[str] = Query(None),
+    condition: Optional[str] = Query(None, description="HTN, DM, or HTN+DM"),
+    risk_level: Optional[str] = Query(None),
+    search: Optional[str] = Query(None, description="Search by name or patient ID"),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page (replaces skip)"),
+    include_total: TotalMode = Query("exact", description="exact, estimated (cached per scope) or none"),
+    current_user: dict = Depends(get_current_user),
+    db = Depends(get_database)
+):
+    """
+    List patients with filters and pagination
+    
+    - BHWs/RHU nurses see only their assigned barangays
+    - Supervisors/admins see all
+    - Supports search, filtering, and pagination
+    - Newest first; pass next_cursor back as cursor to resume after the last row
+      (search results are ranked and paged with skip)
+    - include_total=none skips the count; estimated may lag recent writes briefly
+    """
+    query = build_patient_list_query(current_user, barangay, condition, risk_level)
     
-    # Apply search
     if search:
-        # Search by patient ID or name
-        search_pattern = {"$regex": search, "$options": "i"}
-        query["$or"] = [
-            {"patient_id": search_pattern},
-            {"first_name": search_pattern},
-            {"last_name": search_pattern}
-        ]
-    
-    # Get total count
-    total = await db.patients.count_documents(query)
-    
-    # Get patients
-    cursor = db.patients.find(query).skip(skip).limit(limit).sort("created_at", -1)
-    patients = await cursor.to_list(length=limit)
+        # Search by patient ID or name through the search index, best match first
+        ranked_ids = await search_patient_ids(db, search, query)
+        total = len(ranked_ids) if include_total != "none" else None
+        page_ids = ranked_ids[skip:skip + limit]
+        page = await db.patients.find(
+            {**query, "patient_id": {"$in": page_ids}}, PATIENT_ROW_PROJECTION
+        ).to_list(length=None)
+        rank = {patient_id: position for position, patient_id in enumerate(page_ids)}
+        patients = sorted(page, key=lambda p: rank[p["patient_id"]])
+        page_cursor = None
+    else:
+        # Get total count
+        scope = query.get("barangay")
+        tags = scope_tags(scope["$in"] if isinstance(scope, dict) else scope)
+        total = await list_total(db, "patients", query, include_total, tags)
+        
+        # Get patients, resuming after the cursor when given
+        page_query = query
+        if cursor:
+            try:
+                page_query = after_cursor(query, "created_at", "patient_id", cursor)
+            except ValueError:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Invalid cursor"
+                )
+            skip = 0
+        patients = await db.patients.find(page_query, PATIENT_ROW_PROJECTION).sort(
+            keyset_sort("created_at", "patient_id")
+        ).skip(skip).limit(limit).to_list(length=limit)
+        page_cursor = next_cursor(patients, limit, "created_at", "patient_id")
 
     # Fetch latest visit per patient for list enrichment
     patient_ids = [p["patient_id"] for p in patients]
-    latest_visit_by_patient = {}
-    if patient_ids:
-        if settings.DB_MODE.lower() == "embedded":
-            visits = await db.visits.find({"patient_id": {"$in": patient_ids}}).to_list(length=100000)
-            for visit in visits:
-                pid = visit.get("patient_id")
-                if not pid:
-                    continue
-                current = latest_visit_by_patient.get(pid)
-                if not current or (visit.get("visit_date") and visit["visit_date"] > current.get("visit_date")):
-                    latest_visit_by_patient[pid] = visit
-        else:
-            latest_pipeline = [
-                {"$match": {"patient_id": {"$in": patient_ids}}},
-                {"$sort": {"visit_date": -1}},
-                {"$group": {"_id": "$patient_id", "latest_visit": {"$first": "$$ROOT"}}}
-            ]
-            latest_visits = await db.visits.aggregate(latest_pipeline).to_list(length=10000)
-            latest_visit_by_patient = {v["_id"]: v["latest_visit"] for v in latest_visits}
+    latest_visit_by_patient = await get_latest_visits(db, patient_ids)
     
     # Remove MongoDB _id and enrich fields
     for patient in patients:
-        latest_visit = latest_visit_by_patient.get(patient["patient_id"])
-        patient["conditions"] = normalize_conditions(patient.get("conditions", []))
-        patient["last_visit_date"] = latest_visit.get("visit_date") if latest_visit else None
-        patient["next_visit_date"] = latest_visit.get("next_visit_date") if latest_visit else None
-        if latest_visit and latest_visit.get("control_status"):
-            patient["control_status"] = latest_visit.get("control_status")
-        else:
-            patient["control_status"] = "N/A" if not patient["conditions"] else "Unknown"
-        vitals = latest_visit.get("vitals", {}) if latest_visit else {}
-        if vitals.get("systolic") and vitals.get("diastolic"):
-            patient["latest_bp"] = f"{vitals.get('systolic')}/{vitals.get('diastolic')}"
-        if vitals.get("glucose"):
-            patient["latest_glucose"] = vitals.get("glucose")
-        if vitals.get("glucose_random") is not None:
-            patient["latest_rbg"] = vitals.get("glucose_random")
-        elif vitals.get("glucose") is not None and (vitals.get("glucose_type") or "").lower() == "random":
-            patient["latest_rbg"] = vitals.get("glucose")
-        if vitals.get("glucose_fasting") is not None:
-            patient["latest_fbg"] = vitals.get("glucose_fasting")
-        elif vitals.get("glucose") is not None and (vitals.get("glucose_type") or "").lower() == "fasting":
-            patient["latest_fbg"] = vitals.get("glucose")
-        if vitals.get("weight") is not None:
-            patient["weight"] = vitals.get("weight")
-        if vitals.get("height") is not None:
-            patient["height"] = vitals.get("height")
-        if vitals.get("bmi") is not None:
-            patient["bmi"] = vitals.get("bmi")
-        if latest_visit and latest_visit.get("flagged_for_follow_up") is not None:
-            patient["flagged_for_follow_up"] = latest_visit.get("flagged_for_follow_up")
-        patient.pop("_id", None)
+        enrich_patient(patient, latest_visit_by_patient.get(patient["patient_id"]))
     
     return {
         "patients": patients,
         "total": total,
         "skip": skip,
-        "limit": limit
+        "limit": limit,
+        "next_cursor": page_cursor
     }
 
+@router.get("/export")
+async def export_patients(
+    barangay: Optional[str] = Query(None),
+    condition: Optional[str] = Query(None, description="HTN, DM, or HTN+DM"),
+    risk_level: Optional[str] = Query(None),
+    search: Optional[str] = Query(None, description="Search by name or patient ID"),
+    format: Literal["ndjson", "csv"] = Query("ndjson"),
+    gzip: bool = Query(False),
+    current_user: dict = Depends(get_current_user),
+    db = Depends(get_database)
+):
+    """
+    Export the patient line list (same scope and filters as list_patients)
+    
+    - Streams NDJSON or CSV from a cursor, optionally gzip-compressed
+    - Each row carries the same latest-visit fields as the list view
+    - Logged in the audit trail with the filters and row count
+    """
+    query = build_patient_list_query(current_user, barangay, condition, risk_level)
+    if search:
+        query["patient_id"] = {"$in": await search_patient_ids(db, search, query)}
+    
+    async def rows():
+        cursor = db.patients.find(query, PATIENT_ROW_PROJECTION).sort(keyset_sort("created_at", "patient_id"))
+        async for patients in batched(cursor, settings.EXPORT_PATIENT_BATCH_SIZE):
+            latest_visit_by_patient = await get_latest_visits(db, [p["patient_id"] for p in patients])
+            for patient in patients:
+                enrich_patient(patient, latest_visit_by_patient.get(patient["patient_id"]))
+                yield patient
+    
+    filters = {"barangay": barangay, "condition": condition, "risk_level": risk_level, "search": search}
+    return await export_response(
+        db, current_user, "patient", rows(), format, PATIENT_EXPORT_COLUMNS, gzip,
+        {key: value for key, value in filters.items() if value is not None}
+    )
+
 @router.get("/{patient_id}")
 async def get_patient(
     patient_id: str,
@@ -357,6 +494,16 @@ async def update_patient(
         )
     
     # Prepare update
+    update_data.pop("identity_hash", None)
+    if any(field in update_data for field in IDENTITY_FIELDS):
+        update_data["identity_hash"] = identity_hash({**patient, **update_data})
+        if update_data["identity_hash"] != patient.get("identity_hash"):
+            duplicate = await db.patients.find_one({"identity_hash": update_data["identity_hash"]})
+            if duplicate and duplicate["patient_id"] != patient_id:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=DUPLICATE_PATIENT_DETAIL
+                )
     update_data["updated_at"] = datetime.utcnow()
     update_data["updated_by"] = current_user["user_id"]
     
@@ -364,10 +511,18 @@ async def update_patient(
     changes = {k: {"old": patient.get(k), "new": v} for k, v in update_data.items() if patient.get(k) != v}
     
     # Update patient
-    await db.patients.update_one(
-        {"patient_id": patient_id},
-        {"$set": update_data}
-    )
+    try:
+        await db.patients.update_one(
+            {"patient_id": patient_id},
+            {"$set": update_data}
+        )
+    except DuplicateKeyError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=DUPLICATE_PATIENT_DETAIL
+        )
+    await move_patient_rollups(db, patient, {**patient, **update_data})
+    invalidate_barangays(patient["barangay"], update_data.get("barangay"))
     
     # Log audit
     await db.audit_logs.insert_one({
@@ -384,6 +539,8 @@ async def update_patient(
     
     # Return updated patient
     updated_patient = await db.patients.find_one({"patient_id": patient_id})
+    snapshot_patient(updated_patient)
+    await record_patient_search(db, updated_patient)
     updated_patient.pop("_id", None)
     
     return updated_patient
@@ -393,11 +550,13 @@ async def get_patient_visits(
     patient_id: str,
     skip: int = Query(0, ge=0),
     limit: int = Query(50, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page (replaces skip)"),
+    include_total: TotalMode = Query("exact", description="exact, estimated (cached per scope) or none"),
     current_user: dict = Depends(get_current_user),
     db = Depends(get_database)
 ):
     """
-    Get visit history for a patient
+    Get visit history for a patient, newest first
     """
     # Check patient exists and access
     patient = await db.patients.find_one({"patient_id": patient_id})
@@ -414,10 +573,21 @@ async def get_patient_visits(
             detail="No access to this patient's data"
         )
     
-    # Get visits
-    total = await db.visits.count_documents({"patient_id": patient_id})
-    cursor = db.visits.find({"patient_id": patient_id}).skip(skip).limit(limit).sort("visit_date", -1)
-    visits = await cursor.to_list(length=limit)
+    # Get visits, resuming after the cursor when given
+    query = {"patient_id": patient_id}
+    total = await list_total(db, "visits", query, include_total, scope_tags(patient["barangay"]))
+    if cursor:
+        try:
+            query = after_cursor(query, "visit_date", "visit_id", cursor)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+        skip = 0
+    visits = await db.visits.find(query).sort(
+        keyset_sort("visit_date", "visit_id")
+    ).skip(skip).limit(limit).to_list(length=limit)
     
     for visit in visits:
         visit.pop("_id", None)
@@ -425,7 +595,8 @@ async def get_patient_visits(
     return {
         "patient_id": patient_id,
         "visits": visits,
-        "total": total
+        "total": total,
+        "next_cursor": next_cursor(visits, limit, "visit_date", "visit_id")
     }
 
 @router.get("/{patient_id}/history")
@@ -4,12 +4,21 @@ Record visits, retrieve visit history, sync offline data
 """
 
 from fastapi import APIRouter, Depends, HTTPException, status, Query, Body
-from typing import List, Optional, Any
+from typing import List, Literal, Optional, Any
 from datetime import datetime, timedelta
 from database import get_database
 from auth import get_current_user, RoleChecker, check_barangay_access
 from models.schemas import Visit, VisitType, DiagnosisType, RiskLevel, ControlStatus, SyncStatus, RoleEnum
 from validation import ClinicalValidator
+from services.analytics_cache import invalidate_barangays
+from services.columnar import snapshot_patient, snapshot_visit
+from services.export import VISIT_EXPORT_COLUMNS, export_response
+from services.latest_visits import record_latest_visit
+from services.list_totals import TotalMode, list_total, scope_tags
+from services.pagination import after_cursor, keyset_sort, next_cursor
+from services.visit_rollups import record_visit_rollup
+from storage.loader import current_loader
+import asyncio
 import uuid
 
 router = APIRouter(prefix="/api/visits", tags=["Visits"])
@@ -289,37 +298,41 @@ async def record_visit(
         "updated_at": now
     }
     
-    # Insert visit
+    # Insert the visit first so a failed insert leaves nothing behind, then
+    # update the patient's latest data, the latest-visit and monthly rollup
+    # projections and log the audit entry concurrently
+    patient_update = {
+        "risk_level": risk_tier,
+        "flagged_for_follow_up": flagged_for_follow_up,
+        "current_medications": visit_data.get("current_medications", patient.get("current_medications", [])),
+        "previous_medications": visit_data.get("previous_medications", patient.get("previous_medications")),
+        "medications_provided": medications_provided if medications_provided is not None else patient.get("medications_provided"),
+        "medications_taken_regularly": medications_taken_regularly if medications_taken_regularly is not None else patient.get("medications_taken_regularly"),
+        "updated_at": now,
+        "updated_by": current_user["user_id"]
+    }
     result = await db.visits.insert_one(visit_doc)
-    
-    # Update patient's latest data
-    await db.patients.update_one(
-        {"patient_id": patient_id},
-        {
-            "$set": {
-                "risk_level": risk_tier,
-                "flagged_for_follow_up": flagged_for_follow_up,
-                "current_medications": visit_data.get("current_medications", patient.get("current_medications", [])),
-                "previous_medications": visit_data.get("previous_medications", patient.get("previous_medications")),
-                "medications_provided": medications_provided if medications_provided is not None else patient.get("medications_provided"),
-                "medications_taken_regularly": medications_taken_regularly if medications_taken_regularly is not None else patient.get("medications_taken_regularly"),
-                "updated_at": now,
-                "updated_by": current_user["user_id"]
-            }
-        }
+    await asyncio.gather(
+        record_latest_visit(db, visit_doc),
+        record_visit_rollup(db, visit_doc, patient),
+        db.patients.update_one(
+            {"patient_id": patient_id},
+            {"$set": patient_update}
+        ),
+        db.audit_logs.insert_one({
+            "log_id": f"AUDIT-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{visit_id}",
+            "action": "create",
+            "resource_type": "visit",
+            "resource_id": visit_id,
+            "user_id": current_user["user_id"],
+            "user_role": current_user["role"],
+            "timestamp": now,
+            "barangay": patient["barangay"]
+        })
     )
-    
-    # Log audit
-    await db.audit_logs.insert_one({
-        "log_id": f"AUDIT-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{visit_id}",
-        "action": "create",
-        "resource_type": "visit",
-        "resource_id": visit_id,
-        "user_id": current_user["user_id"],
-        "user_role": current_user["role"],
-        "timestamp": now,
-        "barangay": patient["barangay"]
-    })
+    invalidate_barangays(patient["barangay"])
+    snapshot_visit(visit_doc)
+    snapshot_patient({**patient, **patient_update})
     
     # Return created visit with warnings
     created_visit = await db.visits.find_one({"_id": result.inserted_id})
@@ -333,21 +346,16 @@ async def record_visit(
         "warnings": warnings if warnings else None
     }
 
-@router.get("")
-async def list_visits(
-    patient_id: Optional[str] = Query(None),
-    barangay: Optional[str] = Query(None),
-    visit_type: Optional[str] = Query(None),
-    start_date: Optional[str] = Query(None),
-    end_date: Optional[str] = Query(None),
-    skip: int = Query(0, ge=0),
-    limit: int = Query(50, ge=1, le=1000),
-    current_user: dict = Depends(get_current_user),
-    db = Depends(get_database)
-):
-    """
-    List visits with filters and pagination
-    """
+async def build_visit_list_query(
+    db,
+    current_user: dict,
+    patient_id: Optional[str],
+    barangay: Optional[str],
+    visit_type: Optional[str],
+    start_date: Optional[str],
+    end_date: Optional[str]
+) -> dict:
+    """Visit filter for list/export: the caller's barangay scope plus the requested filters"""
     # Build query
     query = {}
     
@@ -393,13 +401,55 @@ async def list_visits(
     if end_date:
         query["visit_date"] = query.get("visit_date", {})
         query["visit_date"]["$lte"] = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
+    return query
+
+def visit_scope_tags(current_user: dict, patient_id: Optional[str], barangay: Optional[str]):
+    """Barangays a visit listing covers, for tagging its cached total (None = all)"""
+    if patient_id:
+        return None
+    if current_user["role"] in [RoleEnum.BHW.value, RoleEnum.RHU_NURSE.value]:
+        assigned_barangays = current_user.get("assigned_barangays", [])
+        return scope_tags([barangay] if barangay in assigned_barangays else assigned_barangays)
+    return scope_tags(barangay)
+
+@router.get("")
+async def list_visits(
+    patient_id: Optional[str] = Query(None),
+    barangay: Optional[str] = Query(None),
+    visit_type: Optional[str] = Query(None),
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page (replaces skip)"),
+    include_total: TotalMode = Query("exact", description="exact, estimated (cached per scope) or none"),
+    current_user: dict = Depends(get_current_user),
+    db = Depends(get_database)
+):
+    """
+    List visits with filters and pagination
+    
+    - Newest first; pass next_cursor back as cursor to resume after the last row
+    - include_total=none skips the count; estimated may lag recent writes briefly
+    """
+    query = await build_visit_list_query(db, current_user, patient_id, barangay, visit_type, start_date, end_date)
     
     # Get total count
-    total = await db.visits.count_documents(query)
+    total = await list_total(db, "visits", query, include_total, visit_scope_tags(current_user, patient_id, barangay))
     
-    # Get visits
-    cursor = db.visits.find(query).skip(skip).limit(limit).sort("visit_date", -1)
-    visits = await cursor.to_list(length=limit)
+    # Get visits, resuming after the cursor when given
+    if cursor:
+        try:
+            query = after_cursor(query, "visit_date", "visit_id", cursor)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+        skip = 0
+    visits = await db.visits.find(query).sort(
+        keyset_sort("visit_date", "visit_id")
+    ).skip(skip).limit(limit).to_list(length=limit)
     
     # Remove MongoDB _id
     for visit in visits:
@@ -409,8 +459,39 @@ async def list_visits(
         "visits": visits,
         "total": total,
         "skip": skip,
-        "limit": limit
+        "limit": limit,
+        "next_cursor": next_cursor(visits, limit, "visit_date", "visit_id")
+    }
+
+@router.get("/export")
+async def export_visits(
+    patient_id: Optional[str] = Query(None),
+    barangay: Optional[str] = Query(None),
+    visit_type: Optional[str] = Query(None),
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None),
+    format: Literal["ndjson", "csv"] = Query("ndjson"),
+    gzip: bool = Query(False),
+    current_user: dict = Depends(get_current_user),
+    db = Depends(get_database)
+):
+    """
+    Export the visit line list (same scope and filters as list_visits)
+    
+    - Streams NDJSON or CSV from a cursor, optionally gzip-compressed
+    - Logged in the audit trail with the filters and row count
+    """
+    query = await build_visit_list_query(db, current_user, patient_id, barangay, visit_type, start_date, end_date)
+    cursor = db.visits.find(query, {"_id": 0}).sort(keyset_sort("visit_date", "visit_id"))
+    
+    filters = {
+        "patient_id": patient_id, "barangay": barangay, "visit_type": visit_type,
+        "start_date": start_date, "end_date": end_date
     }
+    return await export_response(
+        db, current_user, "visit", cursor, format, VISIT_EXPORT_COLUMNS, gzip,
+        {key: value for key, value in filters.items() if value is not None}
+    )
 
 @router.get("/{visit_id}")
 async def get_visit(
@@ -463,6 +544,17 @@ async def bulk_sync_visits(
     else:
         visits_list = visits_data or []
 
+    # Issue every visit and patient lookup up front so the request loader
+    # batches them into one query per collection; the loop then hits its
+    # cache. Only embedded and memory modes install a loader.
+    if current_loader() is not None:
+        await asyncio.gather(
+            *(db.visits.find_one({"visit_id": v["visit_id"]}) for v in visits_list if isinstance(v, dict) and v.get("visit_id")),
+            *(db.patients.find_one({"patient_id": v["patient_id"]}) for v in visits_list if isinstance(v, dict) and v.get("patient_id")),
+            return_exceptions=True
+        )
+
+    synced_barangays = set()
     for visit_data in visits_list:
         try:
             # Check if visit already exists (by visit_id or timestamp+patient combination)
@@ -556,6 +648,10 @@ async def bulk_sync_visits(
             
             # Insert visit
             await db.visits.insert_one(visit_data)
+            await record_latest_visit(db, visit_data)
+            await record_visit_rollup(db, visit_data, patient)
+            synced_barangays.add(patient.get("barangay"))
+            snapshot_visit(visit_data)
             
             results["success"].append({
                 "visit_id": visit_data["visit_id"],
@@ -563,18 +659,20 @@ async def bulk_sync_visits(
             })
 
             # Update patient risk level
+            patient_update = {
+                "risk_level": visit_data.get("risk_tier"),
+                "flagged_for_follow_up": visit_data.get("flagged_for_follow_up"),
+                "current_medications": visit_data.get("current_medications", patient.get("current_medications", [])),
+                "previous_medications": visit_data.get("previous_medications", patient.get("previous_medications")),
+                "medications_provided": visit_data.get("medications_provided", patient.get("medications_provided")),
+                "medications_taken_regularly": visit_data.get("medications_taken_regularly", patient.get("medications_taken_regularly")),
+                "updated_at": datetime.utcnow()
+            }
             await db.patients.update_one(
                 {"patient_id": patient_id},
-                {"$set": {
-                    "risk_level": visit_data.get("risk_tier"),
-                    "flagged_for_follow_up": visit_data.get("flagged_for_follow_up"),
-                    "current_medications": visit_data.get("current_medications", patient.get("current_medications", [])),
-                    "previous_medications": visit_data.get("previous_medications", patient.get("previous_medications")),
-                    "medications_provided": visit_data.get("medications_provided", patient.get("medications_provided")),
-                    "medications_taken_regularly": visit_data.get("medications_taken_regularly", patient.get("medications_taken_regularly")),
-                    "updated_at": datetime.utcnow()
-                }}
+                {"$set": patient_update}
             )
+            snapshot_patient({**patient, **patient_update})
             
         except Exception as e:
             results["errors"].append({
@@ -582,4 +680,6 @@ async def bulk_sync_visits(
                 "error": str(e)
             })
     
+    invalidate_barangays(*synced_barangays)
+    
     return results
@@ -14,6 +14,11 @@ import random
 from auth import hash_password
 from config import settings
 from database import connect_to_mongo, close_mongo_connection, get_database
+from services.duplicates import backfill_identity_hashes
+from services.id_allocator import reset_patient_id_counter
+from services.latest_visits import rebuild_latest_visits
+from services.patient_search import rebuild_patient_search
+from services.visit_rollups import rebuild_visit_rollups
 from models.schemas import (
     RoleEnum, SexEnum, RiskLevel, ControlStatus, 
     VisitType, DiagnosisType, SyncStatus, ClusterType
@@ -529,7 +534,12 @@ async def main():
         barangays = await seed_barangays(db)
         users = await seed_users(db, barangays)
         patients = await seed_patients(db, num_patients=750)
+        await backfill_identity_hashes(db)
+        await reset_patient_id_counter(db)
+        await rebuild_patient_search(db)
         visits = await seed_visits(db, patients)
+        await rebuild_latest_visits(db)
+        await rebuild_visit_rollups(db)
         medications = await seed_medication_stock(db)
         
         print("\n" + "="*60)
@@ -0,0 +1,68 @@
+"""
+Medication adherence classification
+Every in-scope patient is read once and classified once from their latest
+visit; the result is counted in each condition group the patient belongs to.
+"""
+
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from services.latest_visits import get_latest_visits
+
+# (category, predicate(latest_visit, recent_cutoff)); evaluated in order and
+# the first match wins. latest_visit is None for patients never visited.
+AdherenceRule = Tuple[str, Callable[[Optional[dict], datetime], bool]]
+
+ADHERENCE_RULES: List[AdherenceRule] = [
+    ("Poor Adherence", lambda visit, cutoff: not visit),
+    ("Poor Adherence", lambda visit, cutoff: bool(visit.get("visit_date")) and visit["visit_date"] < cutoff),
+    ("Good Adherence", lambda visit, cutoff: bool(visit.get("medications_dispensed"))),
+    ("Moderate Adherence", lambda visit, cutoff: True),
+]
+
+# Categories in the order they are reported
+ADHERENCE_CATEGORIES = ["Good Adherence", "Moderate Adherence", "Poor Adherence"]
+
+
+def classify_adherence(latest_visit: Optional[dict], recent_cutoff: datetime,
+                       rules: Sequence[AdherenceRule] = ADHERENCE_RULES) -> Optional[str]:
+    for category, matches in rules:
+        if matches(latest_visit, recent_cutoff):
+            return category
+    return None
+
+
+async def adherence_by_group(db, scope_query: dict, groups: Dict[str, List[str]],
+                             rules: Sequence[AdherenceRule] = ADHERENCE_RULES,
+                             categories: Sequence[str] = ADHERENCE_CATEGORIES,
+                             recent_days: int = 90) -> Dict[str, List[dict]]:
+    """
+    Adherence breakdown per condition group ({group: [conditions]}) for the
+    active patients matching scope_query. A patient counts in every group
+    whose conditions they have.
+    """
+    all_conditions = sorted({condition for conditions in groups.values() for condition in conditions})
+    patient_query = {**scope_query, "is_active": True, "conditions": {"$in": all_conditions}}
+    patients = await db.patients.find(patient_query, {"patient_id": 1, "conditions": 1}).to_list(length=None)
+    latest_by_patient = await get_latest_visits(db, [p["patient_id"] for p in patients])
+
+    recent_cutoff = datetime.utcnow() - timedelta(days=recent_days)
+    group_sets = {name: set(conditions) for name, conditions in groups.items()}
+    buckets = {name: {category: 0 for category in categories} for name in groups}
+    for patient in patients:
+        conditions = patient.get("conditions") or []
+        if isinstance(conditions, str):
+            conditions = [conditions]
+        category = classify_adherence(latest_by_patient.get(patient["patient_id"]), recent_cutoff, rules)
+        for name, group_conditions in group_sets.items():
+            if category in buckets[name] and not group_conditions.isdisjoint(conditions):
+                buckets[name][category] += 1
+
+    result = {}
+    for name, counts in buckets.items():
+        total = sum(counts.values())
+        result[name] = [
+            {"category": category, "count": count, "percent": round(count / total * 100, 1) if total else 0}
+            for category, count in counts.items()
+        ]
+    return result
@@ -0,0 +1,26 @@
+"""
+Result cache for /api/analytics endpoints
+Entries are keyed by endpoint, parameters and the caller's barangay scope,
+and tagged with the barangays they cover. Visit and patient writes
+invalidate the barangays they touch.
+"""
+
+from typing import Optional
+
+from config import settings
+from services.list_totals import invalidate_list_totals
+from services.result_cache import TTLCache
+
+analytics_cache = TTLCache(settings.ANALYTICS_CACHE_TTL_S, settings.ANALYTICS_CACHE_MAX_ENTRIES)
+
+
+def invalidate_barangays(*barangays: Optional[str]):
+    """Drop cached analytics and list totals covering any of these barangays"""
+    names = [name for name in barangays if name]
+    if names:
+        analytics_cache.invalidate(names)
+        invalidate_list_totals(names)
+
+
+def analytics_cache_metrics() -> dict:
+    return analytics_cache.metrics()
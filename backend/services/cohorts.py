@@ -0,0 +1,51 @@
+"""
+Cohort retention matrix
+Patients are bucketed into enrolment windows by created_at in one query, and
+retention for every window is read off each patient's latest visit date
+(patient_latest_visit), so no visit scan is needed.
+"""
+
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from services.latest_visits import get_latest_visits
+
+
+async def cohort_matrix(db, scope_query: dict, windows: List[Tuple[datetime, datetime]],
+                        cutoffs: Dict[str, datetime]) -> List[dict]:
+    """
+    For each [start, end) enrolment window: how many patients were created
+    in it ("enrolled") and, per cutoff, how many of them have visited on or
+    after that cutoff ("retained").
+    """
+    if not windows:
+        return []
+    patient_query = {
+        **scope_query,
+        "created_at": {"$gte": min(start for start, _ in windows), "$lt": max(end for _, end in windows)}
+    }
+    patients = await db.patients.find(patient_query, {"patient_id": 1, "created_at": 1}).to_list(length=None)
+    latest_visits = await get_latest_visits(db, list({p["patient_id"] for p in patients if p.get("patient_id")}))
+
+    cells = [{"enrolled": 0, "patient_ids": set()} for _ in windows]
+    for patient in patients:
+        created_at = patient.get("created_at")
+        if not isinstance(created_at, datetime):
+            continue
+        for cell, (start, end) in zip(cells, windows):
+            if start <= created_at < end:
+                cell["enrolled"] += 1
+                if patient.get("patient_id"):
+                    cell["patient_ids"].add(patient["patient_id"])
+
+    matrix = []
+    for cell in cells:
+        last_visits = [latest_visits[pid].get("visit_date") for pid in cell["patient_ids"] if pid in latest_visits]
+        matrix.append({
+            "enrolled": cell["enrolled"],
+            "retained": {
+                name: sum(1 for visit_date in last_visits if isinstance(visit_date, datetime) and visit_date >= cutoff)
+                for name, cutoff in cutoffs.items()
+            }
+        })
+    return matrix
@@ -0,0 +1,324 @@
+"""
+Columnar analytics snapshot (ANALYTICS_SNAPSHOT=True)
+Patients and visits held as NumPy columns: dates as datetime64, vitals as
+float32 with NaN for missing, and barangay, conditions, occupation, risk
+level and control status as integer codes. The visit write paths append to
+it, so counts and rates are computed with vectorized operations instead of
+reading documents from the database.
+"""
+
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+import numpy as np
+
+_NAT = np.datetime64("NaT", "ms")
+
+# Condition bits
+HTN = 1
+DM = 2  # "Diabetes" / "DM"
+DM_TYPE2 = 4  # "Diabetes Mellitus Type 2"
+ANY_DM = DM | DM_TYPE2
+_CONDITION_BITS = {"Hypertension": HTN, "HTN": HTN, "Diabetes": DM, "DM": DM, "Diabetes Mellitus Type 2": DM_TYPE2}
+
+Scope = Union[None, str, dict]
+
+
+class Categories:
+    """Integer codes for a categorical column; code 0 is None/missing"""
+
+    def __init__(self):
+        self.labels: List[Any] = [None]
+        self._codes: Dict[Any, int] = {None: 0}
+
+    def code(self, value) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.labels)
+            self.labels.append(value)
+        return code
+
+    def lookup(self, value) -> int:
+        """Code of an existing label, or -1"""
+        return self._codes.get(value, -1)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+
+class _Table:
+    """Equally long, growable NumPy columns"""
+
+    def __init__(self, dtypes: Dict[str, Any], capacity: int = 1024):
+        self.size = 0
+        self._fill = {name: (_NAT if np.dtype(dtype).kind == "M" else np.nan if np.dtype(dtype).kind == "f" else 0)
+                      for name, dtype in dtypes.items()}
+        self.columns = {name: np.full(capacity, self._fill[name], dtype=dtype) for name, dtype in dtypes.items()}
+
+    def _reserve(self, size: int):
+        capacity = len(next(iter(self.columns.values())))
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name, column in self.columns.items():
+            grown = np.full(capacity, self._fill[name], dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+
+    def append(self, **values) -> int:
+        row = self.size
+        self._reserve(row + 1)
+        self.size += 1
+        self.set(row, **values)
+        return row
+
+    def set(self, row: int, **values):
+        for name, value in values.items():
+            self.columns[name][row] = value
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name][:self.size]
+
+    def nbytes(self) -> int:
+        return sum(column[:self.size].nbytes for column in self.columns.values())
+
+
+def _date(value) -> np.datetime64:
+    return np.datetime64(value, "ms") if isinstance(value, datetime) else _NAT
+
+
+def _number(value) -> float:
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else np.nan
+
+
+def _condition_bits(conditions) -> int:
+    if isinstance(conditions, str):
+        conditions = [conditions]
+    bits = 0
+    for condition in conditions or []:
+        bits |= _CONDITION_BITS.get(condition, 0)
+    return bits
+
+
+class AnalyticsSnapshot:
+    def __init__(self):
+        self.patient_ids = Categories()
+        self.barangays = Categories()
+        self.occupations = Categories()
+        self.education = Categories()
+        self.risk_levels = Categories()
+        self.control_statuses = Categories()
+        self.diagnoses = Categories()
+        self.visit_types = Categories()
+        # One row per patient document (duplicate patient_ids keep separate rows)
+        self._patient_rows: Dict[str, int] = {}
+        self.patients = _Table({
+            "pid": np.int32, "barangay": np.int32, "active": np.bool_, "conditions": np.uint8,
+            "occupation": np.int32, "education": np.int32, "risk": np.int32,
+            "age": np.float32, "created_at": "datetime64[ms]",
+        })
+        self.visits = _Table({
+            "pid": np.int32, "visit_date": "datetime64[ms]", "next_visit_date": "datetime64[ms]",
+            "systolic": np.float32, "diastolic": np.float32, "glucose": np.float32,
+            "diagnosis": np.int32, "control": np.int32, "visit_type": np.int32,
+        })
+        # Latest visit per patient_id code
+        self.latest = _Table({"visit_date": "datetime64[ms]", "next_visit_date": "datetime64[ms]", "control": np.int32})
+        self.loaded_at: Optional[datetime] = None
+
+    # -- loading and incremental updates --------------------------------
+
+    def upsert_patient(self, patient: dict):
+        key = str(patient.get("_id") or patient.get("patient_id"))
+        values = dict(
+            pid=self._pid(patient.get("patient_id")),
+            barangay=self.barangays.code(patient.get("barangay")),
+            active=patient.get("is_active") is True,
+            conditions=_condition_bits(patient.get("conditions")),
+            occupation=self.occupations.code(patient.get("occupation")),
+            education=self.education.code(patient.get("education")),
+            risk=self.risk_levels.code(patient.get("risk_level")),
+            age=_number(patient.get("age")),
+            created_at=_date(patient.get("created_at")),
+        )
+        row = self._patient_rows.get(key)
+        if row is None:
+            self._patient_rows[key] = self.patients.append(**values)
+        else:
+            self.patients.set(row, **values)
+
+    def add_visit(self, visit: dict, replace_ties: bool = True):
+        """
+        Append a visit and move the patient's latest visit to it if it is
+        at least as recent (ties go to the later write, as in
+        patient_latest_visit)
+        """
+        pid = self._pid(visit.get("patient_id"))
+        vitals = visit.get("vitals") or {}
+        visit_date = _date(visit.get("visit_date"))
+        next_visit_date = _date(visit.get("next_visit_date"))
+        control = self.control_statuses.code(visit.get("control_status"))
+        self.visits.append(
+            pid=pid, visit_date=visit_date, next_visit_date=next_visit_date,
+            systolic=_number(vitals.get("systolic")), diastolic=_number(vitals.get("diastolic")),
+            glucose=_number(vitals.get("glucose")),
+            diagnosis=self.diagnoses.code(visit.get("diagnosis")), control=control,
+            visit_type=self.visit_types.code(visit.get("visit_type")),
+        )
+        if pid == 0:
+            return
+        current = self.latest["visit_date"][pid]
+        if np.isnat(current) or (visit_date >= current if replace_ties else visit_date > current):
+            self.latest.set(pid, visit_date=visit_date, next_visit_date=next_visit_date, control=control)
+
+    def _pid(self, patient_id) -> int:
+        pid = self.patient_ids.code(patient_id)
+        while self.latest.size < len(self.patient_ids):
+            self.latest.append()
+        return pid
+
+    async def load(self, db):
+        async for patient in db.patients.find({}, {
+            "patient_id": 1, "barangay": 1, "is_active": 1, "conditions": 1, "occupation": 1,
+            "education": 1, "risk_level": 1, "age": 1, "created_at": 1
+        }):
+            self.upsert_patient(patient)
+        async for visit in db.visits.find({}, {
+            "patient_id": 1, "visit_date": 1, "next_visit_date": 1, "vitals": 1,
+            "diagnosis": 1, "control_status": 1, "visit_type": 1
+        }):
+            # Ties keep the first visit, as the projection rebuild does
+            self.add_visit(visit, replace_ties=False)
+        self.loaded_at = datetime.utcnow()
+
+    # -- vectorized queries ---------------------------------------------
+
+    def patient_mask(self, scope: Scope = None, active_only: bool = True) -> np.ndarray:
+        """Patient rows in a barangay scope: None, a name, or {"$in": [names]}"""
+        mask = self.patients["active"].copy() if active_only else np.ones(self.patients.size, dtype=bool)
+        if isinstance(scope, str):
+            mask &= self.patients["barangay"] == self.barangays.lookup(scope)
+        elif isinstance(scope, dict):
+            codes = [self.barangays.lookup(name) for name in scope.get("$in", [])]
+            mask &= np.isin(self.patients["barangay"], codes)
+        return mask
+
+    def overview(self, scope: Scope, now: datetime) -> dict:
+        """Counts behind /api/analytics/overview"""
+        rows = self.patient_mask(scope)
+        conditions = self.patients["conditions"][rows]
+        has_htn = (conditions & HTN) != 0
+        has_dm = (conditions & ANY_DM) != 0
+
+        pids = np.unique(self.patients["pid"][rows])
+        pids = pids[pids != 0]
+        visited = pids[~np.isnat(self.latest["visit_date"][pids])]
+        controlled = int(np.count_nonzero(
+            self.latest["control"][visited] == self.control_statuses.lookup("Controlled")
+        ))
+        overdue = int(np.count_nonzero(self.latest["next_visit_date"][visited] < _date(now)))
+
+        in_scope = np.zeros(len(self.patient_ids), dtype=bool)
+        in_scope[pids] = True
+        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        monthly_screenings = int(np.count_nonzero(
+            in_scope[self.visits["pid"]] & (self.visits["visit_date"] >= _date(month_start))
+        ))
+
+        total_patients = int(np.count_nonzero(rows))
+        total_with_visits = len(visited)
+        control_rate = (controlled / total_with_visits * 100) if total_with_visits > 0 else 0
+        data_completeness = (total_with_visits / total_patients * 100) if total_patients > 0 else 0
+        return {
+            "total_patients": total_patients,
+            "active_cases": total_with_visits,
+            "htn_patients": int(np.count_nonzero(has_htn)),
+            "dm_patients": int(np.count_nonzero(has_dm)),
+            "both_conditions": int(np.count_nonzero(has_htn & has_dm)),
+            "control_rate": round(control_rate, 1),
+            "controlled_patients": controlled,
+            "uncontrolled_patients": total_with_visits - controlled,
+            "monthly_screenings": monthly_screenings,
+            "overdue_followups": overdue,
+            "data_completeness": round(data_completeness, 1)
+        }
+
+    def barangay_counts(self, names: Iterable[str]) -> Dict[str, dict]:
+        """Active patient, HTN, DM and high-risk counts per barangay"""
+        active = self.patients["active"]
+        barangay = self.patients["barangay"][active]
+        conditions = self.patients["conditions"][active]
+        risk = self.patients["risk"][active]
+        high_risk_codes = [self.risk_levels.lookup(level) for level in ("High", "Very High")]
+        size = len(self.barangays)
+
+        def per_barangay(mask=None) -> np.ndarray:
+            return np.bincount(barangay if mask is None else barangay[mask], minlength=size)
+
+        total = per_barangay()
+        htn = per_barangay((conditions & HTN) != 0)
+        dm = per_barangay((conditions & ANY_DM) != 0)
+        high_risk = per_barangay(np.isin(risk, high_risk_codes))
+        counts = {}
+        for name in names:
+            code = self.barangays.lookup(name)
+            if code < 0:
+                continue
+            counts[name] = {
+                "total_patients": int(total[code]),
+                "htn_patients": int(htn[code]),
+                "dm_patients": int(dm[code]),
+                "high_risk_patients": int(high_risk[code]),
+            }
+        return counts
+
+    def risk_counts(self, scope: Scope) -> List[dict]:
+        """Active patients per risk level, ordered by level with missing ones first like the $sort"""
+        risk = self.patients["risk"][self.patient_mask(scope)]
+        counts = np.bincount(risk, minlength=len(self.risk_levels))
+        labels = self.risk_levels.labels
+        codes = sorted((code for code, count in enumerate(counts) if count),
+                       key=lambda code: (labels[code] is not None, labels[code] or ""))
+        return [{"risk_level": labels[code] or "Unknown", "count": int(counts[code])} for code in codes]
+
+    def metrics(self) -> dict:
+        patients_bytes = self.patients.nbytes()
+        visits_bytes = self.visits.nbytes()
+        return {
+            "loaded_at": self.loaded_at,
+            "patients": self.patients.size,
+            "visits": self.visits.size,
+            "patient_bytes": patients_bytes,
+            "visit_bytes": visits_bytes,
+            "latest_visit_bytes": self.latest.nbytes(),
+            "bytes_per_visit": round(visits_bytes / self.visits.size, 1) if self.visits.size else 0,
+        }
+
+
+_snapshot: Optional[AnalyticsSnapshot] = None
+
+
+def analytics_snapshot() -> Optional[AnalyticsSnapshot]:
+    """The loaded snapshot, or None when ANALYTICS_SNAPSHOT is off"""
+    return _snapshot
+
+
+async def load_analytics_snapshot(db) -> AnalyticsSnapshot:
+    global _snapshot
+    snapshot = AnalyticsSnapshot()
+    await snapshot.load(db)
+    _snapshot = snapshot
+    return snapshot
+
+
+def snapshot_visit(visit: dict):
+    """Add a newly written visit to the snapshot, if one is loaded"""
+    if _snapshot is not None:
+        _snapshot.add_visit(visit)
+
+
+def snapshot_patient(patient: dict):
+    """Insert or refresh a patient in the snapshot, if one is loaded"""
+    if _snapshot is not None:
+        _snapshot.upsert_patient(patient)
@@ -0,0 +1,312 @@
+"""
+Dashboard distributions computed in one pass per collection
+Patients, latest visits and visits are each walked once, filling every
+facet as they go; patients are looked up by patient_id through a dict.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from models.schemas import ControlStatus
+
+AGE_GROUPS = [
+    ("18-29", 18, 29),
+    ("30-39", 30, 39),
+    ("40-49", 40, 49),
+    ("50-59", 50, 59),
+    ("60-69", 60, 69),
+    ("70+", 70, 200),
+]
+
+BMI_CATEGORIES = [
+    "Underweight (<18.5)",
+    "Normal (18.5-22.9)",
+    "Overweight (23-24.9)",
+    "Obese I (25-29.9)",
+    "Obese II (≥30)"
+]
+
+RISK_DESCRIPTIONS = {
+    "Low": "Stage 1, no other risk factors",
+    "Moderate": "Stage 1-2 with 1-2 risk factors",
+    "High": "Stage 2 or multiple risk factors",
+    "Very High": "Stage 3 or complications",
+    "Unknown": "Insufficient data"
+}
+
+# Visit fields the distributions read
+VISIT_FIELDS = {
+    "patient_id": 1,
+    "visit_date": 1,
+    "diagnosis": 1,
+    "vitals": 1,
+    "medications_dispensed": 1
+}
+
+
+def pct(value: int, total: int) -> float:
+    return round((value / total * 100), 1) if total > 0 else 0
+
+
+def age_group(age) -> Optional[str]:
+    if age is None:
+        return None
+    for label, min_age, max_age in AGE_GROUPS:
+        if min_age <= age <= max_age:
+            return label
+    return None
+
+
+def bmi_category(value: float) -> str:
+    if value < 18.5:
+        return "Underweight (<18.5)"
+    if value < 23:
+        return "Normal (18.5-22.9)"
+    if value < 25:
+        return "Overweight (23-24.9)"
+    if value < 30:
+        return "Obese I (25-29.9)"
+    return "Obese II (≥30)"
+
+
+def visit_bmi(vitals: dict) -> Optional[float]:
+    bmi = vitals.get("bmi")
+    if bmi is None and vitals.get("weight") and vitals.get("height"):
+        bmi = round(vitals["weight"] / ((vitals["height"] / 100) ** 2), 1)
+    return bmi
+
+
+def bp_category(systolic, diastolic) -> str:
+    if systolic < 120 and diastolic < 80:
+        return "Normal"
+    if 120 <= systolic < 130 and diastolic < 80:
+        return "Elevated"
+    if 130 <= systolic < 140 or 80 <= diastolic < 90:
+        return "Stage1"
+    return "Stage2"
+
+
+def _glucose_bucket(glucose, fasting: bool) -> int:
+    bounds = (100, 125, 180, 250) if fasting else (140, 199, 250, 350)
+    if glucose < bounds[0]:
+        return 0
+    for index, bound in enumerate(bounds[1:], start=1):
+        if glucose <= bound:
+            return index
+    return 4
+
+
+class _GroupCounts:
+    __slots__ = ("total", "dm", "htn")
+
+    def __init__(self):
+        self.total = 0
+        self.dm = 0
+        self.htn = 0
+
+
+def build_distributions(patients: List[dict], latest_visits: Dict[str, dict],
+                        visits: Iterable[dict], months: int,
+                        now: Optional[datetime] = None) -> dict:
+    """Every dashboard distribution for the given patients and their visits"""
+    total_patients = len(patients) or 1
+
+    # Patients: demographics, disease correlations and risk strata
+    patient_by_id: Dict[str, dict] = {}
+    occupations: Dict[str, _GroupCounts] = defaultdict(_GroupCounts)
+    education_counts: Dict[str, int] = defaultdict(int)
+    age_groups: Dict[str, _GroupCounts] = {label: _GroupCounts() for label, _, _ in AGE_GROUPS}
+    htn_risk: Dict[str, int] = defaultdict(int)
+    dm_risk: Dict[str, int] = defaultdict(int)
+    is_htn: Dict[str, bool] = {}
+    for patient in patients:
+        patient_id = patient.get("patient_id")
+        conditions = patient.get("conditions") or []
+        has_htn = "HTN" in conditions or "Hypertension" in conditions
+        # Prevalence counts "DM"/"Diabetes"; control rates and strata also
+        # count "Diabetes Mellitus Type 2"
+        has_dm = "DM" in conditions or "Diabetes" in conditions
+        has_any_dm = has_dm or "Diabetes Mellitus Type 2" in conditions
+        if patient_id is not None and patient_id not in patient_by_id:
+            patient_by_id[patient_id] = patient
+            is_htn[patient_id] = has_htn
+
+        occupation = occupations[patient.get("occupation") or "Unknown"]
+        occupation.total += 1
+        occupation.dm += has_dm
+        occupation.htn += has_htn
+        education_counts[patient.get("education") or "Unknown"] += 1
+
+        label = age_group(patient.get("age"))
+        if label is not None:
+            group = age_groups[label]
+            group.total += 1
+            group.dm += has_dm
+            group.htn += has_htn
+
+        if has_htn:
+            htn_risk[patient.get("risk_level") or "Unknown"] += 1
+        if has_any_dm:
+            dm_risk[patient.get("risk_level") or "Unknown"] += 1
+
+    # Latest visits: glucose, BMI, control rates and complications
+    fbg_counts = [0] * 5
+    rbg_counts = [0] * 5
+    bmi_counts: Dict[str, int] = defaultdict(int)
+    bmi_counts_htn: Dict[str, int] = defaultdict(int)
+    bmi_sum = 0.0
+    htn_controlled = htn_total = dm_controlled = dm_total = 0
+    complication_counts: Dict[str, int] = defaultdict(int)
+    for patient_id, visit in latest_visits.items():
+        vitals = visit.get("vitals", {})
+        glucose = vitals.get("glucose")
+        if glucose is not None:
+            fasting = "fast" in (vitals.get("glucose_type") or "").lower()
+            (fbg_counts if fasting else rbg_counts)[_glucose_bucket(glucose, fasting)] += 1
+
+        bmi = visit_bmi(vitals)
+        if bmi is not None:
+            category = bmi_category(bmi)
+            bmi_counts[category] += 1
+            bmi_sum += bmi
+            if is_htn.get(patient_id):
+                bmi_counts_htn[category] += 1
+
+        patient = patient_by_id.get(patient_id)
+        if patient is not None:
+            conditions = patient.get("conditions") or []
+            controlled = visit.get("control_status") == ControlStatus.CONTROLLED.value
+            if "HTN" in conditions or "Hypertension" in conditions:
+                htn_total += 1
+                htn_controlled += controlled
+            if "DM" in conditions or "Diabetes" in conditions or "Diabetes Mellitus Type 2" in conditions:
+                dm_total += 1
+                dm_controlled += controlled
+
+        complications = visit.get("complications_noted")
+        if not complications:
+            complication_counts["None"] += 1
+        else:
+            for comp in [c.strip() for c in str(complications).split(",") if c.strip()]:
+                complication_counts[comp] += 1
+
+    # Visits: monthly screenings, BP categories and medications. Buckets are
+    # keyed by month name, as the charts label them
+    now = now or datetime.utcnow()
+    month_buckets = {}
+    bp_buckets = {}
+    for i in range(months - 1, -1, -1):
+        month_name = (now.replace(day=1) - timedelta(days=i * 30)).strftime("%b")
+        month_buckets[month_name] = {"month": month_name, "screenings": 0, "diagnoses": 0}
+        bp_buckets[month_name] = {"month": month_name, "Normal": 0, "Elevated": 0, "Stage1": 0, "Stage2": 0}
+    medication_counts: Dict[str, int] = defaultdict(int)
+    medication_patients: Dict[str, set] = defaultdict(set)
+    for visit in visits:
+        visit_date = visit.get("visit_date")
+        if visit_date:
+            month_name = visit_date.strftime("%b")
+            bucket = month_buckets.get(month_name)
+            if bucket is not None:
+                bucket["screenings"] += 1
+                if visit.get("diagnosis"):
+                    bucket["diagnoses"] += 1
+                vitals = visit.get("vitals", {})
+                systolic = vitals.get("systolic")
+                diastolic = vitals.get("diastolic")
+                if systolic is not None and diastolic is not None:
+                    bp_buckets[month_name][bp_category(systolic, diastolic)] += 1
+        for med in visit.get("medications_dispensed", []):
+            name = med.get("name") or "Unknown"
+            medication_counts[name] += med.get("quantity") or 1
+            if visit.get("patient_id"):
+                medication_patients[name].add(visit.get("patient_id"))
+
+    def bmi_distribution(counts: dict, total: int) -> list:
+        return [
+            {"category": label, "count": counts.get(label, 0), "percent": pct(counts.get(label, 0), total), "color": "#4D6186"}
+            for label in BMI_CATEGORIES
+        ]
+
+    def risk_stratification(counts: dict) -> list:
+        total = sum(counts.values())
+        return [
+            {"risk": level, "count": count, "percent": pct(count, total), "description": RISK_DESCRIPTIONS.get(level, "")}
+            for level, count in counts.items()
+        ]
+
+    by_occupation = sorted(occupations.items(), key=lambda x: x[1].total, reverse=True)
+    bmi_total = sum(bmi_counts.values()) or 1
+    total_comp = sum(complication_counts.values()) or 1
+
+    return {
+        "monthly_screenings": list(month_buckets.values()),
+        "fbg_distribution": [
+            {"range": label, "count": count, "status": ""}
+            for label, count in zip(["<100", "100-125", "126-180", "181-250", ">250"], fbg_counts)
+        ],
+        "rbg_distribution": [
+            {"range": label, "count": count, "status": ""}
+            for label, count in zip(["<140", "140-199", "200-250", "251-350", ">350"], rbg_counts)
+        ],
+        "bp_categories": list(bp_buckets.values()),
+        "occupation_distribution": [
+            {"occupation": occ, "count": group.total, "percent": pct(group.total, total_patients)}
+            for occ, group in by_occupation
+        ],
+        "education_distribution": [
+            {"level": level, "count": count, "percent": pct(count, total_patients)}
+            for level, count in sorted(education_counts.items(), key=lambda x: x[1], reverse=True)
+        ],
+        "age_distribution": [
+            {"ageGroup": label, "count": group.total, "percent": pct(group.total, total_patients)}
+            for label, group in age_groups.items()
+        ],
+        "age_group_disease_correlation": [
+            {
+                "ageGroup": label,
+                "dmPrevalence": pct(group.dm, group.total),
+                "htnPrevalence": pct(group.htn, group.total),
+                "dmCount": group.dm,
+                "htnCount": group.htn
+            }
+            for label, group in age_groups.items()
+        ],
+        "occupation_disease_correlation": [
+            {
+                "occupation": occ,
+                "total": group.total,
+                "dmCount": group.dm,
+                "htnCount": group.htn,
+                "dmPrevalence": pct(group.dm, group.total),
+                "htnPrevalence": pct(group.htn, group.total),
+                "notes": "Derived from registry"
+            }
+            for occ, group in by_occupation
+        ],
+        "bmi_distribution": bmi_distribution(bmi_counts, len(latest_visits)),
+        "bmi_distribution_htn": bmi_distribution(bmi_counts_htn, sum(bmi_counts_htn.values())),
+        "htn_complications": [
+            {"complication": comp, "count": count, "percent": pct(count, total_comp)}
+            for comp, count in sorted(complication_counts.items(), key=lambda x: x[1], reverse=True)
+        ],
+        "htn_risk_stratification": risk_stratification(htn_risk),
+        "dm_risk_stratification": risk_stratification(dm_risk),
+        "medication_distribution": [
+            {
+                "medication": name,
+                "distributed": medication_counts[name],
+                "patients": len(medication_patients[name]),
+                "percent": pct(len(medication_patients[name]), total_patients)
+            }
+            for name in sorted(medication_counts.keys())
+        ],
+        "control_rates": {
+            "htn": {"controlled": htn_controlled, "total": htn_total, "rate": pct(htn_controlled, htn_total)},
+            "dm": {"controlled": dm_controlled, "total": dm_total, "rate": pct(dm_controlled, dm_total)}
+        },
+        "bmi_summary": {
+            "obese_percent": pct(bmi_counts.get("Obese I (25-29.9)", 0) + bmi_counts.get("Obese II (≥30)", 0), bmi_total),
+            "average": round(bmi_sum / bmi_total, 1)
+        }
+    }
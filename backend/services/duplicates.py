@@ -0,0 +1,252 @@
+"""
+Patient duplicate detection
+- identity_hash: digest of the normalized first name, last name, date of
+  birth and barangay, stored on each patient under a unique index so the
+  registration check is a single index lookup
+- find_duplicate_candidates: batch job that blocks patients by a phonetic
+  surname key and birth year, scores every pair within a block and writes
+  likely duplicates to patient_duplicate_candidates for review
+"""
+
+import hashlib
+import itertools
+import re
+from collections import defaultdict
+from datetime import datetime
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+from config import settings
+from services.patient_search import normalize
+
+COLLECTION = "patient_duplicate_candidates"
+
+IDENTITY_FIELDS = ("first_name", "last_name", "date_of_birth", "barangay")
+
+# Surname particles written joined or apart ("De la Cruz", "Dela Cruz", "Delacruz")
+SURNAME_PARTICLES = {"de", "del", "dela", "la", "las", "los", "delos", "san", "sta", "santa", "sto", "santo"}
+
+# Spelling variants common in Filipino and Hispanic Filipino names, applied
+# before coding: Ph/F (Felipe/Phelipe), Qu/K and hard C/K (Quezon/Kison),
+# V/B (Vicente/Bicente), Z/S (Gonzales/Gonsales), J/H (Jose/Hose),
+# Ch/Ts, Ll/Ly/Y, initial Y/I (Ybanez/Ibanez) and the e/i and o/u vowel
+# interchange
+_REWRITES = [
+    (re.compile(r"^y(?=[^aeiou])"), "i"),
+    (re.compile(r"ph"), "f"),
+    (re.compile(r"ck"), "k"),
+    (re.compile(r"ch"), "ts"),
+    (re.compile(r"qu"), "k"),
+    (re.compile(r"c(?=[aou]|$)"), "k"),
+    (re.compile(r"gu(?=[ei])"), "g"),
+    (re.compile(r"ll"), "y"),
+    (re.compile(r"ly"), "y"),
+    (re.compile(r"v"), "b"),
+    (re.compile(r"z"), "s"),
+    (re.compile(r"j"), "h"),
+    (re.compile(r"c"), "s"),
+    (re.compile(r"e"), "i"),
+    (re.compile(r"o"), "u"),
+]
+
+_SOUNDEX_CODES = {
+    **dict.fromkeys("bfpv", "1"), **dict.fromkeys("cgjkqsxz", "2"), **dict.fromkeys("dt", "3"),
+    "l": "4", **dict.fromkeys("mn", "5"), "r": "6",
+}
+
+_DOB_SLASHED = re.compile(r"^(\d{1,2})[/-](\d{1,2})[/-](\d{4})$")
+_DOB_ISO = re.compile(r"^(\d{4})-(\d{2})-(\d{2})")
+_YEAR = re.compile(r"(?:19|20)\d{2}")
+
+SCORE_WEIGHTS = {"last_name": 0.35, "first_name": 0.3, "date_of_birth": 0.2, "barangay": 0.1, "sex": 0.05}
+
+
+def _name_key(name: Optional[str]) -> str:
+    return " ".join(normalize(name).split())
+
+
+def normalize_dob(value) -> str:
+    """Date of birth as YYYY-MM-DD where it can be read (MM/DD/YYYY or ISO), else normalized text"""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d")
+    text = normalize(value)
+    match = _DOB_ISO.match(text)
+    if match:
+        return "-".join(match.groups())
+    match = _DOB_SLASHED.match(text)
+    if match:
+        month, day, year = match.groups()
+        return f"{year}-{int(month):02d}-{int(day):02d}"
+    return text
+
+
+def birth_year(value) -> Optional[str]:
+    match = _YEAR.search(normalize_dob(value))
+    return match.group(0) if match else None
+
+
+def identity_hash(patient: dict) -> str:
+    parts = [
+        _name_key(patient.get("first_name")),
+        _name_key(patient.get("last_name")),
+        normalize_dob(patient.get("date_of_birth")),
+        _name_key(patient.get("barangay")),
+    ]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def phonetic_key(name: Optional[str]) -> str:
+    """
+    Soundex of a name after folding Filipino spelling variants and joining
+    surname particles, so "Dela Cruz" / "de la Krus" or "Vicente" /
+    "Bicente" share a key
+    """
+    letters = re.sub(r"[^a-z ]+", " ", normalize(name))
+    words = letters.split()
+    # Keep the surname proper, joined with any particles before it
+    while len(words) > 1 and words[0] in SURNAME_PARTICLES:
+        words = [words[0] + words[1]] + words[2:]
+    word = "".join(words)
+    if not word:
+        return ""
+    for pattern, replacement in _REWRITES:
+        word = pattern.sub(replacement, word)
+    # Leading H (including folded J) is silent
+    if len(word) > 1 and word[0] == "h":
+        word = word[1:]
+
+    code = word[0].upper()
+    previous = _SOUNDEX_CODES.get(word[0], "")
+    for letter in word[1:]:
+        digit = _SOUNDEX_CODES.get(letter, "")
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        if letter not in "hw":
+            previous = digit
+    return code.ljust(4, "0")
+
+
+def _similarity(a: str, b: str) -> float:
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def score_pair(a: dict, b: dict) -> Tuple[float, Dict[str, float]]:
+    """Weighted similarity of two patients (0-1) and the per-field scores"""
+    first_a, first_b = _name_key(a.get("first_name")), _name_key(b.get("first_name"))
+    first = _similarity(first_a, first_b)
+    if phonetic_key(first_a) and phonetic_key(first_a) == phonetic_key(first_b):
+        first = max(first, 0.9)
+
+    dob_a, dob_b = normalize_dob(a.get("date_of_birth")), normalize_dob(b.get("date_of_birth"))
+    if dob_a and dob_a == dob_b:
+        dob = 1.0
+    elif len(dob_a) == len(dob_b) == 10 and dob_a[:4] == dob_b[:4] and sorted(dob_a[5:].split("-")) == sorted(dob_b[5:].split("-")):
+        # Day and month swapped (DD/MM entered as MM/DD)
+        dob = 0.8
+    else:
+        dob = 0.5 if birth_year(dob_a) == birth_year(dob_b) else 0.0
+
+    fields = {
+        "last_name": _similarity(_name_key(a.get("last_name")), _name_key(b.get("last_name"))),
+        "first_name": first,
+        "date_of_birth": dob,
+        "barangay": 1.0 if _name_key(a.get("barangay")) == _name_key(b.get("barangay")) else 0.0,
+        "sex": 1.0 if normalize(a.get("sex")) == normalize(b.get("sex")) else 0.0,
+    }
+    score = sum(SCORE_WEIGHTS[field] * value for field, value in fields.items())
+    return round(score, 3), {field: round(value, 3) for field, value in fields.items()}
+
+
+def block_key(patient: dict) -> Optional[Tuple[str, str]]:
+    surname = phonetic_key(patient.get("last_name"))
+    year = birth_year(patient.get("date_of_birth"))
+    if not surname or not year:
+        return None
+    return surname, year
+
+
+async def _record_pair(collection, a: dict, b: dict, score: float, field_scores: Dict[str, float],
+                       key: Optional[Tuple[str, str]], now: datetime):
+    """Upsert a candidate pair, keeping the review status of an existing one"""
+    first, second = sorted([a["patient_id"], b["patient_id"]])
+    pair_id = f"{first}|{second}"
+    doc = {
+        "pair_id": pair_id,
+        "patient_ids": [first, second],
+        "score": score,
+        "field_scores": field_scores,
+        "block_key": "-".join(key) if key else None,
+        "detected_at": now
+    }
+    result = await collection.update_one({"pair_id": pair_id}, {"$set": doc})
+    if not result.matched_count:
+        try:
+            await collection.insert_one({**doc, "status": "pending", "reviewed_by": None, "reviewed_at": None})
+        except DuplicateKeyError:
+            await collection.update_one({"pair_id": pair_id}, {"$set": doc})
+
+
+async def backfill_identity_hashes(db) -> Dict[str, int]:
+    """
+    Set identity_hash on patients registered before it existed. A patient
+    whose hash is already held by another is an exact duplicate: it stays
+    unhashed and the pair is recorded as a duplicate candidate for review.
+    """
+    fields = {field: 1 for field in ("patient_id", *IDENTITY_FIELDS, "sex")}
+    patients = await db.patients.find({"identity_hash": {"$exists": False}}, fields).to_list(length=None)
+    hashed = collisions = 0
+    now = datetime.utcnow()
+    for patient in patients:
+        digest = identity_hash(patient)
+        try:
+            await db.patients.update_one({"_id": patient["_id"]}, {"$set": {"identity_hash": digest}})
+            hashed += 1
+        except DuplicateKeyError:
+            collisions += 1
+            holder = await db.patients.find_one({"identity_hash": digest}, fields)
+            if holder and holder.get("patient_id") and patient.get("patient_id") \
+                    and holder["patient_id"] != patient["patient_id"]:
+                score, field_scores = score_pair(patient, holder)
+                await _record_pair(db[COLLECTION], patient, holder, score, field_scores, block_key(patient), now)
+    return {"hashed": hashed, "collisions": collisions}
+
+
+async def find_duplicate_candidates(db, min_score: Optional[float] = None) -> Dict[str, int]:
+    """
+    Score every pair of active patients that share a block (phonetic surname
+    key and birth year) and record pairs scoring at least min_score.
+    Re-running refreshes scores but keeps review decisions.
+    """
+    if min_score is None:
+        min_score = settings.DUPLICATE_MIN_SCORE
+    fields = {field: 1 for field in ("patient_id", *IDENTITY_FIELDS, "sex")}
+    blocks: Dict[Tuple[str, str], List[dict]] = defaultdict(list)
+    scanned = 0
+    async for patient in db.patients.find({"is_active": True}, fields):
+        scanned += 1
+        key = block_key(patient)
+        if key is not None and patient.get("patient_id"):
+            blocks[key].append(patient)
+
+    now = datetime.utcnow()
+    compared = recorded = 0
+    collection = db[COLLECTION]
+    for key, members in blocks.items():
+        for a, b in itertools.combinations(members, 2):
+            if a["patient_id"] == b["patient_id"]:
+                continue
+            compared += 1
+            score, field_scores = score_pair(a, b)
+            if score < min_score:
+                continue
+            await _record_pair(collection, a, b, score, field_scores, key, now)
+            recorded += 1
+    return {"patients": scanned, "blocks": len(blocks), "pairs_compared": compared, "pairs_recorded": recorded}
@@ -0,0 +1,164 @@
+"""
+Streaming line-list exports
+Documents are encoded as NDJSON or CSV one at a time straight off a database
+cursor and flushed in fixed-size chunks (optionally gzip-compressed), so
+memory stays constant however many rows are exported.
+"""
+
+import csv
+import io
+import json
+import uuid
+import zlib
+from datetime import date, datetime
+from typing import Any, AsyncIterable, AsyncIterator, List, Sequence
+
+from fastapi.responses import StreamingResponse
+
+from config import settings
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+VISIT_EXPORT_COLUMNS = [
+    "visit_id", "patient_id", "visit_type", "visit_date",
+    "vitals.systolic", "vitals.diastolic", "vitals.glucose", "vitals.glucose_type",
+    "vitals.glucose_random", "vitals.glucose_fasting", "vitals.weight", "vitals.height", "vitals.bmi",
+    "diagnosis", "risk_tier", "control_status", "flagged_for_follow_up",
+    "current_medications", "medications_dispensed", "medications_provided", "medications_taken_regularly",
+    "treatment", "complications_noted", "next_visit_date", "next_visit_reason",
+    "recorded_by", "recorded_by_role", "sync_status", "created_at", "updated_at",
+]
+
+PATIENT_EXPORT_COLUMNS = [
+    "patient_id", "first_name", "middle_name", "last_name", "date_of_birth", "age", "sex",
+    "barangay", "purok", "address", "contact", "occupation", "education", "marital_status",
+    "conditions", "risk_level", "current_medications", "medications_provided", "medications_taken_regularly",
+    "flagged_for_follow_up", "last_visit_date", "next_visit_date", "control_status",
+    "latest_bp", "latest_rbg", "latest_fbg", "weight", "height", "bmi",
+    "created_at", "updated_at",
+]
+
+
+def _json_default(value: Any):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _lookup(doc: dict, path: str) -> Any:
+    value: Any = doc
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _csv_cell(value: Any) -> Any:
+    if value is None:
+        return ""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, list):
+        # Medication lists are exported by name, other lists as-is
+        return "; ".join(
+            str(item.get("name") or json.dumps(item, default=_json_default)) if isinstance(item, dict) else str(item)
+            for item in value
+        )
+    if isinstance(value, dict):
+        return json.dumps(value, default=_json_default)
+    return value
+
+
+async def batched(source: AsyncIterable[Any], size: int) -> AsyncIterator[List[Any]]:
+    """Group an async iterator into lists of at most size items"""
+    batch = []
+    async for item in source:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def encode_rows(rows: AsyncIterable[dict], export_format: str,
+                      columns: Sequence[str], compress: bool = False) -> AsyncIterator[bytes]:
+    """
+    Encode rows as NDJSON or CSV (with a header row of columns), yielding
+    chunks of about EXPORT_CHUNK_BYTES.
+    """
+    compressor = zlib.compressobj(settings.EXPORT_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == "csv" else None
+    if writer:
+        writer.writerow(columns)
+
+    def drain() -> bytes:
+        data = buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    async for row in rows:
+        if writer:
+            writer.writerow([_csv_cell(_lookup(row, column)) for column in columns])
+        else:
+            buffer.write(json.dumps(row, default=_json_default))
+            buffer.write("\n")
+        if buffer.tell() >= settings.EXPORT_CHUNK_BYTES:
+            chunk = drain()
+            if chunk:
+                yield chunk
+
+    chunk = drain()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+
+async def export_response(db, current_user: dict, resource_type: str, rows: AsyncIterable[dict],
+                          export_format: str, columns: Sequence[str], compress: bool,
+                          filters: dict) -> StreamingResponse:
+    """
+    Stream rows as a file download. The audit entry is written before any
+    data is sent and completed with the row count when the download finishes.
+    """
+    started_at = datetime.utcnow()
+    log_id = f"AUDIT-{started_at.strftime('%Y%m%d%H%M%S')}-{str(uuid.uuid4())[:8]}"
+    details = {"format": export_format, "gzip": compress, "filters": filters, "completed": False}
+    exported = {"rows": 0}
+
+    async def counted() -> AsyncIterator[dict]:
+        async for row in rows:
+            exported["rows"] += 1
+            yield row
+
+    await db.audit_logs.insert_one({
+        "log_id": log_id,
+        "action": "export",
+        "resource_type": resource_type,
+        "resource_id": None,
+        "user_id": current_user["user_id"],
+        "user_role": current_user["role"],
+        "timestamp": started_at,
+        "details": details
+    })
+
+    async def body() -> AsyncIterator[bytes]:
+        async for chunk in encode_rows(counted(), export_format, columns, compress):
+            yield chunk
+        await db.audit_logs.update_one({"log_id": log_id}, {"$set": {
+            "details": {**details, "completed": True, "row_count": exported["rows"], "completed_at": datetime.utcnow()}
+        }})
+
+    filename = f"{resource_type}s-{started_at.strftime('%Y%m%d%H%M%S')}.{export_format}" + (".gz" if compress else "")
+    return StreamingResponse(
+        body(),
+        media_type="application/gzip" if compress else EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
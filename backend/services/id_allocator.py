@@ -0,0 +1,120 @@
+"""
+Counter-based ID allocation
+Each counter is one document in the counters collection holding the last
+number handed out. In mongo mode a block is claimed with an atomic
+find_one_and_update $inc; in the in-process modes the counter is bumped
+under a lock in memory and persisted before the IDs are returned. Either
+way an allocation costs the same however large the registry is.
+"""
+
+import asyncio
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from config import settings
+
+COLLECTION = "counters"
+PATIENT_ID_COUNTER = "patient_id"
+PATIENT_ID_PREFIX = "JAG-"
+
+_lock = threading.Lock()
+_load_lock = asyncio.Lock()
+# (id(db), counter) -> last number allocated by this process
+_allocated: Dict[Tuple[int, str], int] = {}
+
+
+def format_patient_id(number: int) -> str:
+    return f"{PATIENT_ID_PREFIX}{number:06d}"
+
+
+def parse_patient_id(patient_id: Optional[str]) -> Optional[int]:
+    """Sequence number of a JAG-XXXXXX patient ID, or None for other IDs"""
+    if not isinstance(patient_id, str) or not patient_id.startswith(PATIENT_ID_PREFIX):
+        return None
+    suffix = patient_id[len(PATIENT_ID_PREFIX):]
+    return int(suffix) if suffix.isdigit() else None
+
+
+async def _highest_patient_number(db) -> int:
+    highest = 0
+    async for patient in db.patients.find({}, {"patient_id": 1}):
+        number = parse_patient_id(patient.get("patient_id"))
+        if number is not None and number > highest:
+            highest = number
+    return highest
+
+
+async def _counter_value(db, name: str) -> int:
+    """Current counter value, creating the counter from existing patients when missing"""
+    doc = await db[COLLECTION].find_one({"name": name})
+    if doc is not None:
+        return doc["value"]
+    value = await _highest_patient_number(db) if name == PATIENT_ID_COUNTER else 0
+    try:
+        await db[COLLECTION].insert_one({"name": name, "value": value})
+    except DuplicateKeyError:
+        # Another process created it first (unique index)
+        doc = await db[COLLECTION].find_one({"name": name})
+        return doc["value"]
+    return value
+
+
+async def allocate(db, name: str, count: int = 1) -> int:
+    """Claim count consecutive numbers from a counter; returns the first"""
+    if count < 1:
+        raise ValueError("count must be at least 1")
+
+    if not settings.in_process_db:
+        doc = await db[COLLECTION].find_one_and_update(
+            {"name": name}, {"$inc": {"value": count}}, return_document=ReturnDocument.AFTER
+        )
+        if doc is None:
+            await _counter_value(db, name)
+            doc = await db[COLLECTION].find_one_and_update(
+                {"name": name}, {"$inc": {"value": count}}, return_document=ReturnDocument.AFTER
+            )
+        return doc["value"] - count + 1
+
+    key = (id(db), name)
+    if key not in _allocated:
+        # Only one coroutine may load the counter, or a second load could
+        # overwrite numbers already handed out
+        async with _load_lock:
+            if key not in _allocated:
+                value = await _counter_value(db, name)
+                with _lock:
+                    _allocated[key] = value
+    with _lock:
+        first = _allocated[key] + 1
+        _allocated[key] += count
+    last = first + count - 1
+    # Persist before handing the numbers out; the $lt guard keeps the stored
+    # value monotonic when concurrent allocations finish out of order
+    await db[COLLECTION].update_one({"name": name, "value": {"$lt": last}}, {"$set": {"value": last}})
+    return first
+
+
+async def allocate_patient_ids(db, count: int = 1) -> List[str]:
+    first = await allocate(db, PATIENT_ID_COUNTER, count)
+    return [format_patient_id(number) for number in range(first, first + count)]
+
+
+async def ensure_patient_id_counter(db) -> Optional[int]:
+    """Create the patient ID counter from existing patients when it is missing"""
+    if await db[COLLECTION].find_one({"name": PATIENT_ID_COUNTER}) is not None:
+        return None
+    return await _counter_value(db, PATIENT_ID_COUNTER)
+
+
+async def reset_patient_id_counter(db) -> int:
+    """Point the patient ID counter at the highest existing patient ID"""
+    value = await _highest_patient_number(db)
+    with _lock:
+        for key in [key for key in _allocated if key[1] == PATIENT_ID_COUNTER]:
+            del _allocated[key]
+    await db[COLLECTION].delete_many({"name": PATIENT_ID_COUNTER})
+    await db[COLLECTION].insert_one({"name": PATIENT_ID_COUNTER, "value": value})
+    return value
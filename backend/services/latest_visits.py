@@ -0,0 +1,80 @@
+"""
+patient_latest_visit projection
+One document per patient holding a copy of their most recent visit. The
+visit write paths keep it current; rebuild_latest_visits backfills it from
+the visits collection.
+"""
+
+from datetime import datetime
+from typing import Dict, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+COLLECTION = "patient_latest_visit"
+
+
+def _projection_doc(visit: dict) -> dict:
+    snapshot = {key: value for key, value in visit.items() if key != "_id"}
+    return {
+        "patient_id": visit["patient_id"],
+        "visit_id": visit.get("visit_id"),
+        "visit_date": visit.get("visit_date"),
+        "visit": snapshot,
+        "updated_at": datetime.utcnow()
+    }
+
+
+async def record_latest_visit(db, visit: dict):
+    """Point the patient's projection at this visit if it is their most recent"""
+    if not visit.get("patient_id"):
+        return
+    doc = _projection_doc(visit)
+    collection = db[COLLECTION]
+
+    # Compare-and-set on visit_date so an older visit synced late never
+    # replaces a newer one
+    result = await collection.update_one(
+        {"patient_id": doc["patient_id"], "visit_date": {"$lte": doc["visit_date"]}},
+        {"$set": doc}
+    )
+    if result.matched_count:
+        return
+    if await collection.find_one({"patient_id": doc["patient_id"]}) is not None:
+        return
+    try:
+        await collection.insert_one(doc)
+    except DuplicateKeyError:
+        # Another write created the projection first (unique index)
+        await collection.update_one(
+            {"patient_id": doc["patient_id"], "visit_date": {"$lte": doc["visit_date"]}},
+            {"$set": doc}
+        )
+
+
+async def get_latest_visits(db, patient_ids: list[str]) -> Dict[str, dict]:
+    """Most recent visit per patient, for the given patients"""
+    if not patient_ids:
+        return {}
+    docs = await db[COLLECTION].find({"patient_id": {"$in": patient_ids}}).to_list(length=None)
+    return {doc["patient_id"]: doc.get("visit") or {} for doc in docs}
+
+
+async def rebuild_latest_visits(db) -> int:
+    """Recompute the projection from every visit"""
+    pipeline = [
+        {"$sort": {"visit_date": -1}},
+        {"$group": {"_id": "$patient_id", "latest_visit": {"$first": "$$ROOT"}}}
+    ]
+    latest = await db.visits.aggregate(pipeline).to_list(length=None)
+    docs = [_projection_doc(item["latest_visit"]) for item in latest if item["_id"]]
+    await db[COLLECTION].delete_many({})
+    if docs:
+        await db[COLLECTION].insert_many(docs)
+    return len(docs)
+
+
+async def ensure_latest_visits(db) -> Optional[int]:
+    """Backfill the projection when it is empty but visits exist"""
+    if await db[COLLECTION].count_documents({}) or not await db.visits.count_documents({}):
+        return None
+    return await rebuild_latest_visits(db)
@@ -0,0 +1,69 @@
+"""
+Totals for list endpoints
+include_total=exact counts the full filter on every call, none skips the
+count, and estimated serves a cached count per collection, filter and
+barangay scope. Cached totals are tagged with the barangays they cover and
+dropped by writes to those barangays, so an estimate is at most
+LIST_TOTAL_CACHE_TTL_S old and usually exact.
+"""
+
+import hashlib
+import json
+from typing import Iterable, Literal, Optional, Tuple
+
+from config import settings
+from services.result_cache import TTLCache
+
+TotalMode = Literal["none", "exact", "estimated"]
+
+list_total_cache = TTLCache(settings.LIST_TOTAL_CACHE_TTL_S, settings.LIST_TOTAL_CACHE_MAX_ENTRIES)
+
+
+def scope_tags(barangays: Optional[Iterable[str]]) -> Optional[Tuple[str, ...]]:
+    """Cache tags for a barangay scope; None means every barangay"""
+    if barangays is None:
+        return None
+    if isinstance(barangays, str):
+        return (barangays,)
+    return tuple(sorted(set(barangays)))
+
+
+def _filter_key(query: dict) -> str:
+    # Scoped visit filters carry every patient_id in the scope, so the key
+    # is a digest rather than the filter itself
+    encoded = json.dumps(query, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
+async def _count(db, collection_name: str, query: dict) -> int:
+    collection = db[collection_name]
+    if not query and not settings.in_process_db:
+        # Collection metadata instead of a scan
+        return await collection.estimated_document_count()
+    return await collection.count_documents(query)
+
+
+async def list_total(db, collection_name: str, query: dict, mode: TotalMode,
+                     tags: Optional[Tuple[str, ...]]) -> Optional[int]:
+    """Total for a list response in the requested include_total mode"""
+    if mode == "none":
+        return None
+    if mode == "exact":
+        return await db[collection_name].count_documents(query)
+
+    key = (collection_name, _filter_key(query), tags)
+    cached = list_total_cache.get(key)
+    if cached is not None:
+        return cached
+    generation = list_total_cache.generation
+    total = await _count(db, collection_name, query)
+    list_total_cache.set(key, total, tags=tags, generation=generation)
+    return total
+
+
+def invalidate_list_totals(barangays: Iterable[str]):
+    list_total_cache.invalidate(barangays)
+
+
+def list_total_cache_metrics() -> dict:
+    return list_total_cache.metrics()
@@ -0,0 +1,64 @@
+"""
+Keyset (cursor) pagination
+Listings are ordered by a sort field and a unique tie-breaker, both
+descending. A cursor encodes those two values from the last row of a page;
+the next page resumes with a range query after them, so deep pages cost the
+same as the first and rows do not shift when new documents arrive.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from storage.matcher import sort_value
+
+
+def keyset_sort(field: str, tie_field: str) -> List[Tuple[str, int]]:
+    return [(field, -1), (tie_field, -1)]
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    return value
+
+
+def _decode_value(value: Any) -> Any:
+    if isinstance(value, dict):
+        return datetime.fromisoformat(value["$date"])
+    return value
+
+
+def encode_cursor(doc: dict, field: str, tie_field: str) -> str:
+    payload = json.dumps([_encode_value(doc.get(field)), _encode_value(doc.get(tie_field))], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str) -> Tuple[Any, Any]:
+    """(sort value, tie-breaker) of a cursor; raises ValueError when malformed"""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        value, tie = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return _decode_value(value), _decode_value(tie)
+    except (binascii.Error, UnicodeError, TypeError, KeyError, ValueError) as exc:
+        raise ValueError("Invalid cursor") from exc
+
+
+def after_cursor(query: dict, field: str, tie_field: str, token: str) -> dict:
+    """query narrowed to the rows that follow the cursor in keyset_sort order"""
+    value, tie = decode_cursor(token)
+    bound = dict(query.get(field) or {})
+    # The upper bound is an index range on its own; the $or only settles ties
+    if "$lte" not in bound or sort_value(value) < sort_value(bound["$lte"]):
+        bound["$lte"] = value
+    keyset = {"$or": [{field: {"$lt": value}}, {field: value, tie_field: {"$lt": tie}}]}
+    return {**query, field: bound, "$and": query.get("$and", []) + [keyset]}
+
+
+def next_cursor(docs: List[dict], limit: int, field: str, tie_field: str) -> Optional[str]:
+    """Cursor for the page after docs, or None when this was the last page"""
+    if len(docs) < limit or not docs:
+        return None
+    return encode_cursor(docs[-1], field, tie_field)
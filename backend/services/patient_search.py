@@ -0,0 +1,164 @@
+"""
+patient_search index
+One document per patient with lowercase, accent-folded name and ID keys and
+a multikey "terms" field of postings: "p:" for the 1-2 character prefixes of
+each token and "t:" for every trigram. Searches look up one posting through
+the index and verify the candidates, instead of scanning patients with
+case-insensitive regexes. register/update keep it current;
+rebuild_patient_search backfills it.
+"""
+
+import re
+import unicodedata
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+COLLECTION = "patient_search"
+
+_TOKEN_SPLIT = re.compile(r"[^0-9a-z]+")
+_KEY_FIELDS = ("first_key", "last_key", "id_key")
+
+
+def normalize(text: Optional[str]) -> str:
+    """Lowercase and strip accents (e.g. "Peña" -> "pena")"""
+    if not text:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", str(text))
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).lower().strip()
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN_SPLIT.split(normalize(text)) if token]
+
+
+def _token_terms(token: str) -> List[str]:
+    terms = [f"p:{token[:length]}" for length in (1, 2) if len(token) >= length]
+    terms.extend(f"t:{token[i:i + 3]}" for i in range(len(token) - 2))
+    return terms
+
+
+def _search_doc(patient: dict) -> dict:
+    keys = {
+        "first_key": normalize(patient.get("first_name")),
+        "last_key": normalize(patient.get("last_name")),
+        "id_key": normalize(patient.get("patient_id")),
+    }
+    terms = set()
+    for key in keys.values():
+        for token in tokenize(key):
+            terms.update(_token_terms(token))
+    return {
+        "patient_id": patient["patient_id"],
+        "barangay": patient.get("barangay"),
+        "is_active": patient.get("is_active", True),
+        **keys,
+        "terms": sorted(terms),
+        "updated_at": datetime.utcnow()
+    }
+
+
+async def record_patient_search(db, patient: dict):
+    """Index (or re-index) a patient after it is registered or updated"""
+    if not patient.get("patient_id"):
+        return
+    doc = _search_doc(patient)
+    collection = db[COLLECTION]
+    result = await collection.update_one({"patient_id": doc["patient_id"]}, {"$set": doc})
+    if result.matched_count:
+        return
+    try:
+        await collection.insert_one(doc)
+    except DuplicateKeyError:
+        # Another write indexed the patient first (unique index)
+        await collection.update_one({"patient_id": doc["patient_id"]}, {"$set": doc})
+
+
+def _score(doc: dict, query_tokens: List[str], query_key: str) -> Optional[int]:
+    """
+    Relevance of an index entry, or None when it does not match. Every query
+    token must match a name or ID token: whole token 3, prefix 2, substring
+    (3+ characters only) 1. An exact patient ID ranks first.
+    """
+    if query_key and doc.get("id_key") == query_key:
+        return 1000
+    doc_tokens = [token for field in _KEY_FIELDS for token in tokenize(doc.get(field) or "")]
+    score = 0
+    for query_token in query_tokens:
+        best = 0
+        for token in doc_tokens:
+            if token == query_token:
+                best = 3
+                break
+            if token.startswith(query_token):
+                best = max(best, 2)
+            elif len(query_token) >= 3 and query_token in token:
+                best = max(best, 1)
+        if not best:
+            return None
+        score += best
+    return score
+
+
+def _anchor_term(query_tokens: List[str]) -> str:
+    """Posting used to fetch candidates: the longest token's last trigram, or its prefix"""
+    token = max(query_tokens, key=len)
+    if len(token) < 3:
+        return f"p:{token}"
+    return f"t:{token[-3:]}"
+
+
+async def search_patient_ids(db, search: str, patient_query: dict) -> List[str]:
+    """
+    patient_ids of the patients matching both the search text and
+    patient_query, best match first
+    """
+    query_tokens = tokenize(search)
+    if not query_tokens:
+        return []
+    index_query = {"terms": _anchor_term(query_tokens)}
+    # Scope filters the index can apply itself
+    for field in ("barangay", "is_active"):
+        if field in patient_query:
+            index_query[field] = patient_query[field]
+    candidates = await db[COLLECTION].find(
+        index_query, {"patient_id": 1, "first_key": 1, "last_key": 1, "id_key": 1}
+    ).to_list(length=None)
+
+    query_key = normalize(search)
+    ranked: List[Tuple[int, str, str, str]] = []
+    for doc in candidates:
+        score = _score(doc, query_tokens, query_key)
+        if score is not None:
+            ranked.append((-score, doc.get("last_key") or "", doc.get("first_key") or "", doc["patient_id"]))
+    ranked.sort()
+    patient_ids = list(dict.fromkeys(item[3] for item in ranked))
+
+    # Other filters (conditions, risk level, ...) are checked against patients
+    if patient_ids and set(patient_query) - set(index_query):
+        matching = await db.patients.find(
+            {**patient_query, "patient_id": {"$in": patient_ids}}, {"patient_id": 1}
+        ).to_list(length=None)
+        matching_ids = {patient["patient_id"] for patient in matching}
+        patient_ids = [patient_id for patient_id in patient_ids if patient_id in matching_ids]
+    return patient_ids
+
+
+async def rebuild_patient_search(db) -> int:
+    """Recompute the index from every patient"""
+    docs: Dict[str, dict] = {}
+    async for patient in db.patients.find({}, {"patient_id": 1, "first_name": 1, "last_name": 1, "barangay": 1, "is_active": 1}):
+        if patient.get("patient_id"):
+            docs[patient["patient_id"]] = _search_doc(patient)
+    await db[COLLECTION].delete_many({})
+    if docs:
+        await db[COLLECTION].insert_many(list(docs.values()))
+    return len(docs)
+
+
+async def ensure_patient_search(db) -> Optional[int]:
+    """Backfill the index when it is empty but patients exist"""
+    if await db[COLLECTION].count_documents({}) or not await db.patients.count_documents({}):
+        return None
+    return await rebuild_patient_search(db)
@@ -0,0 +1,99 @@
+"""
+In-process cache for computed endpoint results
+Entries expire after a fixed TTL and the least recently used entry is
+evicted when the cache is full. Each entry may carry tags (e.g. the
+barangays it was computed from) so writes can invalidate just the entries
+they affect. Results are shared between callers, so they must not be
+mutated after being cached.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Optional
+
+
+class TTLCache:
+    def __init__(self, ttl_seconds: float, max_entries: int = 256):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (expires_at, value, tags); tags=None means the entry
+        # depends on everything and is dropped by any invalidation
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def generation(self) -> int:
+        """Bumped by every invalidation; pass it back to set()"""
+        return self._generation
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value, _ = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, tags: Optional[Iterable[str]] = None,
+            generation: Optional[int] = None):
+        """
+        Store a result. When generation is given and an invalidation has
+        happened since it was read, the result may be stale and is dropped.
+        """
+        if self.ttl_seconds <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (
+                time.monotonic() + self.ttl_seconds,
+                value,
+                frozenset(tags) if tags is not None else None
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, tags: Iterable[str]):
+        """Drop entries tagged with any of these tags, and all untagged entries"""
+        tags = set(tags)
+        with self._lock:
+            self._generation += 1
+            stale = [
+                key for key, (_, _, entry_tags) in self._entries.items()
+                if entry_tags is None or not entry_tags.isdisjoint(tags)
+            ]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
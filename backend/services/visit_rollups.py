@@ -0,0 +1,190 @@
+"""
+visit_monthly_rollup projection
+Visit counts per (barangay, month, diagnosis, control_status, visit_type)
+and patient state: whether the patient is active and in the HTN and DM
+condition groups. Rows carry the patient's current barangay and state; the
+visit write paths increment the matching row, move_patient_rollups moves a
+patient's counts when that state changes and rebuild_visit_rollups backfills
+it from the visits and patients collections.
+"""
+
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from models.schemas import ControlStatus
+
+COLLECTION = "visit_monthly_rollup"
+KEY_FIELDS = ("barangay", "month", "diagnosis", "control_status", "visit_type", "is_active", "htn", "dm")
+VISIT_KEY_FIELDS = ("month", "diagnosis", "control_status", "visit_type")
+PATIENT_STATE_FIELDS = ("barangay", "is_active", "conditions")
+
+CONDITION_GROUPS = {
+    "htn": ["Hypertension", "HTN"],
+    "dm": ["Diabetes", "Diabetes Mellitus Type 2", "DM"],
+}
+
+
+def month_key(value) -> Optional[str]:
+    if not isinstance(value, datetime):
+        return None
+    return f"{value.year}-{value.month:02d}"
+
+
+def _patient_state(patient: Optional[dict]) -> dict:
+    patient = patient or {}
+    conditions = patient.get("conditions") or []
+    return {
+        "barangay": patient.get("barangay"),
+        "is_active": patient.get("is_active") is True,
+        **{group: any(c in conditions for c in names) for group, names in CONDITION_GROUPS.items()}
+    }
+
+
+def _state_rank(state: dict) -> tuple:
+    return state["is_active"], sum(state[group] for group in CONDITION_GROUPS)
+
+
+def _visit_key(visit: dict) -> Optional[dict]:
+    month = month_key(visit.get("visit_date"))
+    if month is None:
+        return None
+    return {
+        "month": month,
+        "diagnosis": visit.get("diagnosis"),
+        "control_status": visit.get("control_status"),
+        "visit_type": visit.get("visit_type")
+    }
+
+
+async def _add_to_row(collection, key: dict, count: int):
+    update = {"$inc": {"count": count}, "$set": {"updated_at": datetime.utcnow()}}
+    result = await collection.update_one(key, update)
+    if result.matched_count:
+        return
+    try:
+        await collection.insert_one({**key, "count": count, "updated_at": datetime.utcnow()})
+    except DuplicateKeyError:
+        # Another write created the row first (unique index)
+        await collection.update_one(key, update)
+
+
+async def record_visit_rollup(db, visit: dict, patient: Optional[dict]):
+    """Count the visit in the row for its month, diagnosis, status, type and patient state"""
+    key = _visit_key(visit)
+    if key is None:
+        return
+    await _add_to_row(db[COLLECTION], {**_patient_state(patient), **key}, 1)
+
+
+async def move_patient_rollups(db, before: dict, after: dict):
+    """
+    Move a patient's visit counts to the rows for their new state after
+    their barangay, active flag or conditions change
+    """
+    old_state, new_state = _patient_state(before), _patient_state(after)
+    if old_state == new_state:
+        return
+    counts: Counter = Counter()
+    fields = {"visit_date": 1, "diagnosis": 1, "control_status": 1, "visit_type": 1}
+    async for visit in db.visits.find({"patient_id": before["patient_id"]}, fields):
+        key = _visit_key(visit)
+        if key is not None:
+            counts[tuple(key[field] for field in VISIT_KEY_FIELDS)] += 1
+
+    collection = db[COLLECTION]
+    for values, count in counts.items():
+        key = dict(zip(VISIT_KEY_FIELDS, values))
+        await _add_to_row(collection, {**old_state, **key}, -count)
+        await _add_to_row(collection, {**new_state, **key}, count)
+    # Drop rows emptied by the move so reads stay small
+    await collection.delete_many({"count": {"$lte": 0}})
+
+
+def _count_control_status(monthly: Dict[str, Dict[str, int]], month: str, status: Optional[str], count: int):
+    counts = monthly.setdefault(month, {"controlled": 0, "uncontrolled": 0})
+    if status == ControlStatus.CONTROLLED.value:
+        counts["controlled"] += count
+    else:
+        counts["uncontrolled"] += count
+
+
+async def monthly_control_counts(db, diagnoses: List[str], condition_group: str, start_date: datetime,
+                                 barangays=None) -> Dict[str, Dict[str, int]]:
+    """
+    month -> {"controlled", "uncontrolled"} visit counts for the diagnoses,
+    from start_date on, over active patients in condition_group ("htn" or
+    "dm"). Whole months come from the rollup; the month start_date falls in
+    only counts visits on or after it, so those are counted from the visits
+    collection. barangays is one name, a list of names, or None for every
+    barangay.
+    """
+    scope: dict = {}
+    if isinstance(barangays, str):
+        scope["barangay"] = barangays
+    elif barangays is not None:
+        scope["barangay"] = {"$in": list(barangays)}
+    start_month = month_key(start_date)
+    query = {
+        **scope, "diagnosis": {"$in": diagnoses}, "month": {"$gt": start_month},
+        "is_active": True, condition_group: True
+    }
+    rows = await db[COLLECTION].find(query, {"month": 1, "control_status": 1, "count": 1}).to_list(length=None)
+
+    monthly: Dict[str, Dict[str, int]] = {}
+    for row in rows:
+        _count_control_status(monthly, row["month"], row.get("control_status"), row.get("count", 0))
+
+    patients = await db.patients.find(
+        {**scope, "is_active": True, "conditions": {"$in": CONDITION_GROUPS[condition_group]}}, {"patient_id": 1}
+    ).to_list(length=None)
+    month_start = start_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    next_month = (month_start + timedelta(days=32)).replace(day=1)
+    visit_query = {
+        "patient_id": {"$in": [p["patient_id"] for p in patients if p.get("patient_id")]},
+        "diagnosis": {"$in": diagnoses},
+        "visit_date": {"$gte": start_date, "$lt": next_month}
+    }
+    async for visit in db.visits.find(visit_query, {"control_status": 1}):
+        _count_control_status(monthly, start_month, visit.get("control_status"), 1)
+    return monthly
+
+
+async def rebuild_visit_rollups(db) -> int:
+    """Recompute every rollup row from the visits collection"""
+    state_by_patient: Dict[str, dict] = {}
+    async for p in db.patients.find({}, {"patient_id": 1, **{field: 1 for field in PATIENT_STATE_FIELDS}}):
+        if not p.get("patient_id"):
+            continue
+        state, current = _patient_state(p), state_by_patient.get(p["patient_id"])
+        # Legacy records can share a patient_id; keep the one the trends would match
+        if current is None or _state_rank(state) > _state_rank(current):
+            state_by_patient[p["patient_id"]] = state
+    counts: Counter = Counter()
+    fields = {"patient_id": 1, "visit_date": 1, "diagnosis": 1, "control_status": 1, "visit_type": 1}
+    async for visit in db.visits.find({}, fields):
+        key = _visit_key(visit)
+        if key is not None:
+            key.update(state_by_patient.get(visit.get("patient_id")) or _patient_state(None))
+            counts[tuple(key[field] for field in KEY_FIELDS)] += 1
+
+    now = datetime.utcnow()
+    docs = [
+        {**dict(zip(KEY_FIELDS, key)), "count": count, "updated_at": now}
+        for key, count in counts.items()
+    ]
+    await db[COLLECTION].delete_many({})
+    if docs:
+        await db[COLLECTION].insert_many(docs)
+    return len(docs)
+
+
+async def ensure_visit_rollups(db) -> Optional[int]:
+    """Backfill the rollup when it is empty (or has rows without patient state) but visits exist"""
+    if not await db.visits.count_documents({}):
+        return None
+    if await db[COLLECTION].count_documents({}) and not await db[COLLECTION].find_one({"is_active": {"$exists": False}}):
+        return None
+    return await rebuild_visit_rollups(db)
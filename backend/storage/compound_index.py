@@ -0,0 +1,420 @@
+"""
+In-process compound indexes for the embedded database
+Mongita only supports single-field indexes, so compound keys are kept here in
+sorted order and used to answer equality-prefix, range and ordered scans.
+Neither Mongita nor the memory backend enforces unique indexes, so unique
+keys (single-field ones included) are kept here too and checked before
+every write that could duplicate them.
+"""
+
+import functools
+import heapq
+import itertools
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from pymongo.errors import DuplicateKeyError
+from sortedcontainers import SortedList
+
+from storage.matcher import (
+    Predicate, SortSpec, compile_filter, get_path_value, get_path_values, sort_value
+)
+
+IndexKeys = List[Tuple[str, int]]
+
+# Entries are read out of the sorted list in chunks so writers are never
+# blocked for the length of a whole scan
+_SCAN_CHUNK_SIZE = 512
+_RANGE_OPERATORS = ("$gt", "$gte", "$lt", "$lte")
+
+
+class _Extreme:
+    """Bound that sorts before (or after) every index key"""
+    __slots__ = ("sign",)
+
+    def __init__(self, sign: int):
+        self.sign = sign
+
+    def __lt__(self, other):
+        return self is not other and self.sign < 0
+
+    def __gt__(self, other):
+        return self is not other and self.sign > 0
+
+    def __eq__(self, other):
+        return self is other
+
+    def __hash__(self):
+        return id(self)
+
+
+_TOP = _Extreme(1)
+
+
+@functools.total_ordering
+class _Descending:
+    """Wraps a key so it sorts in reverse order within a descending index field"""
+    __slots__ = ("key",)
+
+    def __init__(self, key: tuple):
+        self.key = key
+
+    def __lt__(self, other):
+        if isinstance(other, _Extreme):
+            return other.sign > 0
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return isinstance(other, _Descending) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+
+def _index_key(natural: tuple, direction: int):
+    return natural if direction > 0 else _Descending(natural)
+
+
+def _equality_values(condition: Any) -> Optional[list]:
+    """Values an index can look up for a field condition, or None"""
+    if isinstance(condition, dict):
+        if set(condition) == {"$eq"}:
+            condition = condition["$eq"]
+        elif set(condition) == {"$in"} and isinstance(condition["$in"], (list, tuple)):
+            values = list(condition["$in"])
+            if any(isinstance(v, (dict, list)) or hasattr(v, "pattern") for v in values):
+                return None
+            unique = {}
+            for value in values:
+                unique.setdefault(sort_value(value), value)
+            return list(unique.values())
+        else:
+            return None
+    if isinstance(condition, (dict, list)) or hasattr(condition, "pattern"):
+        return None
+    return [condition]
+
+
+def _range_bounds(condition: Any) -> Optional[Tuple[tuple, bool, tuple, bool]]:
+    """Natural-order (low, low_inclusive, high, high_inclusive) for a range condition"""
+    if not isinstance(condition, dict) or not condition or not set(condition) <= set(_RANGE_OPERATORS):
+        return None
+    low = high = None
+    low_inclusive = high_inclusive = True
+    for op, value in condition.items():
+        if isinstance(value, (dict, list)):
+            return None
+        key = sort_value(value)
+        if op in ("$gt", "$gte"):
+            if low is None or key > low or (key == low and op == "$gt"):
+                low, low_inclusive = key, op == "$gte"
+        elif high is None or key < high or (key == high and op == "$lt"):
+            high, high_inclusive = key, op == "$lte"
+    # Comparisons only match values of the same BSON type, so an open side
+    # stops at the edge of the bound's type bracket
+    if low is None:
+        low = (high[0], -1)
+    if high is None:
+        high = (low[0], 1)
+    return low, low_inclusive, high, high_inclusive
+
+
+class IndexPlan:
+    """How a query is answered from one compound index"""
+
+    def __init__(self, index: "CompoundIndex", ranges: List[Tuple[tuple, tuple]],
+                 reverse: bool, ordered: bool, merge_offset: Optional[int],
+                 residual: Optional[Predicate], consumed: int):
+        self.index = index
+        self.ranges = ranges
+        self.reverse = reverse
+        # True when documents come out in the requested sort order
+        self.ordered = ordered
+        # Scans over several $in prefixes are merged on the index fields
+        # after the prefix when a sort order was requested
+        self.merge_offset = merge_offset
+        self.residual = residual
+        self.consumed = consumed
+
+    def doc_ids(self) -> Iterator[str]:
+        scans = [self.index.scan(low, high, self.reverse) for low, high in self.ranges]
+        if len(scans) == 1:
+            entries = scans[0]
+        elif self.ordered and self.merge_offset is not None:
+            offset = self.merge_offset
+            entries = heapq.merge(*scans, key=lambda entry: entry[offset:], reverse=self.reverse)
+        else:
+            entries = itertools.chain.from_iterable(scans)
+
+        if not self.index.multikey:
+            for entry in entries:
+                yield entry[-1]
+            return
+        seen = set()
+        for entry in entries:
+            doc_id = entry[-1]
+            if doc_id not in seen:
+                seen.add(doc_id)
+                yield doc_id
+
+    def documents(self, fetch: Callable[[str], Optional[dict]]) -> Iterator[dict]:
+        """Fetch the planned documents, dropping those the residual filter rejects"""
+        residual = self.residual
+        for doc_id in self.doc_ids():
+            doc = fetch(doc_id)
+            if doc is None:
+                continue
+            if residual is None or residual(doc):
+                yield doc
+
+
+class CompoundIndex:
+    """Sorted (key..., _id) entries for one compound key specification"""
+
+    def __init__(self, keys: IndexKeys, unique: bool = False, sparse: bool = False, planned: bool = True):
+        self.keys = [(field, 1 if direction >= 0 else -1) for field, direction in keys]
+        self.fields = [field for field, _ in self.keys]
+        self.unique = unique
+        # Sparse only exempts documents missing every key field from the
+        # unique check; they stay in the index so scans still see them
+        self.sparse = sparse
+        # Single-field unique indexes are only constraints; the engine's own
+        # index answers queries on them
+        self.planned = planned
+        self.multikey = False
+        self.duplicate_keys = 0
+        self._entries = SortedList()
+        self._doc_entries: Dict[str, List[tuple]] = {}
+        self._lock = threading.RLock()
+
+    def _entries_for(self, doc: dict) -> List[tuple]:
+        per_field = []
+        for field, direction in self.keys:
+            values = get_path_values(doc, field)
+            expanded = []
+            for value in values:
+                if isinstance(value, list):
+                    self.multikey = True
+                    expanded.extend(value or [None])
+                else:
+                    expanded.append(value)
+            per_field.append([_index_key(sort_value(v), direction) for v in expanded or [None]])
+        doc_id = str(doc["_id"])
+        return [combo + (doc_id,) for combo in itertools.product(*per_field)]
+
+    def add(self, doc: dict):
+        entries = self._entries_for(doc)
+        with self._lock:
+            self._remove(str(doc["_id"]))
+            self._doc_entries[str(doc["_id"])] = entries
+            self._entries.update(entries)
+
+    def _remove(self, doc_id: str):
+        for entry in self._doc_entries.pop(doc_id, ()):
+            self._entries.discard(entry)
+
+    def remove(self, doc_id: Any):
+        with self._lock:
+            self._remove(str(doc_id))
+
+    def rebuild(self, docs: Iterable[dict]):
+        with self._lock:
+            self._entries.clear()
+            self._doc_entries.clear()
+            self.multikey = False
+            self.duplicate_keys = 0
+            seen = set()
+            for doc in docs:
+                entries = self._entries_for(doc)
+                self._doc_entries[str(doc["_id"])] = entries
+                self._entries.update(entries)
+                if self.unique and not self._exempt(doc):
+                    for key in {entry[:-1] for entry in entries}:
+                        if key in seen:
+                            self.duplicate_keys += 1
+                        seen.add(key)
+
+    def _exempt(self, doc: dict) -> bool:
+        return self.sparse and not any(get_path_values(doc, field) for field in self.fields)
+
+    def unique_keys(self, doc: dict) -> Optional[Set[tuple]]:
+        """Keys a document takes in this unique index, or None when sparse exempts it"""
+        if self._exempt(doc):
+            return None
+        return {entry[:-1] for entry in self._entries_for({**doc, "_id": doc.get("_id")})}
+
+    def holder(self, key: tuple, exclude: str) -> Optional[str]:
+        """_id of a document other than exclude holding key, if any"""
+        with self._lock:
+            for entry in self._entries.irange(key, key + (_TOP,)):
+                if entry[-1] != exclude:
+                    return entry[-1]
+        return None
+
+    def __len__(self):
+        return len(self._doc_entries)
+
+    def scan(self, low: tuple, high: tuple, reverse: bool = False) -> Iterator[tuple]:
+        """Yield entries between two bound tuples in index (or reverse) order"""
+        inclusive = (True, True)
+        while True:
+            with self._lock:
+                chunk = list(itertools.islice(
+                    self._entries.irange(low, high, inclusive, reverse), _SCAN_CHUNK_SIZE
+                ))
+            yield from chunk
+            if len(chunk) < _SCAN_CHUNK_SIZE:
+                return
+            if reverse:
+                high, inclusive = chunk[-1], (inclusive[0], False)
+            else:
+                low, inclusive = chunk[-1], (False, inclusive[1])
+
+    def plan(self, query: Dict[str, Any], sort: SortSpec) -> Optional[IndexPlan]:
+        """Work out how (and whether) this index can answer a query"""
+        prefixes: List[tuple] = [()]
+        fixed = set()
+        consumed = []
+        range_bounds = None
+        for field, direction in self.keys:
+            if field not in query:
+                break
+            values = _equality_values(query[field])
+            if values is not None:
+                prefixes = [
+                    prefix + (_index_key(sort_value(v), direction),)
+                    for prefix in prefixes for v in values
+                ]
+                consumed.append(field)
+                if len(values) == 1:
+                    fixed.add(field)
+                continue
+            bounds = _range_bounds(query[field])
+            if bounds is not None:
+                range_bounds = (direction, bounds)
+                consumed.append(field)
+            break
+
+        equality_count = len(consumed) - (1 if range_bounds else 0)
+        remaining_sort = [(f, d) for f, d in sort if f not in fixed]
+        suffix = self.keys[equality_count:]
+        ordered, reverse = not remaining_sort, False
+        if remaining_sort and len(remaining_sort) <= len(suffix):
+            fields_match = all(f == s[0] for (f, _), s in zip(remaining_sort, suffix))
+            same = all(d == s[1] for (_, d), s in zip(remaining_sort, suffix))
+            flipped = all(d == -s[1] for (_, d), s in zip(remaining_sort, suffix))
+            if fields_match and (same or flipped):
+                ordered, reverse = True, flipped and not same
+        # An index that only supplies the order still beats a sort: limited
+        # reads stop early and unbounded ones (exports) stream in order
+        if not consumed and not (ordered and remaining_sort):
+            return None
+
+        ranges = []
+        for prefix in prefixes:
+            if range_bounds is None:
+                ranges.append((prefix, prefix + (_TOP,)))
+                continue
+            direction, (low, low_inclusive, high, high_inclusive) = range_bounds
+            if direction < 0:
+                low, low_inclusive, high, high_inclusive = (
+                    _Descending(high), high_inclusive, _Descending(low), low_inclusive
+                )
+            ranges.append((
+                prefix + ((low,) if low_inclusive else (low, _TOP)),
+                prefix + ((high, _TOP) if high_inclusive else (high,)),
+            ))
+
+        residual_query = {k: v for k, v in query.items() if k not in consumed}
+        residual = compile_filter(residual_query) if residual_query else None
+        merge_offset = equality_count if remaining_sort else None
+        return IndexPlan(self, ranges, reverse, ordered, merge_offset, residual, len(consumed))
+
+
+def is_compound_key(keys: Any) -> bool:
+    """Whether a create_index key specification names more than one field"""
+    return (
+        isinstance(keys, (list, tuple)) and len(keys) > 1
+        and all(isinstance(k, (list, tuple)) and len(k) == 2 for k in keys)
+    )
+
+
+def index_name(keys: IndexKeys) -> str:
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+class CompoundIndexSet:
+    """All compound indexes registered on one collection"""
+
+    def __init__(self):
+        self._indexes: Dict[str, CompoundIndex] = {}
+
+    def __bool__(self):
+        return bool(self._indexes)
+
+    def create(self, keys: IndexKeys, docs: Iterable[dict], unique: bool = False,
+               sparse: bool = False, planned: bool = True) -> CompoundIndex:
+        name = index_name(keys)
+        index = self._indexes.get(name) or CompoundIndex(keys, unique, sparse, planned)
+        index.rebuild(docs)
+        self._indexes[name] = index
+        return index
+
+    def add(self, doc: dict):
+        for index in self._indexes.values():
+            index.add(doc)
+
+    def remove(self, doc_id: Any):
+        for index in self._indexes.values():
+            index.remove(doc_id)
+
+    def updates_unique_key(self, update: Dict[str, Any]) -> bool:
+        """Whether an update document sets or removes a field of a unique index"""
+        paths = [path for fields in update.values() if isinstance(fields, dict) for path in fields]
+        return any(
+            path == field or path.startswith(field + ".") or field.startswith(path + ".")
+            for index in self._indexes.values() if index.unique
+            for field in index.fields for path in paths
+        )
+
+    def check_unique(self, docs: Sequence[dict], previous: Optional[Dict[str, dict]] = None):
+        """
+        Raise DuplicateKeyError if writing docs would give a unique key to two
+        documents. previous maps the _id of each updated document to its
+        current version; a key the document already holds is not rechecked,
+        so duplicates that predate the index do not block other updates.
+        """
+        previous = previous or {}
+        for name, index in self._indexes.items():
+            if not index.unique:
+                continue
+            claimed: Dict[tuple, str] = {}
+            for doc in docs:
+                keys = index.unique_keys(doc)
+                if not keys:
+                    continue
+                doc_id = str(doc.get("_id"))
+                current = previous.get(doc_id)
+                held = (index.unique_keys(current) if current is not None else None) or set()
+                for key in keys - held:
+                    if key in claimed or index.holder(key, doc_id) is not None:
+                        key_value = {field: get_path_value(doc, field) for field in index.fields}
+                        raise DuplicateKeyError(
+                            f"E11000 duplicate key error index: {name} dup key: {key_value}",
+                            11000,
+                            {"keyPattern": dict(index.keys), "keyValue": key_value}
+                        )
+                    claimed[key] = doc_id
+
+    def plan(self, query: Dict[str, Any], sort: Sequence[Tuple[str, int]]) -> Optional[IndexPlan]:
+        """Pick the index that consumes the most of the filter, preferring ordered plans"""
+        best = None
+        for index in self._indexes.values():
+            if not index.planned:
+                continue
+            candidate = index.plan(query or {}, list(sort or []))
+            if candidate is None:
+                continue
+            if best is None or (candidate.consumed, candidate.ordered) > (best.consumed, best.ordered):
+                best = candidate
+        return best
@@ -0,0 +1,105 @@
+"""
+Low-level access to Mongita collections
+Everything that reaches into Mongita internals lives here
+"""
+
+import contextlib
+import copy
+import functools
+import os
+from typing import Any, Iterator, Optional
+
+from mongita.cursor import Cursor
+
+from storage.memory import MemoryCollection
+
+
+def collection_engine(collection):
+    """The Mongita storage engine behind a collection"""
+    return collection._engine
+
+
+def engine_lock(collection):
+    """The engine-wide lock Mongita holds for the duration of every write"""
+    return collection._engine.lock
+
+
+def find_documents(collection, query: dict, sort=None, limit=None, skip=None,
+                   shallow: bool = False) -> Iterator[dict]:
+    """
+    Run a Mongita find. With shallow=True the engine's cached documents are
+    yielded instead of deep copies; callers must not mutate them.
+    """
+    if isinstance(collection, MemoryCollection):
+        return collection.find(query, sort, limit, skip, shallow=shallow)
+    cursor = collection.find(query, sort=sort or None, limit=limit or None, skip=skip or None)
+    find_shallow = getattr(collection, "_Collection__find", None)
+    if shallow and find_shallow is not None:
+        cursor = Cursor(
+            functools.partial(find_shallow, shallow=True),
+            cursor._filter, cursor._sort, cursor._limit, cursor._skip
+        )
+    return iter(cursor)
+
+
+def get_document(collection, doc_id: Any, shallow: bool = False) -> Optional[dict]:
+    """Fetch one document by _id straight from the engine"""
+    engine = collection._engine
+    try:
+        if not engine.doc_exists(collection.full_name, doc_id):
+            return None
+        doc = engine.get_doc(collection.full_name, doc_id)
+    except KeyError:
+        # Deleted between the existence check and the read
+        return None
+    return doc if shallow else copy.deepcopy(doc)
+
+
+def iter_documents(collection) -> Iterator[dict]:
+    """Every document in a collection, shallow"""
+    return find_documents(collection, {}, shallow=True)
+
+
+def _sync_file(path: str):
+    try:
+        with open(path, "rb") as fh:
+            os.fsync(fh.fileno())
+    except FileNotFoundError:
+        pass
+
+
+@contextlib.contextmanager
+def deferred_metadata(engine, fsync: bool = True):
+    """
+    Hold back Mongita's per-write metadata rewrites until the block exits.
+    Mongita rewrites a collection's index metadata and document offsets on
+    every write; inside this block the in-memory copies are updated and each
+    touched collection is written once at the end. Document data is fsync'd
+    before the metadata that points at it. Must be used under the engine lock.
+    """
+    dirty = {}
+
+    def put_metadata(collection, metadata):
+        engine._metadata[collection] = metadata
+        dirty[collection] = metadata
+        return True
+
+    engine.put_metadata = put_metadata
+    try:
+        yield
+    finally:
+        del engine.put_metadata
+        fhs = getattr(engine, "_collection_fhs", {})
+        if fsync:
+            for collection in dirty:
+                if collection in fhs:
+                    os.fsync(fhs[collection].fileno())
+        for collection, metadata in dirty.items():
+            engine.put_metadata(collection, metadata)
+        if fsync and hasattr(engine, "_get_full_path"):
+            for collection in dirty:
+                # put_metadata may have defragmented the data file
+                if collection in fhs:
+                    os.fsync(fhs[collection].fileno())
+                _sync_file(engine._get_full_path(collection, "$.metadata"))
+                _sync_file(engine._get_full_path(collection, "$.file_attrs"))
@@ -0,0 +1,161 @@
+"""
+Dedicated thread pools for embedded database work
+Keeps DB calls off anyio's shared worker limiter and records how long each
+operation waits for a thread and how long it runs
+"""
+
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config import settings
+
+
+class _OperationStats:
+    __slots__ = ("count", "errors", "wait_total", "wait_max", "run_total", "run_max")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def record(self, wait: float, run: float, failed: bool):
+        self.count += 1
+        self.errors += failed
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.run_total += run
+        self.run_max = max(self.run_max, run)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "wait_ms_avg": round(self.wait_total / self.count * 1000, 3) if self.count else 0,
+            "wait_ms_max": round(self.wait_max * 1000, 3),
+            "run_ms_avg": round(self.run_total / self.count * 1000, 3) if self.count else 0,
+            "run_ms_max": round(self.run_max * 1000, 3),
+        }
+
+
+class DBExecutor:
+    """A sized thread pool that tracks queue depth, wait time and run time"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"db-{name}")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._peak_queued = 0
+        self._stats: Dict[Tuple[str, str], _OperationStats] = {}
+
+    async def run(self, collection: str, operation: str, func: Callable[[], Any]) -> Any:
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+            self._peak_queued = max(self._peak_queued, self._queued)
+
+        def _call():
+            started = time.perf_counter()
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+            failed = True
+            try:
+                result = func()
+                failed = False
+                return result
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    self._running -= 1
+                    stats = self._stats.get((collection, operation))
+                    if stats is None:
+                        stats = self._stats[(collection, operation)] = _OperationStats()
+                    stats.record(started - submitted, finished - started, failed)
+
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._pool, context.run, _call)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            operations = [
+                {"collection": collection, "operation": operation, **stats.to_dict()}
+                for (collection, operation), stats in sorted(self._stats.items())
+            ]
+            return {
+                "name": self.name,
+                "workers": self.workers,
+                "queued": self._queued,
+                "running": self._running,
+                "peak_queued": self._peak_queued,
+                "operations": operations,
+            }
+
+    def reset_metrics(self):
+        with self._lock:
+            self._stats.clear()
+            self._peak_queued = self._queued
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+_executors: Dict[str, DBExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def _get_executor(kind: str) -> DBExecutor:
+    if not settings.DB_EXECUTOR_SPLIT_READ_WRITE:
+        kind = "shared"
+    executor = _executors.get(kind)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(kind)
+            if executor is None:
+                workers = (
+                    settings.DB_EXECUTOR_WRITE_WORKERS if kind == "write"
+                    else settings.DB_EXECUTOR_WORKERS
+                )
+                executor = _executors[kind] = DBExecutor(kind, workers)
+    return executor
+
+
+async def run_read(collection: str, operation: str, func: Callable[[], Any]) -> Any:
+    """Run a blocking read on the DB executor"""
+    return await _get_executor("read").run(collection, operation, func)
+
+
+async def run_write(collection: str, operation: str, func: Callable[[], Any]) -> Any:
+    """Run a blocking write on the DB executor (the write pool when split)"""
+    return await _get_executor("write").run(collection, operation, func)
+
+
+def executor_metrics(reset: bool = False) -> dict:
+    """Snapshot of every DB executor's queue and timing metrics"""
+    with _executors_lock:
+        executors = list(_executors.values())
+    snapshot = {
+        "split_read_write": settings.DB_EXECUTOR_SPLIT_READ_WRITE,
+        "executors": [executor.metrics() for executor in executors],
+    }
+    if reset:
+        for executor in executors:
+            executor.reset_metrics()
+    return snapshot
+
+
+def shutdown_executors(executor_name: Optional[str] = None):
+    with _executors_lock:
+        for name in list(_executors):
+            if executor_name is None or name == executor_name:
+                _executors.pop(name).shutdown()
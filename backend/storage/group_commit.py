@@ -0,0 +1,145 @@
+"""
+Group commit for embedded writes
+Writes are buffered for a short window (or until a batch fills), applied
+together under one engine lock with a single metadata rewrite and fsync per
+collection, and only then acknowledged, so a caller that awaited a write
+always reads it back
+"""
+
+import asyncio
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from config import settings
+from storage.engine import collection_engine, deferred_metadata
+from storage.executor import run_write
+from storage.memory import MemoryCollection
+
+
+class _PendingWrite:
+    __slots__ = ("collection", "operation", "func", "future")
+
+    def __init__(self, collection: str, operation: str, func: Callable[[], Any], future: asyncio.Future):
+        self.collection = collection
+        self.operation = operation
+        self.func = func
+        self.future = future
+
+
+class GroupCommitWriter:
+    """Batches writes against one Mongita engine"""
+
+    def __init__(self, engine, window_ms: float, max_ops: int, fsync: bool = True):
+        self._engine = engine
+        self._window = max(0.0, window_ms) / 1000
+        self._max_ops = max(1, max_ops)
+        self._fsync = fsync
+        self._pending: List[_PendingWrite] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushing = False
+        self.batches = 0
+        self.operations = 0
+        self.largest_batch = 0
+
+    async def submit(self, collection: str, operation: str, func: Callable[[], Any]) -> Any:
+        """Queue a blocking write and wait until its batch is on disk"""
+        loop = asyncio.get_running_loop()
+        write = _PendingWrite(collection, operation, func, loop.create_future())
+        self._pending.append(write)
+        if len(self._pending) >= self._max_ops:
+            self._flush_now()
+        elif self._timer is None and not self._flushing:
+            self._timer = loop.call_later(self._window, self._flush_now)
+        return await write.future
+
+    def _flush_now(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # Writes arriving during a flush wait for it and go out in the next batch
+        if self._flushing or not self._pending:
+            return
+        batch = self._pending[:self._max_ops]
+        del self._pending[:self._max_ops]
+        self._flushing = True
+        asyncio.ensure_future(self._flush(batch))
+
+    async def _flush(self, batch: List[_PendingWrite]):
+        try:
+            outcomes = await run_write("*", "group_commit", lambda: self._apply(batch))
+        except Exception as exc:
+            outcomes = [(None, exc)] * len(batch)
+        finally:
+            self._flushing = False
+            if self._pending:
+                self._flush_now()
+
+        self.batches += 1
+        self.operations += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for write, (result, error) in zip(batch, outcomes):
+            if write.future.done():
+                continue
+            if error is not None:
+                write.future.set_exception(error)
+            else:
+                write.future.set_result(result)
+
+    def _apply(self, batch: List[_PendingWrite]) -> list:
+        outcomes = []
+        with self._engine.lock, deferred_metadata(self._engine, fsync=self._fsync):
+            for write in batch:
+                try:
+                    outcomes.append((write.func(), None))
+                except Exception as exc:
+                    # One failed write does not fail the rest of its batch
+                    outcomes.append((None, exc))
+        return outcomes
+
+    def metrics(self) -> dict:
+        return {
+            "batches": self.batches,
+            "operations": self.operations,
+            "avg_batch": round(self.operations / self.batches, 2) if self.batches else 0,
+            "largest_batch": self.largest_batch,
+            "pending": len(self._pending),
+        }
+
+
+_writers: Dict[int, GroupCommitWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def _get_writer(engine) -> GroupCommitWriter:
+    writer = _writers.get(id(engine))
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(id(engine))
+            if writer is None:
+                writer = _writers[id(engine)] = GroupCommitWriter(
+                    engine,
+                    settings.DB_GROUP_COMMIT_WINDOW_MS,
+                    settings.DB_GROUP_COMMIT_MAX_OPS,
+                    settings.DB_GROUP_COMMIT_FSYNC
+                )
+    return writer
+
+
+async def commit_write(collection, operation: str, func: Callable[[], Any]) -> Any:
+    """
+    Run a blocking write against an embedded collection, through the group
+    commit writer when it is enabled
+    """
+    if not settings.DB_GROUP_COMMIT or isinstance(collection, MemoryCollection):
+        # Nothing to batch when there is no disk write to amortize
+        return await run_write(collection.name, operation, func)
+    return await _get_writer(collection_engine(collection)).submit(collection.name, operation, func)
+
+
+def group_commit_metrics() -> dict:
+    with _writers_lock:
+        writers = list(_writers.values())
+    return {
+        "enabled": settings.DB_GROUP_COMMIT,
+        "writers": [writer.metrics() for writer in writers],
+    }
@@ -0,0 +1,152 @@
+"""
+Request-scoped batching for find_one lookups
+Single-key find_one calls issued in the same event-loop tick are merged into
+one $in query, and results are kept in a per-request identity map
+"""
+
+import asyncio
+import contextlib
+import copy
+import datetime
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+
+import bson
+
+from storage.matcher import compile_filter, get_path_values, sort_value
+
+# Values a batched $in lookup treats exactly like an equality match
+_BATCHABLE_TYPES = (str, int, float, bson.ObjectId, datetime.datetime)
+
+_current_loader: ContextVar[Optional["FindOneLoader"]] = ContextVar("find_one_loader", default=None)
+
+
+def batchable_key(query: Any) -> Optional[Tuple[str, Any]]:
+    """The (field, value) of a find_one filter the loader can batch, if any"""
+    if not isinstance(query, dict) or len(query) != 1:
+        return None
+    (field, value), = query.items()
+    if field.startswith("$") or field == "_id":
+        # _id lookups are already a direct fetch in both backends
+        return None
+    if isinstance(value, bool) or not isinstance(value, _BATCHABLE_TYPES):
+        return None
+    return field, value
+
+
+class _Batch:
+    __slots__ = ("collection", "field", "futures")
+
+    def __init__(self, collection, field: str):
+        self.collection = collection
+        self.field = field
+        self.futures: Dict[Any, Tuple[Any, asyncio.Future]] = {}
+
+
+class FindOneLoader:
+    """Batches and caches find_one lookups for the lifetime of one request"""
+
+    def __init__(self):
+        self._docs: Dict[Tuple[str, str, Any], Optional[dict]] = {}
+        self._pending: Dict[Tuple[str, str], _Batch] = {}
+        self._generations: Dict[str, int] = defaultdict(int)
+        self._tasks = set()
+        self.queries = 0
+        self.hits = 0
+
+    async def load(self, collection, field: str, value: Any) -> Optional[dict]:
+        name = collection.name
+        value_key = sort_value(value)
+        cache_key = (name, field, value_key)
+        if cache_key in self._docs:
+            self.hits += 1
+            return copy.deepcopy(self._docs[cache_key])
+
+        batch = self._pending.get((name, field))
+        if batch is None:
+            batch = self._pending[(name, field)] = _Batch(collection, field)
+            asyncio.get_running_loop().call_soon(self._dispatch, name, field)
+        entry = batch.futures.get(value_key)
+        if entry is None:
+            entry = batch.futures[value_key] = (value, asyncio.get_running_loop().create_future())
+        doc = await asyncio.shield(entry[1])
+        return copy.deepcopy(doc)
+
+    def _dispatch(self, name: str, field: str):
+        batch = self._pending.pop((name, field), None)
+        if batch is not None:
+            task = asyncio.ensure_future(self._run(name, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, name: str, batch: _Batch):
+        generation = self._generations[name]
+        values = [value for value, _ in batch.futures.values()]
+        self.queries += 1
+        try:
+            docs = await batch.collection.find({batch.field: {"$in": values}}).to_list(length=None)
+        except Exception as exc:
+            for _, future in batch.futures.values():
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        found: Dict[Any, dict] = {}
+        for doc in docs:
+            for value in get_path_values(doc, batch.field):
+                for candidate in (value if isinstance(value, list) else [value]):
+                    found.setdefault(sort_value(candidate), doc)
+
+        # A write since the query started may have changed these documents
+        cacheable = self._generations[name] == generation
+        for value_key, (_, future) in batch.futures.items():
+            doc = found.get(value_key)
+            if cacheable:
+                self._docs[(name, batch.field, value_key)] = doc
+            if not future.done():
+                future.set_result(doc)
+
+    def invalidate(self, name: str, query: Optional[dict] = None,
+                   inserted: Optional[dict] = None, updated: bool = False):
+        """
+        Drop cached lookups a write may have changed: an insert can satisfy a
+        lookup that found nothing, an update or delete can change or remove
+        any cached document its filter matches
+        """
+        self._generations[name] += 1
+        try:
+            matches = compile_filter(query) if query is not None else None
+        except ValueError:
+            matches = None
+            query = None
+        for key in [key for key in self._docs if key[0] == name]:
+            doc = self._docs[key]
+            if doc is None:
+                if inserted is not None:
+                    _, field, value_key = key
+                    stale = any(
+                        sort_value(candidate) == value_key
+                        for value in get_path_values(inserted, field)
+                        for candidate in (value if isinstance(value, list) else [value])
+                    )
+                else:
+                    stale = updated or query is None
+            else:
+                stale = inserted is None and (matches is None or matches(doc))
+            if stale:
+                del self._docs[key]
+
+
+def current_loader() -> Optional[FindOneLoader]:
+    return _current_loader.get()
+
+
+@contextlib.contextmanager
+def request_scope():
+    """Give the enclosed request its own find_one loader"""
+    token = _current_loader.set(FindOneLoader())
+    try:
+        yield
+    finally:
+        _current_loader.reset(token)
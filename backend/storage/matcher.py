@@ -0,0 +1,309 @@
+"""
+MongoDB query semantics for documents evaluated in-process
+Used wherever the embedded backend filters or sorts documents itself
+"""
+
+import datetime
+import re
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import bson
+
+SortSpec = List[Tuple[str, int]]
+Predicate = Callable[[dict], bool]
+
+_NUMBER_TYPES = (int, float)
+_REGEX_TYPES = (re.Pattern, bson.regex.Regex)
+_COMPARISON_OPERATORS = ("$gt", "$gte", "$lt", "$lte")
+# Operators Mongita evaluates natively
+_MONGITA_OPERATORS = frozenset(("$in", "$eq", "$gt", "$gte", "$lt", "$lte", "$ne", "$nin"))
+
+
+def get_path_values(doc: Any, path: str) -> list:
+    """
+    Resolve a dotted path the way MongoDB does: arrays met along the way are
+    traversed element by element. Missing values are omitted.
+    """
+    values = [doc]
+    for part in path.split("."):
+        next_values = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    next_values.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    next_values.append(value[int(part)])
+                else:
+                    next_values.extend(
+                        item[part] for item in value if isinstance(item, dict) and part in item
+                    )
+        values = next_values
+    return values
+
+
+def get_path_value(doc: Any, path: str, default: Any = None) -> Any:
+    """Resolve a dotted path to a single value (no array fan-out)"""
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict):
+            if part not in value:
+                return default
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return default
+    return value
+
+
+def _candidates(values: list) -> list:
+    """Values a leaf operator is tested against: each value plus array elements"""
+    result = []
+    for value in values:
+        result.append(value)
+        if isinstance(value, list):
+            result.extend(value)
+    return result
+
+
+def _comparable(a: Any, b: Any) -> bool:
+    if isinstance(a, bool) or isinstance(b, bool):
+        return isinstance(a, bool) and isinstance(b, bool)
+    if isinstance(a, _NUMBER_TYPES) and isinstance(b, _NUMBER_TYPES):
+        return True
+    return type(a) is type(b)
+
+
+def _compare(op: str, value: Any, target: Any) -> bool:
+    if not _comparable(value, target):
+        return False
+    try:
+        if op == "$gt":
+            return value > target
+        if op == "$gte":
+            return value >= target
+        if op == "$lt":
+            return value < target
+        return value <= target
+    except TypeError:
+        return False
+
+
+def _equals(values: list, target: Any) -> bool:
+    if target is None and not values:
+        return True
+    for value in _candidates(values):
+        if value == target and isinstance(value, bool) == isinstance(target, bool):
+            return True
+    return False
+
+
+def _compile_regex(pattern: Any, options: str = "") -> "re.Pattern":
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    if isinstance(pattern, bson.regex.Regex):
+        return pattern.try_compile()
+    flags = 0
+    for option in options or "":
+        flags |= {"i": re.IGNORECASE, "m": re.MULTILINE, "s": re.DOTALL, "x": re.VERBOSE}.get(option, 0)
+    return re.compile(pattern, flags)
+
+
+def _regex_matches(values: list, regex: "re.Pattern") -> bool:
+    return any(isinstance(value, str) and regex.search(value) for value in _candidates(values))
+
+
+def _in(values: list, targets: Sequence) -> bool:
+    for target in targets:
+        if isinstance(target, _REGEX_TYPES):
+            if _regex_matches(values, _compile_regex(target)):
+                return True
+        elif _equals(values, target):
+            return True
+    return False
+
+
+def _compile_operators(ops: Dict[str, Any]) -> Callable[[list], bool]:
+    checks: List[Callable[[list], bool]] = []
+    options = ops.get("$options", "")
+    for op, operand in ops.items():
+        if op == "$eq":
+            checks.append(lambda values, t=operand: _equals(values, t))
+        elif op == "$ne":
+            checks.append(lambda values, t=operand: not _equals(values, t))
+        elif op in _COMPARISON_OPERATORS:
+            checks.append(
+                lambda values, o=op, t=operand: any(_compare(o, v, t) for v in _candidates(values))
+            )
+        elif op in ("$in", "$nin"):
+            if not isinstance(operand, (list, tuple, set)):
+                raise ValueError(f"'{op}' requires an array")
+            targets = list(operand)
+            if op == "$in":
+                checks.append(lambda values, t=targets: _in(values, t))
+            else:
+                checks.append(lambda values, t=targets: not _in(values, t))
+        elif op == "$exists":
+            checks.append(lambda values, t=bool(operand): bool(values) == t)
+        elif op == "$regex":
+            regex = _compile_regex(operand, options)
+            checks.append(lambda values, r=regex: _regex_matches(values, r))
+        elif op == "$options":
+            continue
+        elif op == "$size":
+            checks.append(
+                lambda values, t=operand: any(isinstance(v, list) and len(v) == t for v in values)
+            )
+        elif op == "$all":
+            targets = list(operand)
+            checks.append(lambda values, t=targets: all(_equals(values, item) for item in t))
+        elif op == "$elemMatch":
+            inner = compile_filter(operand)
+            checks.append(lambda values, m=inner: any(
+                isinstance(v, list) and any(isinstance(item, dict) and m(item) for item in v)
+                for v in values
+            ))
+        elif op == "$not":
+            inner = _compile_operators(operand if isinstance(operand, dict) else {"$regex": operand})
+            checks.append(lambda values, m=inner: not m(values))
+        else:
+            raise ValueError(f"Unsupported query operator {op!r}")
+
+    return lambda values: all(check(values) for check in checks)
+
+
+def _is_operator_document(condition: Any) -> bool:
+    return isinstance(condition, dict) and bool(condition) and all(
+        key.startswith("$") for key in condition
+    )
+
+
+def _compile_field(path: str, condition: Any) -> Predicate:
+    if _is_operator_document(condition):
+        check = _compile_operators(condition)
+    elif isinstance(condition, _REGEX_TYPES):
+        regex = _compile_regex(condition)
+        check = lambda values: _regex_matches(values, regex)
+    else:
+        check = lambda values: _equals(values, condition)
+    return lambda doc: check(get_path_values(doc, path))
+
+
+def compile_filter(query: Optional[Dict[str, Any]]) -> Predicate:
+    """Compile a MongoDB filter document into a predicate over documents"""
+    if not query:
+        return lambda doc: True
+    predicates: List[Predicate] = []
+    for key, condition in query.items():
+        if key in ("$and", "$or", "$nor"):
+            subs = [compile_filter(sub) for sub in condition]
+            if key == "$and":
+                predicates.append(lambda doc, s=subs: all(p(doc) for p in s))
+            elif key == "$or":
+                predicates.append(lambda doc, s=subs: any(p(doc) for p in s))
+            else:
+                predicates.append(lambda doc, s=subs: not any(p(doc) for p in s))
+        elif key.startswith("$"):
+            raise ValueError(f"Unsupported top-level query operator {key!r}")
+        else:
+            predicates.append(_compile_field(key, condition))
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda doc: all(p(doc) for p in predicates)
+
+
+def _mongita_can_evaluate(key: str, condition: Any) -> bool:
+    if key.startswith("$") or isinstance(condition, _REGEX_TYPES):
+        return False
+    if _is_operator_document(condition):
+        return set(condition) <= _MONGITA_OPERATORS
+    return True
+
+
+def split_filter(query: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Split a filter into the part Mongita can evaluate (and use its indexes
+    for) and the residual that has to be matched in-process
+    """
+    native, residual = {}, {}
+    for key, condition in (query or {}).items():
+        if _mongita_can_evaluate(key, condition):
+            native[key] = condition
+        else:
+            residual[key] = condition
+    return native, residual
+
+
+# BSON comparison order: null < numbers < strings < objects < arrays
+# < binary < ObjectId < booleans < dates
+_TYPE_RANKS = (
+    (type(None), 0),
+    (bool, 7),
+    (int, 1),
+    (float, 1),
+    (str, 2),
+    (dict, 3),
+    (list, 4),
+    (bytes, 5),
+    (bson.ObjectId, 6),
+    (datetime.datetime, 8),
+)
+
+
+def type_rank(value: Any) -> int:
+    for value_type, rank in _TYPE_RANKS:
+        if isinstance(value, value_type):
+            return rank
+    return 9
+
+
+def sort_value(value: Any) -> tuple:
+    """Total-order key for a single value following BSON comparison order"""
+    rank = type_rank(value)
+    if rank in (3, 4, 9):
+        return (rank, 0, repr(value))
+    if rank == 8 and value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return (rank, 0, value)
+
+
+def normalize_sort(key_or_list: Any, direction: Optional[int] = None) -> SortSpec:
+    """Accept every pymongo sort spelling and return [(field, direction), ...]"""
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction if direction is not None else 1)]
+    if isinstance(key_or_list, dict):
+        return [(key, int(value)) for key, value in key_or_list.items()]
+    return [(key, int(value)) for key, value in key_or_list]
+
+
+def sort_documents(docs: List[dict], sort: SortSpec) -> List[dict]:
+    """Sort documents in place by a sort spec (stable, BSON ordering)"""
+    for field, direction in reversed(sort):
+        docs.sort(key=lambda doc, f=field: sort_value(get_path_value(doc, f)), reverse=direction < 0)
+    return docs
+
+
+class _Reversed:
+    """Inverts the ordering of a sort key component for descending fields"""
+    __slots__ = ("key",)
+
+    def __init__(self, key: tuple):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+def sort_key(sort: SortSpec) -> Callable[[dict], tuple]:
+    """Key function ordering documents by a sort spec, for heaps and min/max"""
+    def key(doc: dict) -> tuple:
+        return tuple(
+            sort_value(get_path_value(doc, field)) if direction > 0
+            else _Reversed(sort_value(get_path_value(doc, field)))
+            for field, direction in sort
+        )
+    return key
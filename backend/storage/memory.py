@@ -0,0 +1,401 @@
+"""
+In-memory database backend (DB_MODE=memory)
+Collections are dicts of documents keyed by _id with hash indexes on the
+single fields passed to create_index. It implements the part of the Mongita
+collection API the async wrappers use, so the query planner, compound
+indexes and pipelines work unchanged. State can be snapshotted to a
+directory of .bson files (mongodump layout) and loaded back at startup.
+"""
+
+import copy
+import itertools
+import os
+import re
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+import bson
+from mongita.errors import DuplicateKeyError
+from mongita.results import DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+from storage.matcher import (
+    SortSpec, compile_filter, get_path_values, normalize_sort, sort_documents, sort_value
+)
+
+
+def _index_keys(doc: dict, field: str) -> Set[tuple]:
+    keys = set()
+    for value in get_path_values(doc, field):
+        keys.add(sort_value(value))
+        if isinstance(value, list):
+            keys.update(sort_value(item) for item in value)
+    return keys
+
+
+def _lookup_values(condition: Any) -> Optional[list]:
+    """The values an equality or $in condition can be answered from a hash index with"""
+    if isinstance(condition, dict):
+        if set(condition) == {"$eq"}:
+            values = [condition["$eq"]]
+        elif set(condition) == {"$in"}:
+            values = list(condition["$in"])
+        else:
+            return None
+    else:
+        values = [condition]
+    # null also matches missing fields and containers compare structurally,
+    # so neither can be looked up by key
+    if any(value is None or isinstance(value, (dict, list, re.Pattern, bson.regex.Regex)) for value in values):
+        return None
+    return values
+
+
+class HashIndex:
+    """value -> set of _id strings for one field, multikey over arrays"""
+
+    def __init__(self, field: str):
+        self.field = field
+        self._ids: Dict[tuple, Set[str]] = {}
+
+    def add(self, doc_id: str, doc: dict):
+        for key in _index_keys(doc, self.field):
+            self._ids.setdefault(key, set()).add(doc_id)
+
+    def remove(self, doc_id: str, doc: dict):
+        for key in _index_keys(doc, self.field):
+            ids = self._ids.get(key)
+            if ids is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del self._ids[key]
+
+    def lookup(self, values: list) -> Set[str]:
+        found: Set[str] = set()
+        for value in values:
+            found |= self._ids.get(sort_value(value), set())
+        return found
+
+
+class MemoryEngine:
+    """Shared lock and cross-collection document access, like a Mongita engine"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.collections: Dict[str, "MemoryCollection"] = {}
+
+    def doc_exists(self, full_name: str, doc_id: Any) -> bool:
+        collection = self.collections.get(full_name)
+        return collection is not None and str(doc_id) in collection._docs
+
+    def get_doc(self, full_name: str, doc_id: Any) -> dict:
+        return self.collections[full_name]._docs[str(doc_id)]
+
+
+class MemoryCollection:
+    """
+    Documents are replaced, never mutated, on update, so readers holding a
+    document from a shallow find see a consistent version of it.
+    """
+
+    def __init__(self, name: str, database: "MemoryDatabase"):
+        self.name = name
+        self.database = database
+        self.full_name = f"{database.name}.{name}"
+        self._engine = database._engine
+        self._docs: Dict[str, dict] = {}
+        self._positions: Dict[str, int] = {}
+        self._next_position = 0
+        self._indexes: Dict[str, HashIndex] = {}
+
+    def __repr__(self):
+        return "MemoryCollection(%r)" % self.full_name
+
+    # Reads
+
+    def _candidates(self, query: Dict[str, Any]) -> List[dict]:
+        best: Optional[Set[str]] = None
+        with self._engine.lock:
+            for field, condition in query.items():
+                index = self._indexes.get(field)
+                values = _lookup_values(condition) if index is not None else None
+                if values is None:
+                    continue
+                ids = index.lookup(values)
+                if best is None or len(ids) < len(best):
+                    best = ids
+            if best is None:
+                return list(self._docs.values())
+            # Insertion order keeps unsorted results stable between calls
+            return [self._docs[doc_id] for doc_id in sorted(best, key=self._positions.__getitem__)]
+
+    def find(self, filter: Optional[Dict[str, Any]] = None, sort: Optional[SortSpec] = None,
+             limit: Optional[int] = None, skip: Optional[int] = None, shallow: bool = False) -> Iterator[dict]:
+        query = filter or {}
+        matches = compile_filter(query)
+        docs = [doc for doc in self._candidates(query) if matches(doc)]
+        if sort:
+            sort_documents(docs, normalize_sort(sort))
+        stop = (skip or 0) + limit if limit else None
+        docs = itertools.islice(docs, skip or 0, stop)
+        return docs if shallow else map(copy.deepcopy, docs)
+
+    def find_one(self, filter: Optional[Dict[str, Any]] = None, sort: Optional[SortSpec] = None,
+                 skip: Optional[int] = None) -> Optional[dict]:
+        return next(self.find(filter, sort=sort, limit=1, skip=skip), None)
+
+    def count_documents(self, filter: Optional[Dict[str, Any]] = None) -> int:
+        return sum(1 for _ in self.find(filter, shallow=True))
+
+    def distinct(self, key: str, filter: Optional[Dict[str, Any]] = None) -> list:
+        seen = {}
+        for doc in self.find(filter, shallow=True):
+            for value in get_path_values(doc, key):
+                for item in (value if isinstance(value, list) else [value]):
+                    seen.setdefault(sort_value(item), item)
+        return copy.deepcopy(list(seen.values()))
+
+    # Writes
+
+    def _put(self, doc: dict):
+        doc_id = str(doc["_id"])
+        previous = self._docs.get(doc_id)
+        for index in self._indexes.values():
+            if previous is not None:
+                index.remove(doc_id, previous)
+            index.add(doc_id, doc)
+        if previous is None:
+            self._positions[doc_id] = self._next_position
+            self._next_position += 1
+        self._docs[doc_id] = doc
+
+    def _delete(self, doc: dict):
+        doc_id = str(doc["_id"])
+        for index in self._indexes.values():
+            index.remove(doc_id, doc)
+        del self._docs[doc_id]
+        del self._positions[doc_id]
+
+    def _prepare(self, document: dict) -> dict:
+        if not isinstance(document, dict):
+            raise TypeError("Document must be a dict")
+        document = copy.deepcopy(document)
+        document["_id"] = document.get("_id") or bson.ObjectId()
+        return document
+
+    def insert_one(self, document: dict) -> InsertOneResult:
+        document = self._prepare(document)
+        with self._engine.lock:
+            if str(document["_id"]) in self._docs:
+                raise DuplicateKeyError("Document %r already exists" % document["_id"])
+            self._put(document)
+        return InsertOneResult(document["_id"])
+
+    def insert_many(self, documents: List[dict], ordered: bool = True) -> InsertManyResult:
+        documents = [self._prepare(document) for document in documents]
+        with self._engine.lock:
+            for document in documents:
+                if str(document["_id"]) in self._docs:
+                    raise DuplicateKeyError("Document %r already exists" % document["_id"])
+                self._put(document)
+        return InsertManyResult(documents)
+
+    def _update(self, filter: Dict[str, Any], update: Dict[str, Any], limit: Optional[int]) -> UpdateResult:
+        if not update or not all(key.startswith("$") for key in update):
+            raise ValueError("Update must only contain update operators")
+        with self._engine.lock:
+            targets = list(self.find(filter, limit=limit, shallow=True))
+            for doc in targets:
+                updated = copy.deepcopy(doc)
+                for operator, fields in update.items():
+                    apply_update(operator, fields, updated)
+                self._put(updated)
+        return UpdateResult(len(targets), len(targets))
+
+    def update_one(self, filter: Dict[str, Any], update: Dict[str, Any], upsert: bool = False) -> UpdateResult:
+        if upsert:
+            raise NotImplementedError("upsert is not supported by the memory backend")
+        return self._update(filter, update, limit=1)
+
+    def update_many(self, filter: Dict[str, Any], update: Dict[str, Any], upsert: bool = False) -> UpdateResult:
+        if upsert:
+            raise NotImplementedError("upsert is not supported by the memory backend")
+        return self._update(filter, update, limit=None)
+
+    def _remove(self, filter: Dict[str, Any], limit: Optional[int]) -> DeleteResult:
+        with self._engine.lock:
+            targets = list(self.find(filter, limit=limit, shallow=True))
+            for doc in targets:
+                self._delete(doc)
+        return DeleteResult(len(targets))
+
+    def delete_one(self, filter: Dict[str, Any]) -> DeleteResult:
+        return self._remove(filter, limit=1)
+
+    def delete_many(self, filter: Dict[str, Any]) -> DeleteResult:
+        return self._remove(filter, limit=None)
+
+    def create_index(self, keys: Any, background: bool = False) -> str:
+        (field, direction), = normalize_sort(keys)
+        with self._engine.lock:
+            if field not in self._indexes:
+                index = HashIndex(field)
+                for doc_id, doc in self._docs.items():
+                    index.add(doc_id, doc)
+                self._indexes[field] = index
+        return f"{field}_{direction}"
+
+    def index_information(self) -> List[dict]:
+        # Same layout as Mongita's index_information
+        return [{"_id_": {"key": [("_id", 1)]}}] + [
+            {f"{field}_1": {"key": [(field, 1)]}} for field in self._indexes
+        ]
+
+    def explain_index(self, query: Dict[str, Any]) -> Optional[str]:
+        """The hash index find would narrow this filter with, if any"""
+        best = None
+        with self._engine.lock:
+            for field, condition in query.items():
+                index = self._indexes.get(field)
+                values = _lookup_values(condition) if index is not None else None
+                if values is not None:
+                    size = len(index.lookup(values))
+                    if best is None or size < best[0]:
+                        best = (size, f"{field}_1")
+        return best[1] if best else None
+
+
+def _parent(doc: dict, path: str, create: bool):
+    """The container holding the last segment of a dotted path"""
+    parts = path.split(".")
+    target = doc
+    for part in parts[:-1]:
+        if isinstance(target, list) and part.isdigit():
+            target = target[int(part)]
+            continue
+        if part not in target or not isinstance(target[part], (dict, list)):
+            if not create:
+                return None, parts[-1]
+            target[part] = {}
+        target = target[part]
+    return target, parts[-1]
+
+
+def apply_update(operator: str, fields: Dict[str, Any], doc: dict):
+    for path, value in fields.items():
+        if path == "_id" or path.startswith("_id."):
+            raise ValueError("_id cannot be updated")
+        parent, key = _parent(doc, path, create=operator != "$unset")
+        if operator == "$set":
+            parent[key] = copy.deepcopy(value)
+        elif operator == "$unset":
+            if isinstance(parent, dict):
+                parent.pop(key, None)
+        elif operator == "$inc":
+            parent[key] = parent.get(key, 0) + value
+        elif operator in ("$push", "$addToSet"):
+            items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+            array = parent.setdefault(key, [])
+            if not isinstance(array, list):
+                raise ValueError(f"Cannot apply {operator} to non-array field {path!r}")
+            for item in items:
+                if operator == "$push" or item not in array:
+                    array.append(copy.deepcopy(item))
+        else:
+            raise ValueError(f"Unsupported update operator {operator!r}")
+
+
+class MemoryDatabase:
+    def __init__(self, name: str, engine: MemoryEngine):
+        self.name = name
+        self._engine = engine
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        full_name = f"{self.name}.{name}"
+        collection = self._engine.collections.get(full_name)
+        if collection is None:
+            with self._engine.lock:
+                collection = self._engine.collections.get(full_name)
+                if collection is None:
+                    collection = self._engine.collections[full_name] = MemoryCollection(name, self)
+        return collection
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def list_collection_names(self) -> List[str]:
+        prefix = f"{self.name}."
+        return sorted(
+            full_name[len(prefix):] for full_name, collection in self._engine.collections.items()
+            if full_name.startswith(prefix) and collection._docs
+        )
+
+
+class MemoryClient:
+    """Drop-in for MongitaClientDisk that keeps every collection in memory"""
+
+    def __init__(self):
+        self.engine = MemoryEngine()
+        self._databases: Dict[str, MemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        database = self._databases.get(name)
+        if database is None:
+            database = self._databases[name] = MemoryDatabase(name, self.engine)
+        return database
+
+    def close(self):
+        pass
+
+
+def save_snapshot(database: MemoryDatabase, directory: str) -> Dict[str, int]:
+    """
+    Write each collection to <directory>/<collection>.bson, one BSON document
+    after another. Files are replaced atomically.
+    """
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    for name in database.list_collection_names():
+        collection = database[name]
+        with database._engine.lock:
+            docs = list(collection._docs.values())
+        path = os.path.join(directory, f"{name}.bson")
+        with open(path + ".tmp", "wb") as fh:
+            for doc in docs:
+                fh.write(bson.encode(doc))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(path + ".tmp", path)
+        counts[name] = len(docs)
+    return counts
+
+
+def load_snapshot(database: MemoryDatabase, directory: str) -> Dict[str, int]:
+    """Load every <collection>.bson file in a snapshot directory"""
+    counts = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".bson"):
+            continue
+        name = filename[:-len(".bson")]
+        collection = database[name]
+        with open(os.path.join(directory, filename), "rb") as fh:
+            docs = list(bson.decode_file_iter(fh))
+        with database._engine.lock:
+            for doc in docs:
+                collection._put(doc)
+        counts[name] = len(docs)
+    return counts
+
+
+def copy_collections(source, database: MemoryDatabase) -> Dict[str, int]:
+    """Copy every collection of another (e.g. Mongita) database into memory"""
+    counts = {}
+    for name in source.list_collection_names():
+        docs = list(source[name].find({}))
+        collection = database[name]
+        with database._engine.lock:
+            for doc in docs:
+                collection._put(doc)
+        counts[name] = len(docs)
+    return counts
@@ -0,0 +1,206 @@
+"""
+Motor connection pool configuration, warmup and telemetry (DB_MODE=mongo)
+"""
+
+import asyncio
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from pymongo import monitoring
+
+from config import settings
+from storage.profiler import command_profiler
+
+
+class _ServerPoolStats:
+    __slots__ = (
+        "open", "created", "closed", "checked_out", "peak_checked_out", "checkouts",
+        "failures", "wait_total", "wait_max", "cleared"
+    )
+
+    def __init__(self):
+        self.open = 0
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.checkouts = 0
+        self.failures: Dict[str, int] = {}
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.cleared = 0
+
+    def reset(self):
+        self.created = 0
+        self.closed = 0
+        self.peak_checked_out = self.checked_out
+        self.checkouts = 0
+        self.failures = {}
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.cleared = 0
+
+    def to_dict(self) -> dict:
+        attempts = self.checkouts + sum(self.failures.values())
+        return {
+            "open_connections": self.open,
+            "checked_out": self.checked_out,
+            "idle": max(0, self.open - self.checked_out),
+            "peak_checked_out": self.peak_checked_out,
+            "connections_created": self.created,
+            "connections_closed": self.closed,
+            "checkouts": self.checkouts,
+            "checkout_failures": dict(self.failures),
+            "wait_ms_avg": round(self.wait_total / attempts * 1000, 3) if attempts else 0,
+            "wait_ms_max": round(self.wait_max * 1000, 3),
+            "pool_cleared": self.cleared,
+        }
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """
+    Tracks open, idle and checked-out connections per server, plus how long
+    checkouts wait for a connection. pymongo fires the checkout events on the
+    thread doing the checkout, so the start time is kept per thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._servers: Dict[str, _ServerPoolStats] = {}
+
+    def _stats(self, address) -> _ServerPoolStats:
+        key = "%s:%s" % address
+        stats = self._servers.get(key)
+        if stats is None:
+            stats = self._servers[key] = _ServerPoolStats()
+        return stats
+
+    def _started(self, address) -> Optional[float]:
+        return getattr(self._local, "started", {}).pop(address, None)
+
+    def pool_created(self, event):
+        with self._lock:
+            self._stats(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._stats(event.address).cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            stats = self._stats(event.address)
+            stats.open += 1
+            stats.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            stats = self._stats(event.address)
+            stats.open = max(0, stats.open - 1)
+            stats.closed += 1
+
+    def connection_check_out_started(self, event):
+        if not hasattr(self._local, "started"):
+            self._local.started = {}
+        self._local.started[event.address] = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        started = self._started(event.address)
+        with self._lock:
+            stats = self._stats(event.address)
+            stats.failures[event.reason] = stats.failures.get(event.reason, 0) + 1
+            if started is not None:
+                self._record_wait(stats, time.perf_counter() - started)
+
+    def connection_checked_out(self, event):
+        started = self._started(event.address)
+        with self._lock:
+            stats = self._stats(event.address)
+            stats.checkouts += 1
+            stats.checked_out += 1
+            stats.peak_checked_out = max(stats.peak_checked_out, stats.checked_out)
+            if started is not None:
+                self._record_wait(stats, time.perf_counter() - started)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            stats = self._stats(event.address)
+            stats.checked_out = max(0, stats.checked_out - 1)
+
+    @staticmethod
+    def _record_wait(stats: _ServerPoolStats, wait: float):
+        stats.wait_total += wait
+        stats.wait_max = max(stats.wait_max, wait)
+
+    def open_connections(self) -> int:
+        """Open connections on the best-connected server (minPoolSize is per server)"""
+        with self._lock:
+            return max((stats.open for stats in self._servers.values()), default=0)
+
+    def metrics(self, reset: bool = False) -> dict:
+        with self._lock:
+            servers = {address: stats.to_dict() for address, stats in sorted(self._servers.items())}
+            if reset:
+                for stats in self._servers.values():
+                    stats.reset()
+        return servers
+
+
+pool_listener = PoolStatsListener()
+
+
+def client_options() -> Dict[str, Any]:
+    """AsyncIOMotorClient keyword arguments built from Settings"""
+    options: Dict[str, Any] = {
+        "maxPoolSize": settings.MONGODB_MAX_POOL_SIZE,
+        "minPoolSize": settings.MONGODB_MIN_POOL_SIZE,
+        "maxIdleTimeMS": settings.MONGODB_MAX_IDLE_TIME_MS,
+        "serverSelectionTimeoutMS": settings.MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        "connectTimeoutMS": settings.MONGODB_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": settings.MONGODB_SOCKET_TIMEOUT_MS,
+        "waitQueueTimeoutMS": settings.MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+        "event_listeners": [pool_listener, command_profiler],
+    }
+    compressors = [name.strip() for name in settings.MONGODB_COMPRESSORS.split(",") if name.strip()]
+    if compressors:
+        # pymongo warns about and skips compressors whose package is missing
+        # (zstd needs zstandard, snappy needs python-snappy)
+        options["compressors"] = ",".join(compressors)
+        if "zlib" in compressors:
+            options["zlibCompressionLevel"] = settings.MONGODB_ZLIB_COMPRESSION_LEVEL
+    return {key: value for key, value in options.items() if value is not None}
+
+
+async def warm_pool(client, connections: int, timeout: float) -> int:
+    """
+    Open connections before the first request needs them. Concurrent pings
+    make the pool dial several connections at once; pymongo's background
+    maintenance then tops it up to minPoolSize, which is waited for here.
+    Returns the number of connections open to the primary (or busiest) server.
+    """
+    if connections <= 0:
+        return pool_listener.open_connections()
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(connections)))
+    deadline = time.monotonic() + timeout
+    while pool_listener.open_connections() < connections and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return pool_listener.open_connections()
+
+
+def pool_metrics(reset: bool = False) -> dict:
+    """Live Motor pool state and checkout statistics per server"""
+    return {
+        "max_pool_size": settings.MONGODB_MAX_POOL_SIZE,
+        "min_pool_size": settings.MONGODB_MIN_POOL_SIZE,
+        "servers": pool_listener.metrics(reset=reset),
+    }
@@ -0,0 +1,437 @@
+"""
+Aggregation pipelines for the embedded database
+Runs the subset of MongoDB's aggregation framework the API uses, so routes
+can issue the same pipeline in both database modes
+"""
+
+import copy
+import datetime
+import heapq
+import itertools
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from storage.compound_index import CompoundIndexSet
+from storage.matcher import (
+    compile_filter, get_path_value, normalize_sort, sort_documents, sort_key, sort_value
+)
+from storage.projection import compile_projection
+from storage.query import run_query
+
+Stage = Dict[str, Any]
+_MISSING = object()
+
+
+# ---------------------------------------------------------------------------
+# Expressions
+# ---------------------------------------------------------------------------
+
+def _field_value(value: Any, parts: List[str]) -> Any:
+    """Resolve a field path; arrays along the path yield arrays of values"""
+    for index, part in enumerate(parts):
+        if isinstance(value, list):
+            resolved = [_field_value(item, parts[index:]) for item in value]
+            return [item for item in resolved if item is not _MISSING]
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _compare_values(op: str, a: Any, b: Any) -> bool:
+    a, b = sort_value(a), sort_value(b)
+    if op == "$eq":
+        return a == b
+    if op == "$ne":
+        return a != b
+    if op == "$gt":
+        return a > b
+    if op == "$gte":
+        return a >= b
+    if op == "$lt":
+        return a < b
+    return a <= b
+
+
+def _date_part(name: str) -> Callable[[Any], Any]:
+    def part(value):
+        if not isinstance(value, datetime.datetime):
+            return None
+        if name == "dayOfWeek":
+            # MongoDB numbers days Sunday=1 .. Saturday=7
+            return value.isoweekday() % 7 + 1
+        return getattr(value, name)
+    return part
+
+
+_DATE_PARTS = {
+    "$year": _date_part("year"),
+    "$month": _date_part("month"),
+    "$dayOfMonth": _date_part("day"),
+    "$hour": _date_part("hour"),
+    "$minute": _date_part("minute"),
+    "$second": _date_part("second"),
+    "$dayOfWeek": _date_part("dayOfWeek"),
+}
+
+
+def _as_args(operand: Any) -> list:
+    return operand if isinstance(operand, list) else [operand]
+
+
+def _truthy(value: Any) -> bool:
+    return value not in (None, False, 0) and value is not _MISSING
+
+
+def _evaluate_operator(op: str, operand: Any, doc: dict) -> Any:
+    if op == "$literal":
+        return operand
+    if op in _DATE_PARTS:
+        date = operand.get("date") if isinstance(operand, dict) else _as_args(operand)[0]
+        return _DATE_PARTS[op](evaluate(date, doc))
+    if op == "$dateToString":
+        date = evaluate(operand["date"], doc)
+        if not isinstance(date, datetime.datetime):
+            return operand.get("onNull")
+        return date.strftime(operand.get("format", "%Y-%m-%dT%H:%M:%S.%LZ").replace("%L", "000"))
+    if op == "$cond":
+        if isinstance(operand, dict):
+            condition, then, otherwise = operand["if"], operand["then"], operand["else"]
+        else:
+            condition, then, otherwise = operand
+        return evaluate(then if _truthy(evaluate(condition, doc)) else otherwise, doc)
+    if op == "$ifNull":
+        args = _as_args(operand)
+        for arg in args[:-1]:
+            value = evaluate(arg, doc)
+            if value is not None:
+                return value
+        return evaluate(args[-1], doc)
+
+    args = [evaluate(arg, doc) for arg in _as_args(operand)]
+    if op in ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte"):
+        return _compare_values(op, args[0], args[1])
+    if op == "$and":
+        return all(_truthy(arg) for arg in args)
+    if op == "$or":
+        return any(_truthy(arg) for arg in args)
+    if op == "$not":
+        return not _truthy(args[0])
+    if op == "$in":
+        return any(sort_value(args[0]) == sort_value(item) for item in args[1] or [])
+    if op == "$size":
+        return len(args[0]) if isinstance(args[0], list) else None
+    if op == "$setIntersection":
+        if any(arg is None for arg in args):
+            return None
+        common = [item for item in args[0] if all(item in other for other in args[1:])]
+        return list({sort_value(item): item for item in common}.values())
+    if op == "$arrayElemAt":
+        array, index = args
+        if not isinstance(array, list) or not -len(array) <= index < len(array):
+            return None
+        return array[index]
+    if op in ("$add", "$subtract", "$multiply", "$divide"):
+        if any(arg is None for arg in args):
+            return None
+        if op == "$add":
+            return sum(args[1:], args[0])
+        if op == "$subtract":
+            return args[0] - args[1]
+        if op == "$multiply":
+            result = 1
+            for arg in args:
+                result *= arg
+            return result
+        return args[0] / args[1]
+    if op == "$concat":
+        if any(not isinstance(arg, str) for arg in args):
+            return None
+        return "".join(args)
+    if op == "$toLower":
+        return (args[0] or "").lower()
+    if op == "$toUpper":
+        return (args[0] or "").upper()
+    raise ValueError(f"Unsupported aggregation expression {op!r}")
+
+
+def evaluate(expr: Any, doc: dict) -> Any:
+    """Evaluate an aggregation expression against a document"""
+    if isinstance(expr, str) and expr.startswith("$"):
+        if expr.startswith("$$"):
+            name, _, path = expr[2:].partition(".")
+            if name not in ("ROOT", "CURRENT"):
+                raise ValueError(f"Unsupported aggregation variable {expr!r}")
+            value = _field_value(doc, path.split(".")) if path else doc
+        else:
+            value = _field_value(doc, expr[1:].split("."))
+        return None if value is _MISSING else value
+    if isinstance(expr, dict):
+        if len(expr) == 1:
+            (key, operand), = expr.items()
+            if key.startswith("$"):
+                return _evaluate_operator(key, operand, doc)
+        return {key: evaluate(value, doc) for key, value in expr.items()}
+    if isinstance(expr, list):
+        return [evaluate(item, doc) for item in expr]
+    return expr
+
+
+# ---------------------------------------------------------------------------
+# $group
+# ---------------------------------------------------------------------------
+
+class _Accumulator:
+    """State for one accumulator field within one group"""
+    __slots__ = ("op", "value", "count", "seen", "rank")
+
+    def __init__(self, op: str):
+        self.op = op
+        self.count = 0
+        self.rank = None
+        self.seen = None
+        if op in ("$sum", "$avg"):
+            self.value = 0
+        elif op in ("$push", "$addToSet"):
+            self.value = []
+            self.seen = set() if op == "$addToSet" else None
+        else:
+            self.value = _MISSING
+
+    def add(self, value: Any, rank: Any = None):
+        op = self.op
+        if op == "$sum":
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.value += value
+        elif op == "$avg":
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.value += value
+                self.count += 1
+        elif op == "$first":
+            # With a rank (fused $sort), keep the lowest; ties keep scan order
+            if self.value is _MISSING or (rank is not None and rank < self.rank):
+                self.value, self.rank = value, rank
+        elif op == "$last":
+            if rank is None or self.value is _MISSING or not rank < self.rank:
+                self.value, self.rank = value, rank
+        elif op in ("$min", "$max"):
+            if value is None:
+                return
+            if self.value is _MISSING:
+                self.value = value
+            elif op == "$min" and sort_value(value) < sort_value(self.value):
+                self.value = value
+            elif op == "$max" and sort_value(value) > sort_value(self.value):
+                self.value = value
+        elif op == "$push":
+            self.value.append(value)
+        elif op == "$addToSet":
+            marker = sort_value(value)
+            if marker not in self.seen:
+                self.seen.add(marker)
+                self.value.append(value)
+
+    def result(self) -> Any:
+        if self.op == "$avg":
+            return self.value / self.count if self.count else None
+        return None if self.value is _MISSING else self.value
+
+
+_ORDER_SENSITIVE = ("$first", "$last", "$push")
+_ACCUMULATORS = ("$sum", "$avg", "$first", "$last", "$min", "$max", "$push", "$addToSet", "$count")
+
+
+def _hashable(value: Any) -> Any:
+    if isinstance(value, dict):
+        return ("__dict__",) + tuple((k, _hashable(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return ("__list__",) + tuple(_hashable(v) for v in value)
+    return sort_value(value)
+
+
+def _parse_accumulators(spec: Dict[str, Any]):
+    fields = []
+    for name, accumulator in spec.items():
+        if name == "_id":
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            raise ValueError(f"The group field {name!r} must specify one accumulator")
+        (op, expr), = accumulator.items()
+        if op not in _ACCUMULATORS:
+            raise ValueError(f"Unsupported group accumulator {op!r}")
+        if op == "$count":
+            op, expr = "$sum", 1
+        fields.append((name, op, expr))
+    return fields
+
+
+def _group(docs: Iterable[dict], spec: Dict[str, Any],
+           rank: Optional[Callable[[dict], Any]] = None) -> Iterator[dict]:
+    """
+    Hash aggregation. When a preceding $sort has been fused in, rank orders
+    documents within each group instead of sorting the whole input.
+    """
+    key_expr = spec.get("_id")
+    fields = _parse_accumulators(spec)
+    groups: Dict[Any, tuple] = {}
+    for doc in docs:
+        key_value = evaluate(key_expr, doc)
+        key = _hashable(key_value)
+        group = groups.get(key)
+        if group is None:
+            group = (key_value, [_Accumulator(op) for _, op, _ in fields])
+            groups[key] = group
+        doc_rank = rank(doc) if rank is not None else None
+        for (_, _, expr), accumulator in zip(fields, group[1]):
+            accumulator.add(evaluate(expr, doc), doc_rank)
+    for key_value, accumulators in groups.values():
+        result = {"_id": key_value}
+        for (name, _, _), accumulator in zip(fields, accumulators):
+            result[name] = accumulator.result()
+        yield result
+
+
+# ---------------------------------------------------------------------------
+# Other stages
+# ---------------------------------------------------------------------------
+
+def _project(docs: Iterable[dict], spec: Dict[str, Any]) -> Iterator[dict]:
+    computed = {
+        key: value for key, value in spec.items()
+        if not (isinstance(value, (bool, int)) and value in (0, 1))
+    }
+    if not computed:
+        yield from map(compile_projection(spec), docs)
+        return
+    included = [key for key, value in spec.items() if key not in computed and value]
+    keep_id = spec.get("_id", 1) not in (0, False) and "_id" not in computed
+    for doc in docs:
+        result = {"_id": doc.get("_id")} if keep_id and "_id" in doc else {}
+        for key in included:
+            value = get_path_value(doc, key, _MISSING)
+            if value is not _MISSING:
+                result[key] = value
+        for key, expr in computed.items():
+            result[key] = evaluate(expr, doc)
+        yield result
+
+
+def _add_fields(docs: Iterable[dict], spec: Dict[str, Any]) -> Iterator[dict]:
+    for doc in docs:
+        result = dict(doc)
+        for key, expr in spec.items():
+            result[key] = evaluate(expr, doc)
+        yield result
+
+
+def _unwind(docs: Iterable[dict], spec: Any) -> Iterator[dict]:
+    if isinstance(spec, str):
+        spec = {"path": spec}
+    field = spec["path"].lstrip("$")
+    keep_empty = spec.get("preserveNullAndEmptyArrays", False)
+    for doc in docs:
+        value = doc.get(field)
+        if isinstance(value, list) and value:
+            for item in value:
+                yield {**doc, field: item}
+        elif value is not None and not isinstance(value, list):
+            yield doc
+        elif keep_empty:
+            yield doc
+
+
+def _sort(docs: Iterable[dict], spec: Dict[str, Any], limit: Optional[int]) -> Iterator[dict]:
+    sort = normalize_sort(spec)
+    if limit is not None:
+        # Bounded top-N instead of sorting the whole input
+        return iter(heapq.nsmallest(limit, docs, key=sort_key(sort)))
+    return iter(sort_documents(list(docs), sort))
+
+
+def _count(docs: Iterable[dict], field: str) -> Iterator[dict]:
+    total = sum(1 for _ in docs)
+    if total:
+        yield {field: total}
+
+
+def _top_n(stages: List[Stage], index: int) -> Optional[int]:
+    """How many documents a $sort at stages[index] needs to keep, if bounded"""
+    skip = 0
+    for stage in stages[index + 1:]:
+        if "$skip" in stage:
+            skip += stage["$skip"]
+        elif "$limit" in stage:
+            return skip + stage["$limit"]
+        else:
+            return None
+    return None
+
+
+def _fusable_group(stage: Stage) -> bool:
+    """A $group whose order-sensitive accumulators only need a per-group winner"""
+    if "$group" not in stage:
+        return False
+    ops = [op for _, op, _ in _parse_accumulators(stage["$group"])]
+    return "$push" not in ops
+
+
+def _run_stages(docs: Iterable[dict], stages: List[Stage]) -> Iterator[dict]:
+    index = 0
+    while index < len(stages):
+        stage = stages[index]
+        if len(stage) != 1:
+            raise ValueError("Each pipeline stage must have exactly one field")
+        (name, spec), = stage.items()
+        if name == "$match":
+            docs = filter(compile_filter(spec), docs)
+        elif name == "$sort":
+            next_stage = stages[index + 1] if index + 1 < len(stages) else {}
+            if _fusable_group(next_stage):
+                # $sort followed by $group: rank within each group in one pass
+                docs = _group(docs, next_stage["$group"], sort_key(normalize_sort(spec)))
+                index += 1
+            else:
+                docs = _sort(docs, spec, _top_n(stages, index))
+        elif name == "$group":
+            docs = _group(docs, spec)
+        elif name == "$count":
+            docs = _count(docs, spec)
+        elif name == "$limit":
+            docs = itertools.islice(docs, spec)
+        elif name == "$skip":
+            docs = itertools.islice(docs, spec, None)
+        elif name == "$project":
+            docs = _project(docs, spec)
+        elif name in ("$addFields", "$set"):
+            docs = _add_fields(docs, spec)
+        elif name == "$unwind":
+            docs = _unwind(docs, spec)
+        else:
+            raise ValueError(f"Unsupported pipeline stage {name!r}")
+        index += 1
+    return docs
+
+
+def run_pipeline(collection, indexes: Optional[CompoundIndexSet], pipeline: List[Stage]) -> Iterator[dict]:
+    """
+    Execute an aggregation pipeline over a Mongita collection.
+    A leading $match, and a $sort/$skip/$limit directly behind it, run as an
+    indexed query; the remaining stages stream over the cached documents.
+    """
+    stages = list(pipeline)
+    query, sort, skip, limit = {}, [], 0, None
+    if stages and "$match" in stages[0]:
+        query = stages.pop(0)["$match"]
+    if stages and "$sort" in stages[0] and not (len(stages) > 1 and _fusable_group(stages[1])):
+        sort = normalize_sort(stages.pop(0)["$sort"])
+        while stages and ("$skip" in stages[0] or "$limit" in stages[0]):
+            if "$skip" in stages[0]:
+                if limit is not None:
+                    break
+                skip += stages.pop(0)["$skip"]
+            else:
+                limit = stages.pop(0)["$limit"] if limit is None else min(limit, stages.pop(0)["$limit"])
+
+    docs = run_query(collection, indexes, query, sort, skip, limit, shallow=True)
+    # Stages share references into the engine cache, so results are copied
+    # before they leave the executor
+    return map(copy.deepcopy, _run_stages(docs, stages))
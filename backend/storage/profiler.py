@@ -0,0 +1,252 @@
+"""
+Per-operation database latency histograms and slow-query log
+Operations are keyed by collection, operation and the normalized shape of
+their filter (values replaced by "?"), so one hot count_documents call can
+be told apart from the others on the same collection
+"""
+
+import contextlib
+import datetime
+import json
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+from config import settings
+
+# Histogram bucket upper bounds in milliseconds; the last bucket is open
+_BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# Operators whose argument is a list of values rather than sub-filters
+_VALUE_LIST_OPERATORS = frozenset(("$in", "$nin", "$all"))
+
+
+def query_shape(query: Any) -> Any:
+    """A filter with every value replaced by "?" (operators and field names kept)"""
+    if isinstance(query, dict):
+        shape = {}
+        for key, value in query.items():
+            if key in _VALUE_LIST_OPERATORS:
+                shape[key] = "?"
+            elif key in ("$and", "$or", "$nor") and isinstance(value, list):
+                shape[key] = [query_shape(item) for item in value]
+            elif isinstance(value, dict):
+                shape[key] = query_shape(value)
+            else:
+                shape[key] = "?"
+        return shape
+    return "?"
+
+
+def pipeline_shape(pipeline: List[dict]) -> list:
+    """Stage names, with the shape of any $match filter"""
+    shape = []
+    for stage in pipeline or []:
+        (name, spec), = stage.items()
+        shape.append({name: query_shape(spec)} if name == "$match" else name)
+    return shape
+
+
+def shape_key(shape: Any) -> str:
+    return json.dumps(shape, sort_keys=True, separators=(",", ":"), default=str)
+
+
+class LatencyHistogram:
+    __slots__ = ("buckets", "count", "total", "max", "results")
+
+    def __init__(self):
+        self.buckets = [0] * (len(_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.results = 0
+
+    def record(self, elapsed_ms: float, results: Optional[int]):
+        index = 0
+        while index < len(_BUCKETS_MS) and elapsed_ms > _BUCKETS_MS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += elapsed_ms
+        self.max = max(self.max, elapsed_ms)
+        self.results += results or 0
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction of samples"""
+        if not self.count:
+            return 0.0
+        threshold = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= threshold:
+                return float(_BUCKETS_MS[index]) if index < len(_BUCKETS_MS) else round(self.max, 3)
+        return round(self.max, 3)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total, 3),
+            "avg_ms": round(self.total / self.count, 3) if self.count else 0,
+            "max_ms": round(self.max, 3),
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "avg_results": round(self.results / self.count, 2) if self.count else 0,
+            "buckets": {
+                (f"<={bound}ms" if index < len(_BUCKETS_MS) else f">{_BUCKETS_MS[-1]}ms"): count
+                for index, (bound, count) in enumerate(zip(_BUCKETS_MS + (None,), self.buckets))
+                if count
+            },
+        }
+
+
+class QueryProfiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, str, str], LatencyHistogram] = {}
+        self._slow = deque(maxlen=max(1, settings.DB_SLOW_QUERY_LOG_SIZE))
+
+    def record(self, collection: str, operation: str, shape: Any, elapsed_ms: float,
+               results: Optional[int] = None, explain: Optional[Callable[[], Optional[str]]] = None,
+               detail: Optional[dict] = None):
+        key = (collection, operation, shape_key(shape))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram()
+            histogram.record(elapsed_ms, results)
+
+        threshold = settings.DB_SLOW_QUERY_MS
+        if not threshold or elapsed_ms < threshold:
+            return
+        # Index choice is only worked out for the queries that get logged
+        try:
+            index = explain() if explain is not None else None
+        except Exception:
+            index = None
+        entry = {
+            "at": datetime.datetime.utcnow().isoformat(),
+            "collection": collection,
+            "operation": operation,
+            "shape": shape,
+            "ms": round(elapsed_ms, 3),
+            "results": results,
+            "index": index,
+            **(detail or {}),
+        }
+        with self._lock:
+            self._slow.append(entry)
+        print(
+            f"⚠ Slow query {collection}.{operation} {elapsed_ms:.1f}ms "
+            f"results={results} index={index or 'none'} shape={key[2]}"
+        )
+
+    def metrics(self, reset: bool = False, limit: Optional[int] = None, order_by: str = "total_ms") -> dict:
+        with self._lock:
+            operations = [
+                {"collection": collection, "operation": operation, "shape": shape, **histogram.to_dict()}
+                for (collection, operation, shape), histogram in self._histograms.items()
+            ]
+            slow = list(self._slow)
+            if reset:
+                self._histograms.clear()
+                self._slow.clear()
+        operations.sort(key=lambda item: item.get(order_by, 0), reverse=True)
+        return {
+            "slow_query_ms": settings.DB_SLOW_QUERY_MS,
+            "operations": operations[:limit] if limit else operations,
+            "slow_queries": slow[::-1],
+        }
+
+
+profiler = QueryProfiler()
+
+
+class _Probe:
+    __slots__ = ("results", "explain", "detail")
+
+    def __init__(self, explain, detail):
+        self.results: Optional[int] = None
+        self.explain = explain
+        self.detail = detail
+
+
+@contextlib.contextmanager
+def profile_operation(collection: str, operation: str, shape: Any,
+                      explain: Optional[Callable[[], Optional[str]]] = None,
+                      detail: Optional[dict] = None):
+    """
+    Time the enclosed block and record it under (collection, operation,
+    shape). Set probe.results to the number of documents returned or written.
+    """
+    probe = _Probe(explain, detail)
+    if not settings.DB_QUERY_STATS:
+        yield probe
+        return
+    started = time.perf_counter()
+    try:
+        yield probe
+    finally:
+        profiler.record(
+            collection, operation, shape, (time.perf_counter() - started) * 1000,
+            probe.results, probe.explain, probe.detail
+        )
+
+
+def query_metrics(reset: bool = False, limit: Optional[int] = None, order_by: str = "total_ms") -> dict:
+    return profiler.metrics(reset=reset, limit=limit, order_by=order_by)
+
+
+class CommandProfiler(monitoring.CommandListener):
+    """Feeds MongoDB commands (DB_MODE=mongo) into the same histograms"""
+
+    # command name -> (operation, where its filter lives)
+    _COMMANDS = {
+        "find": ("find", lambda command: command.get("filter")),
+        "aggregate": ("aggregate", lambda command: pipeline_shape(command.get("pipeline"))),
+        "count": ("count_documents", lambda command: command.get("query")),
+        "distinct": ("distinct", lambda command: command.get("query")),
+        "insert": ("insert", lambda command: None),
+        "update": ("update", lambda command: (command.get("updates") or [{}])[0].get("q")),
+        "delete": ("delete", lambda command: (command.get("deletes") or [{}])[0].get("q")),
+        "getMore": ("getMore", lambda command: None),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[Any, int], Tuple[str, str, Any]] = {}
+
+    def started(self, event):
+        spec = self._COMMANDS.get(event.command_name)
+        if spec is None:
+            return
+        operation, get_filter = spec
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get("collection", "?")
+        raw = get_filter(event.command)
+        shape = raw if isinstance(raw, list) else query_shape(raw or {})
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (collection, operation, shape)
+
+    def _finish(self, event, results: Optional[int]):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is not None and settings.DB_QUERY_STATS:
+            collection, operation, shape = pending
+            profiler.record(collection, operation, shape, event.duration_micros / 1000, results)
+
+    def succeeded(self, event):
+        reply = event.reply or {}
+        cursor = reply.get("cursor") or {}
+        batch = cursor.get("firstBatch", cursor.get("nextBatch"))
+        self._finish(event, len(batch) if batch is not None else reply.get("n"))
+
+    def failed(self, event):
+        self._finish(event, None)
+
+
+command_profiler = CommandProfiler()
@@ -0,0 +1,102 @@
+"""
+Projection support for the embedded database
+Mongita ignores projections, so we apply them in the worker thread and copy
+only the fields a caller asked for
+"""
+
+import copy
+from typing import Callable, Dict, Iterable, Optional, Union
+
+Projector = Callable[[dict], dict]
+
+_MISSING = object()
+
+
+def _build_tree(paths: Iterable[str]) -> dict:
+    """Turn dotted paths into a nested dict; None marks a whole-field leaf"""
+    tree: dict = {}
+    for path in paths:
+        node = tree
+        parts = path.split(".")
+        for part in parts[:-1]:
+            if part in node and node[part] is None:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+def _include(value, tree: dict):
+    if isinstance(value, dict):
+        result = {}
+        for key, subtree in tree.items():
+            if key not in value:
+                continue
+            child = value[key]
+            if subtree is None:
+                result[key] = copy.deepcopy(child)
+            elif isinstance(child, (dict, list)):
+                result[key] = _include(child, subtree)
+        return result
+    # Arrays of embedded documents project every element
+    return [_include(item, tree) for item in value if isinstance(item, (dict, list))]
+
+
+def _exclude(value, tree: dict):
+    if isinstance(value, dict):
+        result = {}
+        for key, child in value.items():
+            subtree = tree.get(key, _MISSING)
+            if subtree is None:
+                continue
+            if subtree is _MISSING or not isinstance(child, (dict, list)):
+                result[key] = copy.deepcopy(child)
+            else:
+                result[key] = _exclude(child, subtree)
+        return result
+    return [
+        _exclude(item, tree) if isinstance(item, (dict, list)) else copy.deepcopy(item)
+        for item in value
+    ]
+
+
+def compile_projection(projection: Optional[Union[Dict[str, object], Iterable[str]]]) -> Optional[Projector]:
+    """
+    Compile a MongoDB-style projection into a function that builds the projected
+    copy of a document. Supports inclusion and exclusion of top-level and dotted
+    fields (e.g. "vitals.systolic"). Returns None when every field is wanted.
+    """
+    if not projection:
+        return None
+    if not isinstance(projection, dict):
+        projection = {field: 1 for field in projection}
+
+    include_id = True
+    fields: Dict[str, bool] = {}
+    for key, value in projection.items():
+        if isinstance(value, dict):
+            raise ValueError(f"Projection operators are not supported in embedded mode: {key!r}")
+        if key == "_id":
+            include_id = bool(value)
+        else:
+            fields[key] = bool(value)
+
+    modes = set(fields.values())
+    if len(modes) > 1:
+        raise ValueError("Projection cannot mix inclusion and exclusion")
+
+    if modes == {True} or (not fields and include_id):
+        tree = _build_tree(fields)
+
+        def project_include(doc: dict) -> dict:
+            result = {"_id": doc["_id"]} if include_id and "_id" in doc else {}
+            result.update(_include(doc, tree))
+            return result
+        return project_include
+
+    tree = _build_tree(list(fields) + ([] if include_id else ["_id"]))
+
+    def project_exclude(doc: dict) -> dict:
+        return _exclude(doc, tree)
+    return project_exclude
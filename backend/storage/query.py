@@ -0,0 +1,74 @@
+"""
+Query execution for the embedded database
+Chooses between compound indexes, Mongita's own indexes and an in-process
+matcher for the filter features Mongita does not understand
+"""
+
+import copy
+import itertools
+from typing import Any, Dict, Iterator, Optional
+
+from storage.compound_index import CompoundIndexSet, index_name
+from storage.engine import find_documents, get_document
+from storage.memory import MemoryCollection
+from storage.matcher import SortSpec, compile_filter, sort_documents, split_filter
+
+
+def run_query(collection, indexes: Optional[CompoundIndexSet], query: Optional[Dict[str, Any]],
+              sort: Optional[SortSpec] = None, skip: int = 0, limit: Optional[int] = None,
+              shallow: bool = False) -> Iterator[dict]:
+    """
+    Documents matching a filter, in sort order, after skip/limit.
+    With shallow=True documents come straight from the engine cache and must
+    not be mutated.
+    """
+    query = query or {}
+    sort = sort or []
+    skip = skip or 0
+    plan = indexes.plan(query, sort) if indexes else None
+    native, residual = split_filter(query)
+
+    if plan is None and not residual:
+        return find_documents(collection, query, sort, limit, skip, shallow=shallow)
+
+    if plan is not None:
+        docs = plan.documents(lambda doc_id: get_document(collection, doc_id, shallow=True))
+        if sort and not plan.ordered:
+            docs = iter(sort_documents(list(docs), sort))
+    else:
+        # Mongita narrows the scan with whatever it can evaluate; the rest of
+        # the filter ($or, $and, $regex, $exists, ...) is matched here
+        matches = compile_filter(residual)
+        docs = filter(matches, find_documents(collection, native, sort, shallow=True))
+
+    stop = skip + limit if limit else None
+    docs = itertools.islice(docs, skip, stop)
+    return docs if shallow else map(copy.deepcopy, docs)
+
+
+def count_query(collection, indexes: Optional[CompoundIndexSet], query: Optional[Dict[str, Any]]) -> int:
+    """Count matching documents without copying them"""
+    _, residual = split_filter(query)
+    if not residual:
+        return collection.count_documents(query or {})
+    return sum(1 for _ in run_query(collection, indexes, query, shallow=True))
+
+
+def explain_index(collection, indexes: Optional[CompoundIndexSet], query: Optional[Dict[str, Any]],
+                  sort: Optional[SortSpec] = None) -> Optional[str]:
+    """Name of the index run_query answers a filter from, or None for a collection scan"""
+    query = query or {}
+    plan = indexes.plan(query, sort or []) if indexes else None
+    if plan is not None:
+        return index_name(plan.index.keys)
+    native, _ = split_filter(query)
+    if isinstance(collection, MemoryCollection):
+        return collection.explain_index(native)
+    # Mongita narrows a find with the index of every filtered field that has one
+    indexed = {}
+    for info in collection.index_information():
+        for name, spec in info.items():
+            for field, _ in spec["key"]:
+                indexed.setdefault(field, name)
+    used = [indexed[field] for field in native if field in indexed and field != "_id"]
+    return ",".join(used) or None
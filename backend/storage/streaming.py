@@ -0,0 +1,67 @@
+"""
+Streaming cursor support for the embedded database
+Batches are fetched on the DB executor into a bounded queue that async
+iterators drain
+"""
+
+import asyncio
+import itertools
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator, List, Optional
+
+_DONE = object()
+
+
+class _ProducerError:
+    """Carries an exception raised while fetching a batch back to the consumer"""
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+async def stream_batches(
+    make_iterable: Callable[[], Iterable[Any]],
+    batch_size: int,
+    max_batches: int,
+    run: Callable[[Callable[[], Any]], Awaitable[Any]]
+) -> AsyncIterator[List[Any]]:
+    """
+    Iterate a blocking iterable in lists of at most batch_size items. Each
+    batch is fetched by a separate run() call (the DB executor), so no thread
+    is held while the consumer works. At most max_batches batches are
+    buffered, so fetching pauses when the consumer falls behind and memory
+    stays bounded.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_batches))
+    batch_size = max(1, batch_size)
+    iterator: Optional[Iterator[Any]] = None
+
+    def fetch() -> List[Any]:
+        nonlocal iterator
+        if iterator is None:
+            iterator = iter(make_iterable())
+        return list(itertools.islice(iterator, batch_size))
+
+    async def produce():
+        try:
+            while True:
+                batch = await run(fetch)
+                if batch:
+                    await queue.put(batch)
+                if len(batch) < batch_size:
+                    break
+            await queue.put(_DONE)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as exc:
+            await queue.put(_ProducerError(exc))
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _ProducerError):
+                raise item.exc
+            yield item
+    finally:
+        producer.cancel()